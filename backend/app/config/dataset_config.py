@@ -5,4 +5,10 @@ import os
 
 DATASET_PATH = os.getenv('RAG_DATASET_PATH', r'D:\MECON\Project\chatbot-app\backend\sap_issues_dataset.csv')
 
+# RAG ingestion: characters per chunk, texts per embedding batch and embedding worker processes
+RAG_CHUNK_SIZE = int(os.getenv('RAG_CHUNK_SIZE', '300'))
+RAG_EMBED_BATCH_SIZE = int(os.getenv('RAG_EMBED_BATCH_SIZE', '256'))
+RAG_EMBED_WORKERS = int(os.getenv('RAG_EMBED_WORKERS', str(max((os.cpu_count() or 2) // 2, 1))))
 
+# Background ingestion jobs keep their status and checkpoints here so they survive restarts
+INGEST_JOBS_DIR = os.getenv('INGEST_JOBS_DIR', './ingestion_jobs')
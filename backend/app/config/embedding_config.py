@@ -0,0 +1,28 @@
+# Embedding model and on-disk embedding cache configuration
+
+import os
+
+# Identifies the embedding model in cache keys and stored vectors; change it whenever the model changes
+EMBEDDING_MODEL_ID = os.getenv('EMBEDDING_MODEL_ID', 'all-MiniLM-L6-v2')
+
+# Embedding engine: "default" is ChromaDB's built-in MiniLM, "onnx" runs the same model
+# through ONNX Runtime with the precision, thread and batching settings below
+EMBEDDING_ENGINE = os.getenv('EMBEDDING_ENGINE', 'default').lower()
+# "int8" (dynamically quantized, needs the onnx package once to quantize) or "fp32"
+EMBEDDING_PRECISION = os.getenv('EMBEDDING_PRECISION', 'int8').lower()
+# Optional path of a ready .onnx model; by default ChromaDB's downloaded model is used (and quantized)
+EMBEDDING_ONNX_MODEL = os.getenv('EMBEDDING_ONNX_MODEL', '')
+# ONNX Runtime intra-op threads per inference
+EMBEDDING_THREADS = int(os.getenv('EMBEDDING_THREADS', str(min(os.cpu_count() or 1, 4))))
+
+# Dynamic batching: small embedding calls that arrive within EMBEDDING_BATCH_WINDOW_MS of each
+# other are run as one inference of at most EMBEDDING_MAX_BATCH texts (0 ms disables batching)
+EMBEDDING_MAX_BATCH = int(os.getenv('EMBEDDING_MAX_BATCH', '64'))
+EMBEDDING_BATCH_WINDOW_MS = float(os.getenv('EMBEDDING_BATCH_WINDOW_MS', '2'))
+
+# Load the model and run one inference at startup so the first request does not pay for it
+EMBEDDING_WARMUP = os.getenv('EMBEDDING_WARMUP', 'true').lower() == 'true'
+
+# Directory of the persistent embedding cache. Kept outside the ChromaDB directory
+# so it survives a ChromaDB reset; an empty value disables the cache.
+EMBEDDING_CACHE_DIR = os.getenv('EMBEDDING_CACHE_DIR', './embedding_cache')
@@ -0,0 +1,14 @@
+# Configuration for writing chat exchanges into ChromaDB
+
+import os
+
+# Exchanges waiting to be embedded; when the queue is full new ones are dropped and left to the incremental sync
+CHAT_INDEX_MAX_QUEUE = int(os.getenv('CHAT_INDEX_MAX_QUEUE', '1000'))
+
+# A batch is written once it has this many exchanges or its first exchange has waited this many seconds
+CHAT_INDEX_BATCH_SIZE = int(os.getenv('CHAT_INDEX_BATCH_SIZE', '32'))
+CHAT_INDEX_FLUSH_INTERVAL = float(os.getenv('CHAT_INDEX_FLUSH_INTERVAL', '0.5'))
+
+# Chat memory is split into this many ChromaDB collections by a hash of the user id.
+# Fixed once data exists (recorded in the ChromaDB directory's layout.json).
+CHAT_MEMORY_SHARDS = int(os.getenv('CHAT_MEMORY_SHARDS', '16'))
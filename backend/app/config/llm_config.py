@@ -0,0 +1,71 @@
+# LLM (Ollama) configuration
+# Override any of these through environment variables for your deployment
+
+import os
+
+OLLAMA_BASE_URL = os.getenv('OLLAMA_BASE_URL', 'http://localhost:11434')
+# Comma-separated list of Ollama servers to balance across (defaults to OLLAMA_BASE_URL)
+OLLAMA_BASE_URLS = [url.strip() for url in os.getenv('OLLAMA_BASE_URLS', OLLAMA_BASE_URL).split(',') if url.strip()]
+OLLAMA_MODEL = os.getenv('OLLAMA_MODEL', 'llama3.2')
+
+# 'generate' sends one flattened prompt to /api/generate. 'chat' sends structured
+# messages to /api/chat with a stable prefix (system message, then the session's
+# turns in order) so Ollama can reuse its KV cache between turns.
+OLLAMA_API_MODE = os.getenv('OLLAMA_API_MODE', 'generate')
+# In chat mode, the maximum number of earlier turns sent as messages
+OLLAMA_CHAT_MAX_TURNS = int(os.getenv('OLLAMA_CHAT_MAX_TURNS', '8'))
+
+# Timeouts in seconds. The read timeout is the longest gap allowed between two
+# chunks from Ollama, not the total generation time.
+OLLAMA_CONNECT_TIMEOUT = float(os.getenv('OLLAMA_CONNECT_TIMEOUT', '5'))
+OLLAMA_READ_TIMEOUT = float(os.getenv('OLLAMA_READ_TIMEOUT', '120'))
+
+# Connection pool shared by every chat and streaming request
+OLLAMA_MAX_CONNECTIONS = int(os.getenv('OLLAMA_MAX_CONNECTIONS', '100'))
+OLLAMA_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv('OLLAMA_MAX_KEEPALIVE_CONNECTIONS', '20'))
+OLLAMA_KEEPALIVE_EXPIRY = float(os.getenv('OLLAMA_KEEPALIVE_EXPIRY', '60'))
+
+# Backend health checks: probe every interval seconds (0 disables) and eject a
+# backend after this many consecutive failed probes or requests
+OLLAMA_HEALTH_CHECK_INTERVAL = float(os.getenv('OLLAMA_HEALTH_CHECK_INTERVAL', '10'))
+OLLAMA_HEALTH_CHECK_TIMEOUT = float(os.getenv('OLLAMA_HEALTH_CHECK_TIMEOUT', '2'))
+OLLAMA_EJECT_AFTER_FAILURES = int(os.getenv('OLLAMA_EJECT_AFTER_FAILURES', '3'))
+
+# Send a hedged copy of a streaming request to a second backend when the first
+# token has not arrived after this many seconds (0 disables hedging)
+OLLAMA_HEDGE_AFTER = float(os.getenv('OLLAMA_HEDGE_AFTER', '0'))
+
+# Exact-match reply cache (set RESPONSE_CACHE_MAX_ENTRIES=0 to disable)
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv('RESPONSE_CACHE_MAX_ENTRIES', '1024'))
+RESPONSE_CACHE_TTL = float(os.getenv('RESPONSE_CACHE_TTL', '3600'))
+
+# Semantic answer cache for /chat/chroma. A cached answer is reused when the
+# cosine distance between the new and the cached question is below the threshold.
+# Answers are only reused in the chat session they were generated in, since
+# they were built from that session's chat memory.
+SEMANTIC_CACHE_ENABLED = os.getenv('SEMANTIC_CACHE_ENABLED', 'true').lower() == 'true'
+SEMANTIC_CACHE_MAX_DISTANCE = float(os.getenv('SEMANTIC_CACHE_MAX_DISTANCE', '0.08'))
+# When true, answers generated without any chat history in the prompt are also
+# reused for other users and sessions
+SEMANTIC_CACHE_SHARED = os.getenv('SEMANTIC_CACHE_SHARED', 'false').lower() == 'true'
+# Cached answers expire after this many seconds; above max entries the oldest are evicted
+SEMANTIC_CACHE_TTL = float(os.getenv('SEMANTIC_CACHE_TTL', '86400'))
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.getenv('SEMANTIC_CACHE_MAX_ENTRIES', '10000'))
+
+# Admission control: generations allowed to run at once, requests allowed to
+# wait for a slot, and how long (seconds) a request may wait before a 429
+GENERATION_MAX_CONCURRENT = int(os.getenv('GENERATION_MAX_CONCURRENT', '4'))
+GENERATION_MAX_QUEUE = int(os.getenv('GENERATION_MAX_QUEUE', '32'))
+GENERATION_QUEUE_TIMEOUT = float(os.getenv('GENERATION_QUEUE_TIMEOUT', '30'))
+
+# Prompt size limits in (approximate) tokens. PROMPT_MAX_TOKENS should leave room
+# for the reply inside the model's context window (Ollama's num_ctx).
+PROMPT_MAX_TOKENS = int(os.getenv('PROMPT_MAX_TOKENS', '3072'))
+PROMPT_SECTION_BUDGETS = {
+    'system': int(os.getenv('PROMPT_BUDGET_SYSTEM', '256')),
+    'history': int(os.getenv('PROMPT_BUDGET_HISTORY', '768')),
+    'knowledge': int(os.getenv('PROMPT_BUDGET_KNOWLEDGE', '768')),
+    'recent': int(os.getenv('PROMPT_BUDGET_RECENT', '768')),
+    'attachments': int(os.getenv('PROMPT_BUDGET_ATTACHMENTS', '1536')),
+    'user': int(os.getenv('PROMPT_BUDGET_USER', '1024')),
+}
@@ -0,0 +1,60 @@
+# Retrieval configuration for conversation history and RAG knowledge
+
+import os
+
+# Number of candidates fetched from ChromaDB before filtering and diversification
+RETRIEVAL_CANDIDATES = int(os.getenv('RETRIEVAL_CANDIDATES', '15'))
+
+# Results farther than these cosine distances are treated as irrelevant
+HISTORY_MAX_DISTANCE = float(os.getenv('HISTORY_MAX_DISTANCE', '0.65'))
+KNOWLEDGE_MAX_DISTANCE = float(os.getenv('KNOWLEDGE_MAX_DISTANCE', '0.6'))
+
+# Maximal marginal relevance trade-off: 1.0 ranks by relevance only, lower values favour diversity
+RETRIEVAL_MMR_LAMBDA = float(os.getenv('RETRIEVAL_MMR_LAMBDA', '0.7'))
+
+# Seconds each concurrent context-gathering stage (vector queries, history lookups) may take
+# before the request goes ahead without it
+RETRIEVAL_STAGE_TIMEOUT = float(os.getenv('RETRIEVAL_STAGE_TIMEOUT', '2'))
+
+# Number of recent query embeddings kept in memory so one message is only embedded once
+QUERY_EMBEDDING_CACHE_SIZE = int(os.getenv('QUERY_EMBEDDING_CACHE_SIZE', '256'))
+
+# Hybrid knowledge retrieval: BM25 and exact transaction-code matches fused with the vector results
+HYBRID_RETRIEVAL_ENABLED = os.getenv('HYBRID_RETRIEVAL_ENABLED', 'true').lower() == 'true'
+BM25_K1 = float(os.getenv('BM25_K1', '1.5'))
+BM25_B = float(os.getenv('BM25_B', '0.75'))
+# Transaction codes made of letters only (comma-separated). Codes with digits (VA01, SE16N, FBL1N) are
+# recognised by their shape; letter-only codes cannot be told apart from acronyms such as SAP or GUI.
+TRANSACTION_CODE_ALLOWLIST = frozenset(
+    code.strip().upper() for code in os.getenv(
+        'TRANSACTION_CODE_ALLOWLIST',
+        'MIRO,MIGO,MMBE,MMRV,MRBR,MKVZ,PFCG,SUIM,SICF,SEGW,SPAU,SPDD,STAD,STMS,SPRO,SOST,SCOT,SARA,'
+        'SHDB,SPAD,SMLG,SNOTE,SMICM,STRUST,LSMW,SQVI,SBWP,COGI,COHV,COOIS'
+    ).split(',') if code.strip()
+)
+# Reciprocal rank fusion constant; larger values flatten the gap between top and lower ranks
+RRF_K = int(os.getenv('RRF_K', '60'))
+# Answer transaction-code questions from the exact-match index without the knowledge vector search
+TCODE_SKIP_VECTOR = os.getenv('TCODE_SKIP_VECTOR', 'true').lower() == 'true'
+
+# Knowledge fast path for /chat/chroma: when the nearest knowledge documents are within this cosine
+# distance and the closest KNOWLEDGE_FAST_PATH_TOP_K of them give the same dataset response, that
+# response is returned without calling the LLM. KNOWLEDGE_FAST_PATH_POLISH rewrites it with the LLM
+# in the background and stores the rewritten answer.
+KNOWLEDGE_FAST_PATH_ENABLED = os.getenv('KNOWLEDGE_FAST_PATH_ENABLED', 'false').lower() == 'true'
+KNOWLEDGE_FAST_PATH_MAX_DISTANCE = float(os.getenv('KNOWLEDGE_FAST_PATH_MAX_DISTANCE', '0.12'))
+KNOWLEDGE_FAST_PATH_TOP_K = int(os.getenv('KNOWLEDGE_FAST_PATH_TOP_K', '3'))
+KNOWLEDGE_FAST_PATH_POLISH = os.getenv('KNOWLEDGE_FAST_PATH_POLISH', 'false').lower() == 'true'
+
+# Vector search backend of the RAG knowledge collection: "chroma" (HNSW) or "numpy", an exact
+# search over a memory-mapped .npy matrix that suits small, static datasets. Chat memory always uses Chroma.
+KNOWLEDGE_VECTOR_BACKEND = os.getenv('KNOWLEDGE_VECTOR_BACKEND', 'chroma').lower()
+# Storage type of the numpy matrix: "float32", or "float16" for half the memory
+NUMPY_INDEX_DTYPE = os.getenv('NUMPY_INDEX_DTYPE', 'float32')
+
+# Category routing: knowledge queries only search the KNOWLEDGE_ROUTE_CATEGORIES categories whose
+# centroid embeddings are closest to the query. Knowledge bases smaller than
+# KNOWLEDGE_ROUTING_MIN_DOCUMENTS are always searched in full.
+KNOWLEDGE_ROUTING_ENABLED = os.getenv('KNOWLEDGE_ROUTING_ENABLED', 'true').lower() == 'true'
+KNOWLEDGE_ROUTE_CATEGORIES = int(os.getenv('KNOWLEDGE_ROUTE_CATEGORIES', '2'))
+KNOWLEDGE_ROUTING_MIN_DOCUMENTS = int(os.getenv('KNOWLEDGE_ROUTING_MIN_DOCUMENTS', '20000'))
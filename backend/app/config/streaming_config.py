@@ -0,0 +1,13 @@
+# Streaming reply configuration
+
+import os
+
+# Maximum number of chunks kept per streamed reply for clients that reconnect
+STREAM_BUFFER_MAX_CHUNKS = int(os.getenv('STREAM_BUFFER_MAX_CHUNKS', '4096'))
+
+# Seconds a completed reply stays resumable before its buffer is evicted
+STREAM_BUFFER_TTL = float(os.getenv('STREAM_BUFFER_TTL', '300'))
+
+# Seconds generation keeps running after the last client disconnects, waiting
+# for a resume. After that the Ollama generation is cancelled.
+STREAM_RESUME_GRACE = float(os.getenv('STREAM_RESUME_GRACE', '20'))
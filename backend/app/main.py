@@ -2,12 +2,18 @@ from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 import os
+import asyncio
 from app.routes import auth, chat, chat_sessions, user as user_routes, file_context, streaming
 from app.routes import dataset  # <-- Add this import
 from app.database.db import Base, engine
 from app.models import user  # This imports the models so they're registered with SQLAlchemy
 from app.database.migrations import run_migrations
 from app.utils.chroma_db import chroma_db  # Import ChromaDB singleton
+from app.utils.llm_client import llm_client  # Shared async Ollama client
+from app.utils.chat_indexer import chat_indexer  # Background ChromaDB indexing
+from app.utils.embedding_engine import embedding_engine
+from app.config.embedding_config import EMBEDDING_WARMUP
+from app.utils.metrics import metrics
 
 # Initialize database tables
 Base.metadata.create_all(bind=engine)
@@ -28,6 +34,19 @@ async def startup_event():
     import os
     logger = logging.getLogger("uvicorn")
     
+    # Start probing the configured Ollama backends
+    llm_client.start_health_checks()
+    
+    # Index new chat exchanges in the background
+    chat_indexer.start()
+    
+    # Load the embedding model before the first request needs it
+    if EMBEDDING_WARMUP:
+        try:
+            await asyncio.to_thread(embedding_engine.warm_up)
+        except Exception as e:
+            logger.error(f"Embedding warm-up failed: {str(e)}")
+    
     try:
         logger.info("Initializing ChromaDB for faster responses...")
         
@@ -35,6 +54,10 @@ async def startup_event():
         collection_count = len(chroma_db.client.list_collections())
         logger.info(f"ChromaDB initialized successfully with {collection_count} collections")
         
+        # One-time move from the combined chat_history collection to separate knowledge and chat shards
+        if chroma_db.needs_migration():
+            chroma_db.migrate_legacy_layout()
+        
     except Exception as e:
         logger.error(f"Error initializing ChromaDB: {str(e)}")
         logger.info("Attempting to reset ChromaDB...")
@@ -51,6 +74,12 @@ async def startup_event():
         except Exception as reset_err:
             logger.error(f"Failed to reset ChromaDB: {str(reset_err)}")
 
+# Shutdown event to flush pending chat indexing and release pooled Ollama connections
+@app.on_event("shutdown")
+async def shutdown_event():
+    await chat_indexer.stop()
+    await llm_client.aclose()
+
 # Configure CORS
 app.add_middleware(
     CORSMiddleware,
@@ -58,6 +87,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],  # Allows all methods
     allow_headers=["*"],  # Allows all headers
+    expose_headers=["X-Chat-Id"],  # Lets the frontend resume interrupted streams
 )
 
 # Include routers
@@ -76,11 +106,21 @@ app.mount("/uploads", StaticFiles(directory=uploads_dir), name="uploads")
 async def root():
     return {"message": "Welcome to the MECON Chatbot API"}
 
+@app.get("/metrics")
+async def get_metrics():
+    """Return the in-process counters and timings of the chat pipeline."""
+    return metrics.snapshot()
+
+@app.get("/ollama/backends")
+async def get_ollama_backends():
+    """Return the health and load of each configured Ollama backend."""
+    return {"backends": llm_client.pool.status()}
+
 @app.post("/init-chroma-db")
-async def initialize_chroma_db():
-    """Initialize and populate ChromaDB with existing chat data."""
+async def initialize_chroma_db(incremental: bool = False):
+    """Initialize and populate ChromaDB with existing chat data (incremental=true only syncs new chats)."""
     from app.utils.populate_chroma import populate_chroma_db
-    success = populate_chroma_db()
+    success = populate_chroma_db(incremental=incremental)
     if success:
         return {"message": "ChromaDB successfully populated with existing chat data"}
     else:
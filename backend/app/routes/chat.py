@@ -3,17 +3,33 @@ from sqlalchemy.orm import Session
 from ..database.db import SessionLocal
 from ..models.user import Chat, ChatSession
 from pydantic import BaseModel
-from typing import List, Optional
-import requests
+from typing import Any, Dict, List, Optional, Set, Tuple
 from datetime import datetime
+import asyncio
 import json
 from app.utils.auth_jwt import get_current_user
-from app.utils.chroma_db import chroma_db
+from app.utils.chroma_db import chroma_db, split_chat_document
+from app.utils.chat_indexer import chat_indexer
 from app.utils.file_processor import file_processor
+from app.utils.llm_client import llm_client, clean_reply, LLMUnavailableError
+from app.utils.prompt_builder import PromptBuilder, DEFAULT_SYSTEM_MESSAGE, FILES_SYSTEM_MESSAGE, KNOWLEDGE_POLISH_SYSTEM_MESSAGE
+from app.utils.generation_scheduler import generation_scheduler, SchedulerBusyError
 from app.config.dataset_config import DATASET_PATH  # Import dataset config
+from app.config.llm_config import SEMANTIC_CACHE_ENABLED, SEMANTIC_CACHE_MAX_DISTANCE, SEMANTIC_CACHE_SHARED
+from app.utils.metrics import metrics
+from app.utils.context_selector import select_context
+from app.utils.hybrid_retriever import hybrid_retriever
+from app.utils.session_history import get_recent_turns, touch_session, build_session_prompt
+from app.config.retrieval_config import (
+    RETRIEVAL_CANDIDATES, KNOWLEDGE_MAX_DISTANCE, RETRIEVAL_STAGE_TIMEOUT, HYBRID_RETRIEVAL_ENABLED, TCODE_SKIP_VECTOR,
+    KNOWLEDGE_FAST_PATH_ENABLED, KNOWLEDGE_FAST_PATH_MAX_DISTANCE, KNOWLEDGE_FAST_PATH_TOP_K, KNOWLEDGE_FAST_PATH_POLISH
+)
 
 router = APIRouter(prefix="/chat", tags=["Chat"])
 
+# Background polish passes of knowledge-base answers, referenced until they finish
+_polish_tasks: Set[asyncio.Task] = set()
+
 # Dependency to get DB session
 def get_db():
     db = SessionLocal()
@@ -42,122 +58,188 @@ class ChatHistory(BaseModel):
     class Config:
         from_attributes = True
 
-OLLAMA_URL = "http://localhost:11434/api/generate"
-
-@router.post("/")
-def chat(
-    req: ChatRequest, 
-    db: Session = Depends(get_db),
-    current_user: dict = Depends(get_current_user)
-):
-    user_id = current_user["user_id"]
-    
-    # Verify the session exists and belongs to the user
-    session = db.query(ChatSession).filter(
-        ChatSession.id == req.session_id,
-        ChatSession.user_id == user_id
-    ).first()
-    
-    if not session:
-        raise HTTPException(status_code=404, detail="Chat session not found")
-      # Update the timestamp to show this session was recently used
-    from datetime import datetime
-    session.updated_at = datetime.utcnow()
+def _store_chat(db: Session, user_id: int, session_id: int, message: str, reply: str,
+                attachments: Optional[str] = None) -> Chat:
+    """Insert an exchange into the SQL database (runs in a worker thread)."""
+    chat = Chat(
+        message=message, 
+        response=reply, 
+        user_id=user_id,
+        session_id=session_id,
+        attachments=attachments
+    )
+    db.add(chat)
     db.commit()
-    
+    db.refresh(chat)
+    return chat
+
+async def _save_chat(db: Session, user_id: int, session_id: int, message: str, reply: str,
+                     attachments: Optional[str] = None, index_message: Optional[str] = None) -> Chat:
+    """Save an exchange to the SQL database and index it in ChromaDB."""
+    chat = await asyncio.to_thread(_store_chat, db, user_id, session_id, message, reply, attachments)
+
+    # Queue for ChromaDB indexing (embedded in the background) for future semantic search
+    chat_indexer.enqueue(
+        user_id=user_id,
+        session_id=session_id,
+        message=index_message or message,
+        response=reply,
+        chat_id=chat.id
+    )
+    return chat
+
+async def _run_stage(name: str, fn, *args, default=None):
+    """Run a blocking context-gathering call in the thread pool, returning default if it is slow or fails."""
     try:
-        # Use ChromaDB to find relevant previous context based on semantic similarity
-        relevant_context = chroma_db.get_relevant_context(
-            user_id=user_id,
-            session_id=req.session_id,
-            query=req.message,
-            limit=5  # Get 5 most semantically relevant chat exchanges
-        )
-        
-        # Also get the most recent messages to maintain conversation flow
-        recent_messages = db.query(Chat).filter(
-            Chat.session_id == req.session_id
-        ).order_by(Chat.timestamp.desc()).limit(3).all()  # Get last 3 messages for recency bias
-        
-        # Build context combining semantic relevance with recency
-        system_message = "You are Nexora AI, a helpful and knowledgeable assistant. Maintain context of the conversation and provide accurate, concise responses. Remember previous information shared by the user.\n\n"
-        context = system_message
-        
-        # Add semantically relevant context first
-        if relevant_context:
-            context += "Relevant conversation history:\n"
-            for exchange in relevant_context:
-                context += f"{exchange}\n\n"
-        
-        # Add recent messages for conversational flow
-        if recent_messages:
-            context += "Recent conversation:\n"
-            # Reverse to get chronological order
-            for msg in reversed(recent_messages):
-                context += f"User: {msg.message}\nAI: {msg.response}\n\n"
+        return await asyncio.wait_for(asyncio.to_thread(fn, *args), RETRIEVAL_STAGE_TIMEOUT)
+    except asyncio.TimeoutError:
+        metrics.increment("retrieval_stage_timeouts_total")
+        print(f"Context stage '{name}' timed out after {RETRIEVAL_STAGE_TIMEOUT}s, continuing without it")
     except Exception as e:
-        # If there's an issue with ChromaDB, fall back to the traditional method
-        print(f"ChromaDB error, falling back to traditional context retrieval: {str(e)}")
-        
-        # Traditional method - get previous messages from this session
-        previous_messages = db.query(Chat).filter(
-            Chat.session_id == req.session_id
-        ).order_by(Chat.timestamp.desc()).limit(10).all()
-        
-        system_message = "You are Nexora AI, a helpful and knowledgeable assistant. Maintain context of the conversation and provide accurate, concise responses. Remember previous information shared by the user.\n\n"
-        context = system_message
-        
-        if previous_messages:
-            # Reverse to get chronological order
-            for msg in reversed(previous_messages):
-                context += f"User: {msg.message}\nAI: {msg.response}\n\n"
-    
-    # Combine context with current message
-    full_prompt = f"{context}User: {req.message}\nAI:"
+        print(f"Context stage '{name}' failed, continuing without it: {str(e)}")
+    return default
 
-    payload = {
-        "model": "llama3.2",
-        "prompt": full_prompt,
-        "stream": False
-    }
+async def _vector_stages(user_id: int, session_id: int, message: str):
+    """
+    Embed the message once, then run the semantic cache lookup and the session
+    and RAG dataset (domain-specific) retrievals on that same embedding.
+    Knowledge results are fused with BM25 and exact transaction-code matches;
+    when the message names a known T-code, the knowledge vector search is skipped.
+    Returns (cached_reply, (history_candidates, knowledge_candidates)).
+    """
+    _, exact = await asyncio.gather(
+        _run_stage("query embedding", chroma_db.embed_query, message),
+        _run_stage("code lookup", hybrid_retriever.exact_matches, message, default=[])
+            if HYBRID_RETRIEVAL_ENABLED else _no_stage(),
+    )
+    skip_knowledge = bool(exact) and TCODE_SKIP_VECTOR
+    if skip_knowledge:
+        metrics.increment("knowledge_vector_search_skipped_total")
+    targets = [(user_id, session_id)] if skip_knowledge else [(user_id, session_id), ('rag', 'rag')]
     
+    cached_reply, contexts = await asyncio.gather(
+        _run_stage("semantic cache", chroma_db.get_cached_answer, message, SEMANTIC_CACHE_MAX_DISTANCE, user_id, session_id)
+            if SEMANTIC_CACHE_ENABLED else _no_stage(),
+        _run_stage("context retrieval", chroma_db.query_contexts, message,
+                   targets, RETRIEVAL_CANDIDATES, default=[[] for _ in targets]),
+    )
+    history_candidates = contexts[0]
+    knowledge_candidates = contexts[1] if len(contexts) > 1 else []
+    if HYBRID_RETRIEVAL_ENABLED:
+        knowledge_candidates = await _run_stage("hybrid retrieval", hybrid_retriever.fuse, message,
+                                                knowledge_candidates, RETRIEVAL_CANDIDATES, default=knowledge_candidates)
+    return cached_reply, (history_candidates, knowledge_candidates)
+
+async def _no_stage():
+    return None
+
+def _recent_exchanges(session_id: int) -> List[Tuple[str, str]]:
+    """
+    Return the session's most recent (message, response) pair, or in chat API mode
+    the stable window of earlier turns (runs in a worker thread).
+    """
+    db = SessionLocal()
+    try:
+        return [(chat.message, chat.response) for chat in get_recent_turns(db, session_id, limit=1)]
+    finally:
+        db.close()
+
+def _knowledge_answer(candidates: List[Dict[str, Any]]) -> Optional[str]:
+    """
+    The dataset response to return without the LLM, if the nearest knowledge documents
+    are within KNOWLEDGE_FAST_PATH_MAX_DISTANCE and the closest of them all give it.
+    """
+    close = sorted(
+        (c for c in candidates if c["distance"] <= KNOWLEDGE_FAST_PATH_MAX_DISTANCE),
+        key=lambda c: c["distance"]
+    )[:KNOWLEDGE_FAST_PATH_TOP_K]
+    responses = {split_chat_document(c["document"])[1].strip() for c in close}
+    if len(responses) != 1:
+        return None
+    return responses.pop() or None
+
+def _update_chat_response(chat_id: int, response: str) -> bool:
+    """Replace the stored reply of a chat (runs in a worker thread)."""
+    db = SessionLocal()
+    try:
+        chat = db.query(Chat).filter(Chat.id == chat_id).first()
+        if not chat:
+            return False
+        chat.response = response
+        db.commit()
+        return True
+    finally:
+        db.close()
+
+async def _polish_knowledge_answer(user_id: int, session_id: int, chat_id: int, message: str, answer: str):
+    """Rewrite a knowledge-base answer for the question with the LLM and store it in place of the dataset answer."""
+    prompt_builder = PromptBuilder(KNOWLEDGE_POLISH_SYSTEM_MESSAGE)
+    prompt_builder.add_knowledge([answer])
+    prompt_result = prompt_builder.build(message)
+    try:
+        polished = clean_reply(await llm_client.generate(
+            prompt_result.prompt, messages=prompt_result.messages, slot=lambda: generation_scheduler.slot(user_id)
+        ))
+    except Exception as e:
+        metrics.increment("knowledge_fast_path_polish_failures")
+        print(f"Polishing knowledge-base answer for chat {chat_id} failed, keeping the dataset answer: {str(e)}")
+        return
+    if not polished or polished == "No response from model.":
+        return
+    if await asyncio.to_thread(_update_chat_response, chat_id, polished):
+        chat_indexer.enqueue(user_id, session_id, message, polished, chat_id=chat_id)
+        metrics.increment("knowledge_fast_path_polished")
+
+async def _generate_reply(user_id: int, prompt: str, messages: Optional[List[dict]] = None) -> str:
+    """
+    Generate a reply, mapping failures to HTTP errors. Only a request that starts
+    an upstream generation waits for the scheduler to admit it; cached replies and
+    requests joining an identical in-flight generation do not take a slot.
+    """
     try:
-        response = requests.post(OLLAMA_URL, json=payload)
-        response.raise_for_status()
-        result = response.json()
-        ai_reply = result.get("response", "No response from model.")
+        ai_reply = await llm_client.generate(prompt, messages=messages, slot=lambda: generation_scheduler.slot(user_id))
         
         # Clean up AI response if needed to remove any artifacts from context
-        if ai_reply.startswith("AI:"):
-            ai_reply = ai_reply[3:].strip()
+        return clean_reply(ai_reply)
             
-    except requests.exceptions.ConnectionError:
+    except SchedulerBusyError as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+    except LLMUnavailableError:
         raise HTTPException(status_code=503, detail="AI service is currently unavailable. Please try again later.")
     except Exception as e:
         print(f"Error during AI request: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"Ollama error: {str(e)}")    # Save chat to the SQL database
-    chat = Chat(
-        message=req.message, 
-        response=ai_reply, 
-        user_id=user_id,
-        session_id=req.session_id
-    )
-    db.add(chat)
-    db.commit()
-    db.refresh(chat)
+        raise HTTPException(status_code=500, detail=f"Ollama error: {str(e)}")
 
-    # Also add to ChromaDB for future semantic search
-    chroma_db.add_chat_entry(
-        user_id=user_id,
-        session_id=req.session_id,
-        message=req.message,
-        response=ai_reply
+@router.post("/")
+async def chat(
+    req: ChatRequest, 
+    db: Session = Depends(get_db),
+    current_user: dict = Depends(get_current_user)
+):
+    user_id = current_user["user_id"]
+    
+    # Verify the session exists and belongs to the user, and update its timestamp
+    # to show it was recently used; database and embedding work runs off the event loop
+    if not await asyncio.to_thread(touch_session, user_id, req.session_id):
+        raise HTTPException(status_code=404, detail="Chat session not found")
+    
+    # Combine semantically relevant context with the most recent messages
+    prompt_builder = await asyncio.to_thread(
+        build_session_prompt, db, user_id, req.session_id, req.message, DEFAULT_SYSTEM_MESSAGE
     )
+    
+    # Combine context with current message within the token budget
+    prompt_result = prompt_builder.build(req.message)
+
+    ai_reply = await _generate_reply(user_id, prompt_result.prompt, prompt_result.messages)
+
+    # Save chat to the SQL database and ChromaDB
+    chat = await _save_chat(db, user_id, req.session_id, req.message, ai_reply)
 
     return {"reply": ai_reply, "chat_id": chat.id}
 
 @router.post("/chroma")
-def chat_with_chroma(
+async def chat_with_chroma(
     req: ChatRequest, 
     db: Session = Depends(get_db),
     current_user: dict = Depends(get_current_user)
@@ -165,102 +247,76 @@ def chat_with_chroma(
     """Endpoint that specifically uses ChromaDB for semantic search to retrieve context."""
     user_id = current_user["user_id"]
     
-    # Verify the session exists and belongs to the user
-    session = db.query(ChatSession).filter(
-        ChatSession.id == req.session_id,
-        ChatSession.user_id == user_id
-    ).first()
+    # The session check, recent-message lookup and vector work do not depend on each other,
+    # so run them concurrently; slow stages are dropped after RETRIEVAL_STAGE_TIMEOUT
+    session_found, recent_turns, (cached_reply, (candidates, rag_candidates)) = await asyncio.gather(
+        asyncio.to_thread(touch_session, user_id, req.session_id),
+        # Also get the most recent message to maintain conversation flow
+        _run_stage("recent message", _recent_exchanges, req.session_id, default=[]),
+        _vector_stages(user_id, req.session_id, req.message),
+    )
     
-    if not session:
+    if not session_found:
         raise HTTPException(status_code=404, detail="Chat session not found")
     
-    # Update the timestamp to show this session was recently used
-    session.updated_at = datetime.utcnow()
-    db.commit()
+    # Answer repeated and paraphrased questions straight from the semantic cache
+    if SEMANTIC_CACHE_ENABLED:
+        if cached_reply is not None:
+            metrics.increment("semantic_cache_hits")
+            chat = await _save_chat(db, user_id, req.session_id, req.message, cached_reply)
+            return {"reply": cached_reply, "chat_id": chat.id}
+        metrics.increment("semantic_cache_misses")
     
-    # Use ChromaDB to find relevant previous context based on semantic similarity
-    relevant_context = chroma_db.get_relevant_context(
-        user_id=user_id,
-        session_id=req.session_id,
-        query=req.message,
-        limit=5
-    )
-    # Add RAG dataset context (domain-specific)
-    rag_context = chroma_db.get_relevant_context(
-        user_id='rag',
-        session_id='rag',
-        query=req.message,
-        limit=3
-    )
+    # Questions the dataset answers unambiguously are answered from it without the LLM
+    if KNOWLEDGE_FAST_PATH_ENABLED:
+        answer = _knowledge_answer(rag_candidates)
+        metrics.increment("knowledge_fast_path_hits" if answer is not None else "knowledge_fast_path_misses")
+        hits = metrics.get_counter("knowledge_fast_path_hits")
+        metrics.set_gauge("knowledge_fast_path_hit_rate", hits / (hits + metrics.get_counter("knowledge_fast_path_misses")))
+        if answer is not None:
+            chat = await _save_chat(db, user_id, req.session_id, req.message, answer)
+            if KNOWLEDGE_FAST_PATH_POLISH:
+                task = asyncio.create_task(
+                    _polish_knowledge_answer(user_id, req.session_id, chat.id, req.message, answer)
+                )
+                _polish_tasks.add(task)
+                task.add_done_callback(_polish_tasks.discard)
+            return {"reply": answer, "chat_id": chat.id, "source": "knowledge_base", "polishing": KNOWLEDGE_FAST_PATH_POLISH}
     
-    # Also get the most recent message to maintain conversation flow
-    recent_message = db.query(Chat).filter(
-        Chat.session_id == req.session_id
-    ).order_by(Chat.timestamp.desc()).first()
+    # Drop distant, redundant and already-included results before building the prompt
+    relevant_context = select_context(
+        candidates,
+        limit=5,
+        recent_turns=recent_turns
+    )
+    rag_context = select_context(rag_candidates, limit=3, max_distance=KNOWLEDGE_MAX_DISTANCE)
     
     # Build context combining semantic relevance with recency
-    system_message = "You are Nexora AI, a helpful and knowledgeable assistant. Maintain context of the conversation and provide accurate, concise responses. Remember previous information shared by the user.\n\n"
-    context = system_message
+    prompt_builder = PromptBuilder(DEFAULT_SYSTEM_MESSAGE)
     
-    # Add semantically relevant context first
-    if relevant_context:
-        context += "Relevant conversation history:\n"
-        for exchange in relevant_context:
-            context += f"{exchange}\n\n"
-    # Add RAG context if available
-    if rag_context:
-        context += "Relevant domain knowledge:\n"
-        for chunk in rag_context:
-            context += f"{chunk}\n\n"
+    # Add semantically relevant context first, then RAG context if available
+    prompt_builder.add_history(relevant_context)
+    prompt_builder.add_knowledge(rag_context)
     
     # Add recent message for conversational flow
-    if recent_message:
-        context += "Most recent exchange:\n"
-        context += f"User: {recent_message.message}\nAI: {recent_message.response}\n\n"
-    
-    # Combine context with current message
-    full_prompt = f"{context}User: {req.message}\nAI:"
-
-    payload = {
-        "model": "llama3.2",
-        "prompt": full_prompt,
-        "stream": False
-    }
+    if recent_turns:
+        prompt_builder.add_recent_turns(
+            recent_turns, header="Most recent exchange:" if len(recent_turns) == 1 else "Recent conversation:"
+        )
     
-    try:
-        response = requests.post(OLLAMA_URL, json=payload)
-        response.raise_for_status()
-        result = response.json()
-        ai_reply = result.get("response", "No response from model.")
-        
-        # Clean up AI response if needed to remove any artifacts from context
-        if ai_reply.startswith("AI:"):
-            ai_reply = ai_reply[3:].strip()
-            
-    except requests.exceptions.ConnectionError:
-        raise HTTPException(status_code=503, detail="AI service is currently unavailable. Please try again later.")
-    except Exception as e:
-        print(f"Error during AI request: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"Ollama error: {str(e)}")
+    # Combine context with current message within the token budget
+    prompt_result = prompt_builder.build(req.message)
 
-    # Save chat to the SQL database
-    chat = Chat(
-        message=req.message, 
-        response=ai_reply, 
-        user_id=user_id,
-        session_id=req.session_id
-    )
-    db.add(chat)
-    db.commit()
-    db.refresh(chat)
+    ai_reply = await _generate_reply(user_id, prompt_result.prompt, prompt_result.messages)
 
-    # Also add to ChromaDB for future semantic search
-    chroma_db.add_chat_entry(
-        user_id=user_id,
-        session_id=req.session_id,
-        message=req.message,
-        response=ai_reply
-    )
+    # Save chat to the SQL database and ChromaDB
+    chat = await _save_chat(db, user_id, req.session_id, req.message, ai_reply)
+    
+    if SEMANTIC_CACHE_ENABLED:
+        # The answer only applies to other sessions if none of this session's history was in the prompt
+        personal = bool(relevant_context) or bool(recent_turns)
+        await asyncio.to_thread(chroma_db.cache_answer, query=req.message, answer=ai_reply, user_id=user_id,
+                                session_id=req.session_id, shared=SEMANTIC_CACHE_SHARED and not personal)
 
     return {"reply": ai_reply, "chat_id": chat.id}
 
@@ -274,23 +330,16 @@ async def chat_with_files(
 ):
     user_id = current_user["user_id"]
     
-    # Verify the session exists and belongs to the user
-    session = db.query(ChatSession).filter(
-        ChatSession.id == session_id,
-        ChatSession.user_id == user_id
-    ).first()
-    
-    if not session:
+    # Verify the session exists and belongs to the user, and update its timestamp
+    if not await asyncio.to_thread(touch_session, user_id, session_id):
         raise HTTPException(status_code=404, detail="Chat session not found")
     
-    # Update the timestamp to show this session was recently used
-    session.updated_at = datetime.utcnow()
-    db.commit()
-    
     processed_files = []
-    extracted_text_combined = ""    # Process each uploaded file but keep them for future reference
+    extracted_text_combined = ""
+    
+    # Process each uploaded file but keep them for future reference (OCR and PDF parsing block)
     for file in files:
-        file_info = file_processor.process_file(file, user_id, delete_after_processing=False)
+        file_info = await asyncio.to_thread(file_processor.process_file, file, user_id, delete_after_processing=False)
         processed_files.append(file_info)
         if file_info["extracted_text"]:
             extracted_text_combined += f"\n\nText from {file_info['original_name']}:\n{file_info['extracted_text']}"
@@ -313,101 +362,25 @@ async def chat_with_files(
             "extracted_text": file["extracted_text"]
         })
     
-    try:
-        # Use ChromaDB to find relevant previous context based on semantic similarity
-        relevant_context = chroma_db.get_relevant_context(
-            user_id=user_id,
-            session_id=session_id,
-            query=user_message_with_files,
-            limit=5  # Get 5 most semantically relevant chat exchanges
-        )
-        
-        # Also get the most recent messages to maintain conversation flow
-        recent_messages = db.query(Chat).filter(
-            Chat.session_id == session_id
-        ).order_by(Chat.timestamp.desc()).limit(3).all()  # Get last 3 messages for recency bias
-        
-        # Build context combining semantic relevance with recency
-        system_message = "You are Nexora AI, a helpful and knowledgeable assistant. The user is sending you messages with attached files which have been converted to text. Please analyze both the message and the extracted text to provide an appropriate response. Be concise and helpful, focusing on what the files actually contain.\n\n"
-        context = system_message
-        
-        # Add semantically relevant context first
-        if relevant_context:
-            context += "Relevant conversation history:\n"
-            for exchange in relevant_context:
-                context += f"{exchange}\n\n"
-        
-        # Add recent messages for conversational flow
-        if recent_messages:
-            context += "Recent conversation:\n"
-            # Reverse to get chronological order
-            for msg in reversed(recent_messages):
-                context += f"User: {msg.message}\nAI: {msg.response}\n\n"
-    except Exception as e:
-        # If there's an issue with ChromaDB, fall back to the traditional method
-        print(f"ChromaDB error, falling back to traditional context retrieval: {str(e)}")
-        
-        # Traditional method - get previous messages from this session
-        previous_messages = db.query(Chat).filter(
-            Chat.session_id == session_id
-        ).order_by(Chat.timestamp.desc()).limit(10).all()
-        
-        system_message = "You are Nexora AI, a helpful and knowledgeable assistant. The user is sending you messages with attached files which have been converted to text. Please analyze both the message and the extracted text to provide an appropriate response. Be concise and helpful, focusing on what the files actually contain.\n\n"
-        context = system_message
-        
-        if previous_messages:
-            # Reverse to get chronological order
-            for msg in reversed(previous_messages):
-                context += f"User: {msg.message}\nAI: {msg.response}\n\n"
+    # Combine semantically relevant context with the most recent messages
+    prompt_builder = await asyncio.to_thread(
+        build_session_prompt, db, user_id, session_id, user_message_with_files, FILES_SYSTEM_MESSAGE
+    )
     
-    # Combine context with current message
-    full_prompt = f"{context}User: {user_message_with_files}\nAI:"
+    # Combine context with the extracted file text and current message within the token budget
+    for file_info in processed_files:
+        prompt_builder.add_attachment(file_info["original_name"], file_info["extracted_text"])
+    prompt_result = prompt_builder.build(user_message)
 
-    payload = {
-        "model": "llama3.2",
-        "prompt": full_prompt,
-        "stream": False
-    }
-    
-    try:
-        response = requests.post(OLLAMA_URL, json=payload)
-        response.raise_for_status()
-        result = response.json()
-        ai_reply = result.get("response", "No response from model.")
-        
-        # Clean up AI response if needed to remove any artifacts from context
-        if ai_reply.startswith("AI:"):
-            ai_reply = ai_reply[3:].strip()
-            
-    except requests.exceptions.ConnectionError:
-        raise HTTPException(status_code=503, detail="AI service is currently unavailable. Please try again later.")
-    except Exception as e:
-        print(f"Error during AI request: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"Ollama error: {str(e)}")
+    ai_reply = await _generate_reply(user_id, prompt_result.prompt, prompt_result.messages)
     
     # Store the original message (without the extracted text) and attachments in JSON format
     original_message = user_message
     attachments_json = json.dumps(file_attachments) if file_attachments else None
     
-    # Save chat to the SQL database
-    chat = Chat(
-        message=original_message, 
-        response=ai_reply,
-        user_id=user_id,
-        session_id=session_id,
-        attachments=attachments_json
-    )
-    db.add(chat)
-    db.commit()
-    db.refresh(chat)
-
-    # Also add to ChromaDB for future semantic search
-    chroma_db.add_chat_entry(
-        user_id=user_id,
-        session_id=session_id,
-        message=user_message_with_files,  # Include extracted text for semantic search
-        response=ai_reply
-    )
+    # Save chat to the SQL database and ChromaDB, including the extracted text in the index for semantic search
+    chat = await _save_chat(db, user_id, session_id, original_message, ai_reply,
+                            attachments=attachments_json, index_message=user_message_with_files)
 
     return {
         "reply": ai_reply, 
@@ -1,18 +1,71 @@
 from fastapi import APIRouter
-from app.utils.ingest_rag_dataset import ingest_dataset_to_chromadb
+from app.utils.ingestion_jobs import ingestion_jobs
+from app.utils.chroma_db import chroma_db
 from fastapi.responses import JSONResponse
 from app.config.dataset_config import DATASET_PATH
 import os
 
 router = APIRouter(prefix="/dataset", tags=["Dataset Management"])
 
-@router.post("/ingest")
+@router.post("/ingest", status_code=202)
 def ingest_dataset(dataset_path: str = None):
     """
-    Ingest a CSV dataset into ChromaDB for RAG. If no path is provided, uses the default from config.
+    Start ingesting a CSV dataset into ChromaDB for RAG as a background job.
+    If no path is provided, uses the default from config. An interrupted job for
+    the same file is resumed from its last checkpoint. Poll /dataset/jobs/{job_id}.
     """
     path = dataset_path or DATASET_PATH
-    success = ingest_dataset_to_chromadb(path)
-    if success:
-        return {"message": f"Dataset at {os.path.basename(path)} ingested into ChromaDB."}
-    return JSONResponse(status_code=400, content={"message": f"Failed to ingest dataset at {path}."})
+    if not os.path.exists(path):
+        return JSONResponse(status_code=400, content={"message": f"Dataset file not found: {path}."})
+    try:
+        job = ingestion_jobs.start(path)
+    except RuntimeError as e:
+        return JSONResponse(status_code=409, content={"message": str(e)})
+    return {"message": f"Ingestion of {os.path.basename(path)} started.", **job.status_dict()}
+
+@router.get("/jobs")
+def list_ingestion_jobs():
+    """List ingestion jobs, newest first."""
+    return {"jobs": ingestion_jobs.list()}
+
+@router.get("/jobs/{job_id}")
+def get_ingestion_job(job_id: str):
+    """Return a job's status, progress, throughput and ETA."""
+    job = ingestion_jobs.get(job_id)
+    if job is None:
+        return JSONResponse(status_code=404, content={"message": "Ingestion job not found"})
+    return job.status_dict()
+
+@router.post("/jobs/{job_id}/cancel")
+def cancel_ingestion_job(job_id: str):
+    """Cancel a running job after its current batch; the live collection is left unchanged."""
+    try:
+        return ingestion_jobs.cancel(job_id).status_dict()
+    except KeyError:
+        return JSONResponse(status_code=404, content={"message": "Ingestion job not found"})
+
+@router.post("/jobs/{job_id}/resume", status_code=202)
+def resume_ingestion_job(job_id: str):
+    """Resume a failed or interrupted job from its last checkpoint."""
+    try:
+        return ingestion_jobs.resume(job_id).status_dict()
+    except KeyError:
+        return JSONResponse(status_code=404, content={"message": "Ingestion job not found"})
+    except RuntimeError as e:
+        return JSONResponse(status_code=409, content={"message": str(e)})
+
+@router.get("/version")
+def get_collection_version():
+    """
+    Return the live knowledge base collection version, the version kept for rollback
+    and the version being built, if any.
+    """
+    return chroma_db.collection_version()
+
+@router.post("/rollback")
+def rollback_collection():
+    """Make the previous knowledge base version live again."""
+    try:
+        return chroma_db.rollback()
+    except RuntimeError as e:
+        return JSONResponse(status_code=409, content={"message": str(e)})
@@ -1,18 +1,25 @@
 # filepath: d:\MECON\Project\chatbot-app\backend\app\routes\streaming.py
-from fastapi import APIRouter, Depends, HTTPException, UploadFile, File, Form, Request
+from fastapi import APIRouter, Depends, HTTPException, UploadFile, File, Form, Request, Query
 from fastapi.responses import StreamingResponse
 from sqlalchemy.orm import Session
 from ..database.db import SessionLocal
 from ..models.user import Chat, ChatSession
 from pydantic import BaseModel
-from typing import List, Optional
-import requests
+from typing import AsyncIterator, List, Optional, Tuple
 from datetime import datetime
 import json
 import asyncio
+import time
 from app.utils.auth_jwt import get_current_user
-from app.utils.chroma_db import chroma_db
+from app.utils.chat_indexer import chat_indexer
 from app.utils.file_processor import file_processor
+from app.utils.llm_client import llm_client, LLMUnavailableError
+from app.utils.prompt_builder import PromptBuilder, DEFAULT_SYSTEM_MESSAGE, FILES_SYSTEM_MESSAGE
+from app.utils.metrics import metrics
+from app.utils.session_history import touch_session, build_session_prompt
+from app.utils.generation_scheduler import generation_scheduler, SchedulerBusyError
+from app.utils.stream_buffer import StreamBuffer, stream_registry
+from app.config.streaming_config import STREAM_RESUME_GRACE
 
 router = APIRouter(prefix="/streaming", tags=["Streaming"])
 
@@ -28,159 +35,229 @@ class ChatRequest(BaseModel):
     message: str
     session_id: int
 
-OLLAMA_URL = "http://localhost:11434/api/generate"
+INTERRUPTED_MARKER = "\n\n[interrupted]"
 
-@router.post("/")
-async def stream_chat(
-    req: ChatRequest,
-    db: Session = Depends(get_db),
-    current_user: dict = Depends(get_current_user)
-):
-    user_id = current_user["user_id"]
-    
-    # Verify the session exists and belongs to the user
-    session = db.query(ChatSession).filter(
-        ChatSession.id == req.session_id,
-        ChatSession.user_id == user_id
-    ).first()
-    
-    if not session:
-        raise HTTPException(status_code=404, detail="Chat session not found")
-    
-    # Update the timestamp to show this session was recently used
-    session.updated_at = datetime.utcnow()
+def _save_response(db: Session, chat: Chat, response: str):
+    """Store the reply on the chat row (runs in a worker thread)."""
+    chat.response = response
+    db.add(chat)
     db.commit()
-    
-    try:
-        # Use ChromaDB to find relevant previous context based on semantic similarity
-        relevant_context = chroma_db.get_relevant_context(
-            user_id=user_id,
-            session_id=req.session_id,
-            query=req.message,
-            limit=5  # Get 5 most semantically relevant chat exchanges
-        )
-        
-        # Also get the most recent messages to maintain conversation flow
-        recent_messages = db.query(Chat).filter(
-            Chat.session_id == req.session_id
-        ).order_by(Chat.timestamp.desc()).limit(3).all()  # Get last 3 messages for recency bias
-        
-        # Build context combining semantic relevance with recency
-        system_message = "You are Nexora AI, a helpful and knowledgeable assistant. Maintain context of the conversation and provide accurate, concise responses. Remember previous information shared by the user.\n\n"
-        context = system_message
-        
-        # Add semantically relevant context first
-        if relevant_context:
-            context += "Relevant conversation history:\n"
-            for exchange in relevant_context:
-                context += f"{exchange}\n\n"
-        
-        # Add recent messages for conversational flow
-        if recent_messages:
-            context += "Recent conversation:\n"
-            # Reverse to get chronological order
-            for msg in reversed(recent_messages):
-                context += f"User: {msg.message}\nAI: {msg.response}\n\n"
-                
-    except Exception as e:
-        # If there's an issue with ChromaDB, fall back to the traditional method
-        print(f"ChromaDB error, falling back to traditional context retrieval: {str(e)}")
-        
-        # Traditional method - get previous messages from this session
-        previous_messages = db.query(Chat).filter(
-            Chat.session_id == req.session_id
-        ).order_by(Chat.timestamp.desc()).limit(10).all()
-        
-        system_message = "You are Nexora AI, a helpful and knowledgeable assistant. Maintain context of the conversation and provide accurate, concise responses. Remember previous information shared by the user.\n\n"
-        context = system_message
-        
-        if previous_messages:
-            # Reverse to get chronological order
-            for msg in reversed(previous_messages):
-                context += f"User: {msg.message}\nAI: {msg.response}\n\n"
-    
-    # Combine context with current message
-    full_prompt = f"{context}User: {req.message}\nAI:"
 
-    # Setting stream=True for streaming response from Ollama
-    payload = {
-        "model": "llama3.2",
-        "prompt": full_prompt,
-        "stream": True
-    }
-    
-    # Start a chat DB entry with an empty response that will be updated later
+def _create_chat(db: Session, user_id: int, session_id: int, message: str, attachments: Optional[str] = None) -> Chat:
+    """Insert a chat row with an empty response that is filled in when generation ends (runs in a worker thread)."""
     chat = Chat(
-        message=req.message, 
-        response="", 
+        message=message, 
+        response="",
         user_id=user_id,
-        session_id=req.session_id
+        session_id=session_id,
+        attachments=attachments
     )
     db.add(chat)
     db.commit()
     db.refresh(chat)
-    
-    async def generate_stream():
+    return chat
+
+async def _strip_reply_prefix(chunks: AsyncIterator[str]) -> AsyncIterator[str]:
+    """
+    Streaming counterpart of clean_reply(): drop an "AI:" echo at the start of the
+    reply before it reaches the buffer, so the stored reply is the streamed text.
+    """
+    head = ""
+    async for chunk in chunks:
+        if head is None:
+            yield chunk
+            continue
+        head += chunk
+        if head.startswith("AI:"):
+            rest = head[3:].lstrip()
+            if not rest:
+                continue
+            head = rest
+        elif "AI:".startswith(head):
+            # Too short to tell yet
+            continue
+        yield head
+        head = None
+    if head and not head.startswith("AI:"):
+        yield head
+
+async def _generate_into_buffer(buffer: StreamBuffer, chat_id: int, prompt: str, messages: List[dict],
+                                index_message: str, slot_acquired_at: Optional[float]):
+    """
+    Read the reply from Ollama into the stream buffer and store it on the chat row.
+    Runs independently of the client connection so a dropped client can resume.
+    If nobody has been reading for STREAM_RESUME_GRACE seconds, the upstream
+    generation is cancelled and the partial reply is saved with an interrupted marker.
+    The generation slot acquired by the endpoint, if any, is released when this finishes.
+    """
+    try:
+        await _stream_reply(buffer, chat_id, prompt, messages, index_message)
+    except Exception as e:
+        # Loading or saving the chat row failed; the readers still get to the end of the buffer
+        print(f"Error during AI request: {str(e)}")
+    finally:
+        # Readers wait until the buffer is finished, so this runs whatever happened above
+        await buffer.finish()
+        if slot_acquired_at is not None:
+            generation_scheduler.release(held_since=slot_acquired_at)
+
+async def _stream_reply(buffer: StreamBuffer, chat_id: int, prompt: str, messages: List[dict], index_message: str):
+    db = SessionLocal()
+    try:
+        chat = await asyncio.to_thread(lambda: db.query(Chat).filter(Chat.id == chat_id).first())
+        if chat is None:
+            raise ValueError(f"Chat {chat_id} no longer exists")
         full_response = ""
+        started = time.monotonic()
+        upstream = llm_client.stream(prompt, messages=messages)
+        replies = _strip_reply_prefix(upstream)
+        completed = False
         
         try:
-            with requests.post(OLLAMA_URL, json=payload, stream=True) as response:
-                response.raise_for_status()
-                
-                # Process the streaming response from Ollama
-                for line in response.iter_lines():
-                    if line:
-                        try:
-                            data = json.loads(line.decode('utf-8'))
-                            if "response" in data:
-                                chunk = data["response"]
-                                full_response += chunk
-                                # Stream each chunk back to the client
-                                yield chunk
-                        except json.JSONDecodeError:
-                            print(f"Error decoding JSON: {line}")
-                            continue
-                
-                # Clean up AI response if needed to remove any artifacts from context
-                if full_response.startswith("AI:"):
-                    full_response = full_response[3:].strip()
-                
-                # Update the chat entry with the full response
-                chat.response = full_response
-                db.add(chat)
-                db.commit()
+            # Process the streaming response from Ollama without blocking the event loop.
+            # The stored reply is exactly the buffered text, so a resume from the stored
+            # reply (after the buffer is evicted) continues at the same offset.
+            async for chunk in replies:
+                full_response += chunk
+                await buffer.append(chunk)
+                # Stop generating once every client has been gone for the grace period
+                if buffer.abandoned_for() > STREAM_RESUME_GRACE:
+                    break
+            else:
+                completed = True
+            
+            if completed:
+                metrics.observe("streaming_generation_seconds", time.monotonic() - started)
+                await asyncio.to_thread(_save_response, db, chat, full_response)
                 
-                # Add to ChromaDB for future semantic search
-                chroma_db.add_chat_entry(
-                    user_id=user_id,
-                    session_id=req.session_id,
-                    message=req.message,
-                    response=full_response
+                # Queue for ChromaDB indexing (embedded in the background) for future semantic search
+                chat_indexer.enqueue(
+                    user_id=chat.user_id,
+                    session_id=chat.session_id,
+                    message=index_message,
+                    response=full_response,
+                    chat_id=chat.id
                 )
                 
-        except requests.exceptions.ConnectionError:
+        except LLMUnavailableError:
+            completed = True
             error_msg = "AI service is currently unavailable. Please try again later."
-            yield error_msg
-            chat.response = error_msg
-            db.add(chat)
-            db.commit()
+            await buffer.append(error_msg)
+            await asyncio.to_thread(_save_response, db, chat, full_response + error_msg)
             
         except Exception as e:
+            completed = True
             print(f"Error during AI request: {str(e)}")
             error_msg = f"Error: {str(e)}"
-            yield error_msg
-            chat.response = error_msg
-            db.add(chat)
-            db.commit()
+            await buffer.append(error_msg)
+            await asyncio.to_thread(_save_response, db, chat, full_response + error_msg)
+            
+        finally:
+            # Closing the upstream generator closes the HTTP response, which makes Ollama stop generating
+            await replies.aclose()
+            await upstream.aclose()
+            if not completed:
+                # Estimate the saved inference time from the average full generation time
+                elapsed = time.monotonic() - started
+                saved = max(metrics.average("streaming_generation_seconds") - elapsed, 0.0)
+                metrics.increment("streaming_interrupted_total")
+                metrics.increment("streaming_inference_seconds_saved", saved)
+                await buffer.append(INTERRUPTED_MARKER)
+                await asyncio.to_thread(_save_response, db, chat, full_response + INTERRUPTED_MARKER)
+    finally:
+        db.close()
+
+async def acquire_generation_slot(user_id: int, prompt: str, messages: List[dict]) -> Optional[float]:
+    """
+    Wait for the scheduler to admit a generation; fails fast with 429 when it is saturated.
+    Replies that are cached or already being generated for an identical request need
+    no slot, so None is returned for them, also when that became true while waiting.
+    """
+    if not llm_client.needs_generation(prompt, messages=messages):
+        return None
+    try:
+        await generation_scheduler.acquire(user_id)
+    except SchedulerBusyError as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+    if not llm_client.needs_generation(prompt, messages=messages):
+        generation_scheduler.release()
+        return None
+    return time.monotonic()
+
+def start_generation(chat: Chat, prompt: str, messages: List[dict], index_message: str,
+                     slot_acquired_at: Optional[float]) -> StreamBuffer:
+    """Create the resumable buffer for a chat row and start generating into it."""
+    buffer = stream_registry.create(chat.id, chat.user_id)
+    stream_registry.start(chat.id, _generate_into_buffer(buffer, chat.id, prompt, messages, index_message, slot_acquired_at))
+    return buffer
+
+async def admit_and_start(db: Session, user_id: int, session_id: int, message: str, prompt: str,
+                          messages: List[dict], index_message: str,
+                          attachments: Optional[str] = None) -> Tuple[Chat, StreamBuffer]:
+    """
+    Wait for a generation slot, create the chat row and start generating into its buffer.
+    The generation releases the slot when it ends; if anything fails before it has
+    started (e.g. the insert, or the client disconnecting), the slot is released here.
+    """
+    slot_acquired_at = await acquire_generation_slot(user_id, prompt, messages)
+    try:
+        chat = await asyncio.to_thread(_create_chat, db, user_id, session_id, message, attachments)
+        buffer = start_generation(chat, prompt, messages, index_message=index_message, slot_acquired_at=slot_acquired_at)
+    except (Exception, asyncio.CancelledError):
+        if slot_acquired_at is not None:
+            generation_scheduler.release()
+        raise
+    return chat, buffer
+
+async def relay_buffer(request: Request, buffer: StreamBuffer, offset: int = 0):
+    """Send buffered chunks to one client, stopping as soon as it disconnects."""
+    reader = buffer.read(offset)
+    try:
+        async for chunk in reader:
+            if await request.is_disconnected():
+                break
+            yield chunk
+    finally:
+        await reader.aclose()
+
+@router.post("/")
+async def stream_chat(
+    req: ChatRequest,
+    request: Request,
+    db: Session = Depends(get_db),
+    current_user: dict = Depends(get_current_user)
+):
+    user_id = current_user["user_id"]
     
-    # Return StreamingResponse to client
+    # Verify the session exists and belongs to the user, and update its timestamp
+    # to show it was recently used; database and embedding work runs off the event loop
+    if not await asyncio.to_thread(touch_session, user_id, req.session_id):
+        raise HTTPException(status_code=404, detail="Chat session not found")
+    
+    # Combine semantically relevant context with the most recent messages
+    prompt_builder = await asyncio.to_thread(
+        build_session_prompt, db, user_id, req.session_id, req.message, DEFAULT_SYSTEM_MESSAGE
+    )
+    
+    # Combine context with current message within the token budget
+    prompt_result = prompt_builder.build(req.message)
+
+    # Wait for a generation slot, then start a chat DB entry with an empty response that will be updated later
+    chat, buffer = await admit_and_start(
+        db, user_id, req.session_id, req.message, prompt_result.prompt, prompt_result.messages,
+        index_message=req.message
+    )
+    
+    # Return StreamingResponse to client; the chat id lets it resume after a dropped connection
     return StreamingResponse(
-        generate_stream(),
-        media_type="text/event-stream"
+        relay_buffer(request, buffer),
+        media_type="text/event-stream",
+        headers={"X-Chat-Id": str(chat.id)}
     )
 
 @router.post("/with-files")
 async def stream_chat_with_files(
+    request: Request,
     files: List[UploadFile] = File(...),
     message: Optional[str] = Form(None),
     session_id: int = Form(...),
@@ -189,25 +266,16 @@ async def stream_chat_with_files(
 ):
     user_id = current_user["user_id"]
     
-    # Verify the session exists and belongs to the user
-    session = db.query(ChatSession).filter(
-        ChatSession.id == session_id,
-        ChatSession.user_id == user_id
-    ).first()
-    
-    if not session:
+    # Verify the session exists and belongs to the user, and update its timestamp
+    if not await asyncio.to_thread(touch_session, user_id, session_id):
         raise HTTPException(status_code=404, detail="Chat session not found")
     
-    # Update the timestamp to show this session was recently used
-    session.updated_at = datetime.utcnow()
-    db.commit()
-    
     processed_files = []
     extracted_text_combined = ""
     
-    # Process each uploaded file but keep them for future reference
+    # Process each uploaded file but keep them for future reference (OCR and PDF parsing block)
     for file in files:
-        file_info = file_processor.process_file(file, user_id, delete_after_processing=False)
+        file_info = await asyncio.to_thread(file_processor.process_file, file, user_id, delete_after_processing=False)
         processed_files.append(file_info)
         if file_info["extracted_text"]:
             extracted_text_combined += f"\n\nText from {file_info['original_name']}:\n{file_info['extracted_text']}"
@@ -230,137 +298,73 @@ async def stream_chat_with_files(
             "extracted_text": file["extracted_text"]
         })
     
-    try:
-        # Use ChromaDB to find relevant previous context based on semantic similarity
-        relevant_context = chroma_db.get_relevant_context(
-            user_id=user_id,
-            session_id=session_id,
-            query=user_message_with_files,
-            limit=5  # Get 5 most semantically relevant chat exchanges
-        )
-        
-        # Also get the most recent messages to maintain conversation flow
-        recent_messages = db.query(Chat).filter(
-            Chat.session_id == session_id
-        ).order_by(Chat.timestamp.desc()).limit(3).all()  # Get last 3 messages for recency bias
-        
-        # Build context combining semantic relevance with recency
-        system_message = "You are Nexora AI, a helpful and knowledgeable assistant. The user is sending you messages with attached files which have been converted to text. Please analyze both the message and the extracted text to provide an appropriate response. Be concise and helpful, focusing on what the files actually contain.\n\n"
-        context = system_message
-        
-        # Add semantically relevant context first
-        if relevant_context:
-            context += "Relevant conversation history:\n"
-            for exchange in relevant_context:
-                context += f"{exchange}\n\n"
-        
-        # Add recent messages for conversational flow
-        if recent_messages:
-            context += "Recent conversation:\n"
-            # Reverse to get chronological order
-            for msg in reversed(recent_messages):
-                context += f"User: {msg.message}\nAI: {msg.response}\n\n"
-    except Exception as e:
-        # If there's an issue with ChromaDB, fall back to the traditional method
-        print(f"ChromaDB error, falling back to traditional context retrieval: {str(e)}")
-        
-        # Traditional method - get previous messages from this session
-        previous_messages = db.query(Chat).filter(
-            Chat.session_id == session_id
-        ).order_by(Chat.timestamp.desc()).limit(10).all()
-        
-        system_message = "You are Nexora AI, a helpful and knowledgeable assistant. The user is sending you messages with attached files which have been converted to text. Please analyze both the message and the extracted text to provide an appropriate response. Be concise and helpful, focusing on what the files actually contain.\n\n"
-        context = system_message
-        
-        if previous_messages:
-            # Reverse to get chronological order
-            for msg in reversed(previous_messages):
-                context += f"User: {msg.message}\nAI: {msg.response}\n\n"
+    # Combine semantically relevant context with the most recent messages
+    prompt_builder = await asyncio.to_thread(
+        build_session_prompt, db, user_id, session_id, user_message_with_files, FILES_SYSTEM_MESSAGE
+    )
     
-    # Combine context with current message
-    full_prompt = f"{context}User: {user_message_with_files}\nAI:"
+    # Combine context with the extracted file text and current message within the token budget
+    for file_info in processed_files:
+        prompt_builder.add_attachment(file_info["original_name"], file_info["extracted_text"])
+    prompt_result = prompt_builder.build(user_message)
 
-    # Setting stream=True for streaming response from Ollama
-    payload = {
-        "model": "llama3.2",
-        "prompt": full_prompt,
-        "stream": True
-    }
-    
     # Store the original message (without the extracted text) and attachments in JSON format
     original_message = user_message
     attachments_json = json.dumps(file_attachments) if file_attachments else None
     
-    # Save chat to the SQL database with an empty response that will be updated later
-    chat = Chat(
-        message=original_message, 
-        response="",
-        user_id=user_id,
-        session_id=session_id,
-        attachments=attachments_json
+    # Wait for a generation slot, then save chat to the SQL database with an empty response
+    # that will be updated later; the ChromaDB entry includes the extracted text for semantic search
+    chat, buffer = await admit_and_start(
+        db, user_id, session_id, original_message, prompt_result.prompt, prompt_result.messages,
+        index_message=user_message_with_files, attachments=attachments_json
     )
-    db.add(chat)
-    db.commit()
-    db.refresh(chat)
     
     async def generate_stream_with_files():
-        full_response = ""
-        attachment_info = json.dumps({"attachments": file_attachments}) + "\n"
         # First yield the attachment info as a special message
-        yield attachment_info
+        yield json.dumps({"attachments": file_attachments}) + "\n"
         
+        stream = relay_buffer(request, buffer)
         try:
-            with requests.post(OLLAMA_URL, json=payload, stream=True) as response:
-                response.raise_for_status()
-                
-                # Process the streaming response from Ollama
-                for line in response.iter_lines():
-                    if line:
-                        try:
-                            data = json.loads(line.decode('utf-8'))
-                            if "response" in data:
-                                chunk = data["response"]
-                                full_response += chunk
-                                # Stream each chunk back to the client
-                                yield chunk
-                        except json.JSONDecodeError:
-                            print(f"Error decoding JSON: {line}")
-                            continue
-                
-                # Clean up AI response if needed to remove any artifacts from context
-                if full_response.startswith("AI:"):
-                    full_response = full_response[3:].strip()
-                
-                # Update the chat entry with the full response
-                chat.response = full_response
-                db.add(chat)
-                db.commit()
-                
-                # Add to ChromaDB for future semantic search
-                chroma_db.add_chat_entry(
-                    user_id=user_id,
-                    session_id=session_id,
-                    message=user_message_with_files,  # Include extracted text for semantic search
-                    response=full_response
-                )
-                
-        except requests.exceptions.ConnectionError:
-            error_msg = "AI service is currently unavailable. Please try again later."
-            yield error_msg
-            chat.response = error_msg
-            db.add(chat)
-            db.commit()
-            
-        except Exception as e:
-            print(f"Error during AI request: {str(e)}")
-            error_msg = f"Error: {str(e)}"
-            yield error_msg
-            chat.response = error_msg
-            db.add(chat)
-            db.commit()
+            async for chunk in stream:
+                yield chunk
+        finally:
+            await stream.aclose()
     
     # Return StreamingResponse to client
     return StreamingResponse(
         generate_stream_with_files(),
+        media_type="text/event-stream",
+        headers={"X-Chat-Id": str(chat.id)}
+    )
+
+@router.get("/{chat_id}/resume")
+async def resume_stream(
+    chat_id: int,
+    request: Request,
+    offset: int = Query(0, ge=0, description="Number of reply characters the client already received"),
+    db: Session = Depends(get_db),
+    current_user: dict = Depends(get_current_user)
+):
+    """Replay a streamed reply from the given offset, then tail it if it is still being generated."""
+    user_id = current_user["user_id"]
+    buffer = stream_registry.get(chat_id)
+    
+    if buffer is None or buffer.user_id != user_id:
+        # The buffer has been evicted, so serve the stored reply if it exists; it is the
+        # exact text the buffer streamed, so the offset carries over
+        chat = await asyncio.to_thread(
+            lambda: db.query(Chat).filter(Chat.id == chat_id, Chat.user_id == user_id).first()
+        )
+        if not chat:
+            raise HTTPException(status_code=404, detail="Chat message not found")
+        if not chat.response:
+            raise HTTPException(status_code=410, detail="This reply is no longer being generated")
+        return StreamingResponse(iter([chat.response[offset:]]), media_type="text/event-stream")
+    
+    if offset < buffer.base_offset:
+        raise HTTPException(status_code=410, detail="Requested offset is no longer buffered")
+    
+    return StreamingResponse(
+        relay_buffer(request, buffer, offset),
         media_type="text/event-stream"
-    )
\ No newline at end of file
+    )
@@ -0,0 +1,111 @@
+"""
+Benchmark the embedding engines on the RAG dataset: ChromaDB's default function,
+ONNX Runtime fp32 and ONNX Runtime int8. Reports batch throughput, single-text
+latency, concurrent throughput with dynamic batching, and agreement with the
+default vectors (cosine similarity and nearest-neighbour recall@k).
+
+    python -m app.utils.benchmark_embeddings --texts 2000 --threads 4
+"""
+import argparse
+import json
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+import numpy as np
+import pandas as pd
+from app.config.dataset_config import DATASET_PATH
+from app.config.embedding_config import EMBEDDING_THREADS, EMBEDDING_BATCH_WINDOW_MS
+from app.utils.embedding_engine import EmbeddingEngine
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+
+def _load_texts(path: str, count: int) -> List[str]:
+    df = pd.read_csv(path)
+    texts = (df["issue/query"].astype(str) + "\n" + df["response"].astype(str)).tolist()
+    return (texts * (count // max(len(texts), 1) + 1))[:count]
+
+
+def _neighbour_recall(vectors: np.ndarray, reference: np.ndarray, queries: np.ndarray,
+                      reference_queries: np.ndarray, k: int) -> float:
+    """Share of the default engine's top-k documents that the engine also ranks in its top-k."""
+    k = min(k, len(vectors))
+    found = np.argsort(-(queries @ vectors.T), axis=1)[:, :k]
+    expected = np.argsort(-(reference_queries @ reference.T), axis=1)[:, :k]
+    return float(np.mean([len(set(f) & set(e)) / k for f, e in zip(found, expected)]))
+
+
+def _concurrent_qps(engine: EmbeddingEngine, queries: List[str], clients: int) -> float:
+    """Single-text calls from several threads at once, as concurrent chat requests make them."""
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+        list(pool.map(lambda text: engine([text]), queries))
+    return round(len(queries) / max(time.perf_counter() - started, 1e-9), 1)
+
+
+def run_benchmark(num_texts: int = 2000, threads: int = EMBEDDING_THREADS, clients: int = 16,
+                  k: int = 10) -> Dict[str, Dict[str, float]]:
+    texts = _load_texts(DATASET_PATH, num_texts)
+    queries = pd.read_csv(DATASET_PATH)["issue/query"].astype(str).drop_duplicates().tolist()
+    # Quality is compared on distinct documents, so duplicate rows do not create ranking ties
+    documents = list(dict.fromkeys(texts))
+
+    report = {}
+    reference = reference_queries = None
+    for name, options in [
+        ("default", {"engine": "default"}),
+        ("onnx_fp32", {"engine": "onnx", "precision": "fp32"}),
+        ("onnx_int8", {"engine": "onnx", "precision": "int8"}),
+    ]:
+        # Measured without the batching window first; it is switched on for the batched concurrency run
+        engine = EmbeddingEngine(threads=threads, batch_window_ms=0, **options)
+        started = time.perf_counter()
+        engine.warm_up()
+        load_seconds = time.perf_counter() - started
+
+        started = time.perf_counter()
+        engine(texts)
+        batch_seconds = time.perf_counter() - started
+
+        latencies = []
+        for query in queries:
+            started = time.perf_counter()
+            engine([query])
+            latencies.append((time.perf_counter() - started) * 1000)
+        query_vectors = engine(queries)
+        document_vectors = engine(documents)
+
+        concurrent_queries = (queries * (400 // len(queries) + 1))[:400]
+        unbatched_qps = _concurrent_qps(engine, concurrent_queries, clients)
+        engine.batch_window = max(EMBEDDING_BATCH_WINDOW_MS, 1.0) / 1000
+        batched_qps = _concurrent_qps(engine, concurrent_queries, clients)
+
+        if reference is None:
+            reference, reference_queries = document_vectors, query_vectors
+        report[name] = {
+            "model": engine.name,
+            "load_seconds": round(load_seconds, 2),
+            "batch_texts_per_second": round(len(texts) / max(batch_seconds, 1e-9), 1),
+            "single_p50_ms": round(float(np.percentile(latencies, 50)), 2),
+            "concurrent_qps_unbatched": unbatched_qps,
+            "concurrent_qps_batched": batched_qps,
+            "mean_cosine_to_default": round(float(np.mean(np.sum(document_vectors * reference, axis=1))), 5),
+            "min_cosine_to_default": round(float(np.min(np.sum(document_vectors * reference, axis=1))), 5),
+            f"recall@{k}_vs_default": round(
+                _neighbour_recall(document_vectors, reference, query_vectors, reference_queries, k), 4
+            ),
+        }
+        logger.info(f"{name}: {report[name]}")
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare embedding engines for throughput and quality")
+    parser.add_argument("--texts", type=int, default=2000, help="Number of dataset texts to embed")
+    parser.add_argument("--threads", type=int, default=EMBEDDING_THREADS, help="ONNX Runtime intra-op threads")
+    parser.add_argument("--clients", type=int, default=16, help="Concurrent callers for the batching test")
+    parser.add_argument("--k", type=int, default=10, help="Neighbours compared for recall")
+    args = parser.parse_args()
+    print(json.dumps(run_benchmark(args.texts, args.threads, args.clients, args.k), indent=2))
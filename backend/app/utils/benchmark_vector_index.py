@@ -0,0 +1,84 @@
+"""
+Benchmark the numpy vector backend against Chroma on the live knowledge collection.
+Reports per-query latency, batched throughput and recall@k against exact float32 search.
+
+    python -m app.utils.benchmark_vector_index --queries 200 --k 5
+"""
+import argparse
+import json
+import logging
+import os
+import tempfile
+import time
+from typing import Callable, Dict, List
+import numpy as np
+from app.utils.chroma_db import chroma_db, split_chat_document
+from app.utils.vector_index import NumpyVectorIndex
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+
+def _latency(search: Callable[[np.ndarray], List[List[str]]], queries: np.ndarray) -> Dict[str, float]:
+    """Time one query at a time; returns p50/p95 in milliseconds."""
+    samples = []
+    for query in queries:
+        started = time.perf_counter()
+        search(query[None, :])
+        samples.append((time.perf_counter() - started) * 1000)
+    return {"p50_ms": round(float(np.percentile(samples, 50)), 3), "p95_ms": round(float(np.percentile(samples, 95)), 3)}
+
+
+def _throughput(search: Callable[[np.ndarray], List[List[str]]], queries: np.ndarray) -> float:
+    """Queries per second when the whole set is sent as one batch."""
+    started = time.perf_counter()
+    search(queries)
+    return round(len(queries) / max(time.perf_counter() - started, 1e-9), 1)
+
+
+def _recall(results: List[List[str]], truth: List[List[str]]) -> float:
+    hits = sum(len(set(r) & set(t)) for r, t in zip(results, truth))
+    return round(hits / max(sum(len(t) for t in truth), 1), 4)
+
+
+def run_benchmark(num_queries: int = 200, k: int = 5) -> Dict[str, Dict[str, float]]:
+    collection = chroma_db.knowledge_collection
+    # The memory-mapped files may still be open on Windows when the directory is removed
+    with tempfile.TemporaryDirectory(ignore_cleanup_errors=True) as directory:
+        # Exact float32 search is the ground truth; float16 shows the cost of halving the memory
+        ids, documents, embeddings, _ = chroma_db.export_vectors(collection)
+        if not ids:
+            raise RuntimeError("The knowledge collection is empty; ingest a dataset first")
+        exact = NumpyVectorIndex.build(os.path.join(directory, "float32"), ids, documents, embeddings)
+        half = NumpyVectorIndex.build(os.path.join(directory, "float16"), ids, documents, embeddings, dtype="float16")
+
+        # Query with the issue texts of a sample of documents, as users ask them
+        rng = np.random.default_rng(0)
+        picks = rng.choice(len(exact), size=num_queries, replace=num_queries > len(exact))
+        texts = [split_chat_document(exact.documents[i])[0] for i in picks]
+        queries = np.asarray(chroma_db.embedder(texts), dtype=np.float32)
+
+        def numpy_search(index: NumpyVectorIndex):
+            return lambda batch: [[r["id"] for r in results] for results in index.query(batch, k)]
+
+        def chroma_search(batch: np.ndarray):
+            return collection.query(query_embeddings=batch.tolist(), n_results=k, include=[])["ids"]
+
+        truth = numpy_search(exact)(queries)
+        report = {}
+        for name, search in [("chroma", chroma_search), ("numpy_float32", numpy_search(exact)), ("numpy_float16", numpy_search(half))]:
+            report[name] = {
+                **_latency(search, queries),
+                "batch_qps": _throughput(search, queries),
+                f"recall@{k}": _recall(search(queries), truth),
+            }
+        logger.info(f"Benchmarked {num_queries} queries against {len(exact)} documents of '{collection.name}'")
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the numpy and Chroma knowledge vector backends")
+    parser.add_argument("--queries", type=int, default=200, help="Number of queries to run")
+    parser.add_argument("--k", type=int, default=5, help="Results per query")
+    args = parser.parse_args()
+    print(json.dumps(run_benchmark(args.queries, args.k), indent=2))
@@ -0,0 +1,52 @@
+"""Nearest-centroid routing of queries to the categories (partitions) of the knowledge base."""
+import json
+import os
+from typing import Dict, List, Sequence
+import numpy as np
+
+
+class CategoryRouter:
+    def __init__(self, categories: Sequence[str], centroids, counts: Sequence[int]):
+        """centroids holds one L2-normalized mean embedding per category."""
+        self.categories = list(categories)
+        self.centroids = np.asarray(centroids, dtype=np.float32).reshape(len(self.categories), -1)
+        self.counts = [int(c) for c in counts]
+
+    @classmethod
+    def build(cls, categories: Sequence[str], embeddings) -> "CategoryRouter":
+        """Compute the centroid of each category from the documents' embeddings."""
+        vectors = np.atleast_2d(np.asarray(embeddings, dtype=np.float32))
+        vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        labels = np.asarray([c or "" for c in categories])
+        names = [str(name) for name in dict.fromkeys(labels.tolist())]
+        centroids = []
+        counts = []
+        for name in names:
+            mean = vectors[labels == name].mean(axis=0)
+            centroids.append(mean / max(float(np.linalg.norm(mean)), 1e-12))
+            counts.append(int((labels == name).sum()))
+        return cls(names, centroids, counts)
+
+    def __len__(self) -> int:
+        return len(self.categories)
+
+    def route(self, query_embedding, top_n: int) -> List[str]:
+        """The top_n categories whose centroids are closest to the query, most likely first."""
+        query = np.asarray(query_embedding, dtype=np.float32).ravel()
+        scores = self.centroids @ (query / max(float(np.linalg.norm(query)), 1e-12))
+        return [self.categories[i] for i in np.argsort(-scores, kind="stable")[:top_n]]
+
+    def sizes(self) -> Dict[str, int]:
+        return dict(zip(self.categories, self.counts))
+
+    def save(self, path: str):
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"categories": self.categories, "centroids": self.centroids.tolist(), "counts": self.counts}, f)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> "CategoryRouter":
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        return cls(data["categories"], data["centroids"], data["counts"])
@@ -0,0 +1,124 @@
+"""Write-behind indexing of chat exchanges into ChromaDB, batched off the response path."""
+import asyncio
+import logging
+import time
+from typing import Dict, List, Optional
+from app.config.indexing_config import (
+    CHAT_INDEX_MAX_QUEUE,
+    CHAT_INDEX_BATCH_SIZE,
+    CHAT_INDEX_FLUSH_INTERVAL,
+)
+from app.utils.chroma_db import chroma_db
+from app.utils.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Put on the queue by stop() so the worker flushes and exits
+_STOP = object()
+
+
+class ChatIndexer:
+    def __init__(self, max_queue: int = CHAT_INDEX_MAX_QUEUE, batch_size: int = CHAT_INDEX_BATCH_SIZE,
+                 flush_interval: float = CHAT_INDEX_FLUSH_INTERVAL):
+        """
+        Queue exchanges for indexing and write them with one collection.add per batch.
+        A batch is written when it reaches batch_size or after flush_interval seconds,
+        whichever comes first, so the embedding model runs once per batch.
+        """
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+
+    def start(self):
+        """Start the background worker (called on application startup)."""
+        if self._worker is None or self._worker.done():
+            self._queue = asyncio.Queue(maxsize=self.max_queue)
+            self._worker = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Flush everything still queued and stop the worker (called on application shutdown)."""
+        if self._worker is None:
+            return
+        await self._queue.put(_STOP)
+        await self._worker
+        self._worker = None
+
+    def enqueue(self, user_id: int, session_id: int, message: str, response: str, chat_id: Optional[int] = None):
+        """Schedule an exchange for indexing without waiting for it to be embedded."""
+        if not message or not response:
+            logger.warning(f"Empty message or response for user_id={user_id}, session_id={session_id}")
+            return
+
+        entry = {
+            "chat_id": chat_id,
+            "user_id": user_id,
+            "session_id": session_id,
+            "message": message,
+            "response": response,
+            "enqueued_at": time.monotonic(),
+        }
+        if self._worker is None or self._worker.done():
+            # No worker (e.g. scripts) - index inline as before
+            self._index_now(entry)
+            return
+        try:
+            self._queue.put_nowait(entry)
+        except asyncio.QueueFull:
+            # Drop the entry rather than embed it on the event loop; the row is in SQL,
+            # so the next incremental sync (/init-chroma-db?incremental=true) indexes it
+            metrics.increment("chat_index_queue_full_total")
+            logger.debug(f"Chat index queue full, dropped chat_id={chat_id} until the next incremental sync")
+            return
+        metrics.set_gauge("chat_index_queue_depth", self._queue.qsize())
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            first = await self._queue.get()
+            if first is _STOP:
+                break
+            batch = [first]
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    entry = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if entry is _STOP:
+                    stopping = True
+                    break
+                batch.append(entry)
+            metrics.set_gauge("chat_index_queue_depth", self._queue.qsize())
+            try:
+                await asyncio.to_thread(self._index, batch)
+            except Exception as e:
+                # The rows stay in SQL; the next incremental sync (/init-chroma-db?incremental=true) indexes them
+                metrics.increment("chat_index_failed_batches_total")
+                logger.error(f"Chat indexing batch of {len(batch)} entries failed: {str(e)}")
+
+    def _index_now(self, entry: Dict):
+        """Index one exchange inline (no worker running); a failure is logged, the incremental sync picks the row up later."""
+        try:
+            self._index([entry])
+        except Exception as e:
+            logger.error(f"Failed to index chat entry: {str(e)}")
+
+    def _index(self, batch: List[Dict]):
+        """Embed and store a batch with a single collection.add."""
+        chroma_db.batch_add_chats(batch)
+        now = time.monotonic()
+        metrics.increment("chat_index_batches_total")
+        metrics.increment("chat_index_entries_total", len(batch))
+        metrics.observe("chat_index_batch_size", len(batch))
+        for entry in batch:
+            metrics.observe("chat_index_lag_seconds", now - entry["enqueued_at"])
+
+
+# Create a singleton instance
+chat_indexer = ChatIndexer()
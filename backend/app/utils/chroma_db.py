@@ -5,32 +5,115 @@ import os
 import shutil
 import logging
 import time
-from typing import List, Dict, Any, Optional
+import glob
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from typing import List, Dict, Any, Optional, Set, Tuple
 import uuid
+import zlib
+import numpy as np
+from app.config.retrieval_config import (
+    QUERY_EMBEDDING_CACHE_SIZE, KNOWLEDGE_VECTOR_BACKEND, NUMPY_INDEX_DTYPE,
+    KNOWLEDGE_ROUTING_ENABLED, KNOWLEDGE_ROUTE_CATEGORIES, KNOWLEDGE_ROUTING_MIN_DOCUMENTS
+)
+from app.config.indexing_config import CHAT_MEMORY_SHARDS
+from app.config.llm_config import SEMANTIC_CACHE_TTL, SEMANTIC_CACHE_MAX_ENTRIES
+from app.utils.metrics import metrics
+from app.utils.embedding_cache import embedding_cache
+from app.utils.embedding_engine import embedding_engine
+from app.utils.vector_index import NumpyVectorIndex
+from app.utils.category_router import CategoryRouter
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+def chat_document_id(chat_id: int) -> str:
+    """Deterministic ChromaDB id for a row of the chats table, so re-indexing upserts instead of duplicating."""
+    return f"chat_{chat_id}"
+
+def _is_stale_chat(chat_id: Optional[int], chat_ids: Set[int], max_chat_id: int) -> bool:
+    """Whether a chat memory entry has no chats row among the ids a full rebuild scanned."""
+    if chat_id is None:
+        return True
+    return chat_id <= max_chat_id and chat_id not in chat_ids
+
+def chat_document(message: str, response: str) -> str:
+    """Text stored and embedded for one exchange."""
+    return f"User: {message}\nAI: {response}"
+
+def split_chat_document(document: str) -> Tuple[str, str]:
+    """Inverse of chat_document(): the (message, response) of a stored exchange."""
+    message, _, response = document.partition("\nAI: ")
+    return message[len("User: "):] if message.startswith("User: ") else message, response
+
+# RAG knowledge base; version N > 0 of it lives in "rag_knowledge_v{N}"
+KNOWLEDGE_COLLECTION = "rag_knowledge"
+# Per-user chat memory is spread over hash-bucketed collections "chat_memory_{bucket}"
+CHAT_SHARD_PREFIX = "chat_memory"
+# Single collection (plus "chat_history_v{N}" versions) that held both before they were separated
+LEGACY_COLLECTION = "chat_history"
+RAG_USER_ID = "rag"
+
+def collection_name(version: int) -> str:
+    """Collection name of a knowledge base version."""
+    return KNOWLEDGE_COLLECTION if version == 0 else f"{KNOWLEDGE_COLLECTION}_v{version}"
+
+def chat_shard_name(bucket: int) -> str:
+    return f"{CHAT_SHARD_PREFIX}_{bucket:03d}"
+
 class ChromaDBUtil:
     def __init__(self, persist_directory: str = "./chroma_db"):
         """Initialize ChromaDB with the specified persistence directory."""
         self.persist_directory = persist_directory
+        self.sync_state_path = os.path.join(persist_directory, "chat_sync_state.json")
+        self.versions_path = os.path.join(persist_directory, "knowledge_versions.json")
+        self.layout_path = os.path.join(persist_directory, "layout.json")
         os.makedirs(persist_directory, exist_ok=True)
         
+        # Chat memory shards, opened on first use
+        self.chat_shards = CHAT_MEMORY_SHARDS
+        self._chat_collections: Dict[int, Any] = {}
+        self._chat_collections_lock = threading.Lock()
+        
+        # Blue/green rebuilds: the collection being built, if any, and the lock guarding the swap
+        self._staging = None
+        self._staging_version: Optional[int] = None
+        self._build_lock = threading.Lock()
+        
+        # Optional exact numpy search and the category router of the knowledge base,
+        # loaded for the live version on first use
+        self.knowledge_backend = KNOWLEDGE_VECTOR_BACKEND
+        self._vector_index: Optional[NumpyVectorIndex] = None
+        self._vector_index_name: Optional[str] = None
+        self._category_router: Optional[CategoryRouter] = None
+        self._category_router_name: Optional[str] = None
+        self._knowledge_index_lock = threading.Lock()
+        
         # Use the default embedding function (all-MiniLM-L6-v2)
         self.embedding_function = embedding_functions.DefaultEmbeddingFunction()
+        # Vectors are always passed to Chroma explicitly; they come from the configurable engine
+        self.embedder = embedding_engine
+        
+        # Whether the stored vectors come from the embedding model that is loaded now,
+        # checked on first use: chat memory against layout.json, the knowledge base per version
+        self._chat_vectors_ok: Optional[bool] = None
+        self._knowledge_vectors_ok: Tuple[Optional[str], bool] = (None, True)
+        
+        # LRU of recent query embeddings, keyed by a hash of the query text
+        self._query_embeddings: "OrderedDict[str, List[float]]" = OrderedDict()
+        self._query_embeddings_lock = threading.Lock()
         
         try:
             # Try to initialize the client
             self.client = chromadb.PersistentClient(path=persist_directory)
             
-            # Create collections for chat context and responses
-            self.chat_collection = self.client.get_or_create_collection(
-                name="chat_history",
-                embedding_function=self.embedding_function,
-                metadata={"hnsw:space": "cosine"}
-            )
+            # Open the live version of the knowledge base; chat shards are opened on demand
+            self._load_layout()
+            self.knowledge_collection = self._get_collection(self.get_versions()["live"])
+            self._init_answer_cache_collection()
             logger.info("ChromaDB initialized successfully")
         except Exception as e:
             logger.error(f"Error initializing ChromaDB: {str(e)}")
@@ -70,76 +153,603 @@ class ChromaDBUtil:
             # Initialize a new client
             self.client = chromadb.PersistentClient(path=self.persist_directory)
             
-            # Create a fresh collection
-            self.chat_collection = self.client.get_or_create_collection(
-                name="chat_history",
-                embedding_function=self.embedding_function,
-                metadata={"hnsw:space": "cosine"}
-            )
+            # Create a fresh knowledge collection (the version pointer was removed with the directory)
+            with self._chat_collections_lock:
+                self._chat_collections = {}
+            self._chat_vectors_ok = None
+            self._load_layout()
+            self.knowledge_collection = self._get_collection(0)
+            self._init_answer_cache_collection()
             logger.info("ChromaDB recreated successfully")
         except Exception as e:
             logger.error(f"Failed to recreate ChromaDB: {str(e)}")
             raise
     
-    def add_chat_entry(self, user_id: int, session_id: int, message: str, response: str):
-        """Add a chat entry (user message and AI response) to the collection."""
+    def _collection_names(self) -> List[str]:
+        # list_collections() returns names in newer ChromaDB releases and Collection objects in older ones
+        return [getattr(c, "name", c) for c in self.client.list_collections()]
+    
+    def _load_layout(self):
+        """
+        Read the storage layout. The shard count is fixed once data exists, since
+        changing it would send users to the wrong shard.
+        """
+        try:
+            with open(self.layout_path) as f:
+                layout = json.load(f)
+        except (OSError, ValueError):
+            layout = None
+        if layout is not None:
+            self.chat_shards = int(layout["chat_shards"])
+            if self.chat_shards != CHAT_MEMORY_SHARDS:
+                logger.warning(f"Using the existing {self.chat_shards} chat memory shards instead of CHAT_MEMORY_SHARDS={CHAT_MEMORY_SHARDS}")
+        elif not self.needs_migration():
+            self._save_layout()
+    
+    def _save_layout(self, vector_id: Optional[str] = None):
+        layout = {"chat_shards": self.chat_shards, "created_at": time.time()}
+        if vector_id is not None:
+            layout["vector_id"] = vector_id
+        with open(self.layout_path, "w") as f:
+            json.dump(layout, f)
+    
+    def _chat_vectors_match(self) -> bool:
+        """
+        Whether chat memory was embedded by the model loaded now. Vectors of another
+        model (e.g. after changing EMBEDDING_ENGINE) are not comparable with its query
+        vectors, so chat memory is not searched until a full repopulate re-embeds it.
+        """
+        if self._chat_vectors_ok is None:
+            try:
+                with open(self.layout_path) as f:
+                    recorded = json.load(f).get("vector_id")
+            except (OSError, ValueError):
+                recorded = None
+            current = self.embedder.vector_id
+            if recorded is None:
+                # Layouts from before vector ids were recorded are assumed to match
+                self._save_layout(current)
+                self._chat_vectors_ok = True
+            else:
+                self._chat_vectors_ok = recorded == current
+                if not self._chat_vectors_ok:
+                    logger.error(
+                        f"Chat memory was embedded with {recorded} but the embedding model is {current}; "
+                        f"it is not searched until it is repopulated (POST /init-chroma-db)"
+                    )
+        return self._chat_vectors_ok
+    
+    def record_chat_vectors(self):
+        """Mark chat memory as embedded by the current model (after a full repopulate)."""
+        self._save_layout(self.embedder.vector_id)
+        self._chat_vectors_ok = True
+    
+    def needs_migration(self) -> bool:
+        """True if data is still in the combined chat_history collection."""
+        if os.path.exists(self.layout_path):
+            return False
+        return any(name == LEGACY_COLLECTION or name.startswith(f"{LEGACY_COLLECTION}_v") for name in self._collection_names())
+    
+    def migrate_legacy_layout(self, page_size: int = 1000) -> Dict[str, int]:
+        """
+        One-time move of the combined chat_history collection into the RAG knowledge
+        collection and the per-user chat memory shards. Embeddings are copied, not
+        recomputed. The legacy collections are deleted once everything was copied.
+        """
+        if not self.needs_migration():
+            return {"knowledge": 0, "chats": 0}
+        
+        # The live legacy collection was tracked in collection_versions.json
+        legacy_live = LEGACY_COLLECTION
+        legacy_versions_path = os.path.join(self.persist_directory, "collection_versions.json")
+        try:
+            with open(legacy_versions_path) as f:
+                version = json.load(f)["live"]
+            legacy_live = LEGACY_COLLECTION if version == 0 else f"{LEGACY_COLLECTION}_v{version}"
+        except (OSError, ValueError, KeyError):
+            pass
+        
+        logger.info(f"Migrating '{legacy_live}' into '{KNOWLEDGE_COLLECTION}' and {self.chat_shards} chat memory shards...")
+        source = self.client.get_collection(legacy_live)
+        moved = {"knowledge": 0, "chats": 0}
+        offset = 0
+        while True:
+            page = source.get(limit=page_size, offset=offset, include=["documents", "metadatas", "embeddings"])
+            if not page["ids"]:
+                break
+            targets: Dict[str, Tuple[Any, List[int]]] = {}
+            for i, metadata in enumerate(page["metadatas"]):
+                user_id = (metadata or {}).get("user_id")
+                collection = self.knowledge_collection if user_id == RAG_USER_ID else self._chat_collection(user_id)
+                targets.setdefault(collection.name, (collection, []))[1].append(i)
+            for collection, rows in targets.values():
+                collection.upsert(
+                    ids=[page["ids"][i] for i in rows],
+                    documents=[page["documents"][i] for i in rows],
+                    metadatas=[page["metadatas"][i] for i in rows],
+                    embeddings=[page["embeddings"][i] for i in rows]
+                )
+                moved["knowledge" if collection is self.knowledge_collection else "chats"] += len(rows)
+            offset += page_size
+        
+        self._save_layout()
+        for name in self._collection_names():
+            if name == LEGACY_COLLECTION or name.startswith(f"{LEGACY_COLLECTION}_v"):
+                self.client.delete_collection(name)
+        if os.path.exists(legacy_versions_path):
+            os.remove(legacy_versions_path)
+        logger.info(f"Migrated {moved['knowledge']} knowledge documents and {moved['chats']} chat entries")
+        return moved
+    
+    def shard_for(self, user_id: Any) -> int:
+        """Stable hash bucket of a user's chat memory."""
+        return zlib.crc32(str(user_id).encode("utf-8")) % self.chat_shards
+    
+    def _chat_collection(self, user_id: Any):
+        bucket = self.shard_for(user_id)
+        with self._chat_collections_lock:
+            collection = self._chat_collections.get(bucket)
+            if collection is None:
+                collection = self.client.get_or_create_collection(
+                    name=chat_shard_name(bucket),
+                    embedding_function=self.embedding_function,
+                    metadata={"hnsw:space": "cosine"}
+                )
+                self._chat_collections[bucket] = collection
+            return collection
+    
+    def _get_collection(self, version: int):
+        return self.client.get_or_create_collection(
+            name=collection_name(version),
+            embedding_function=self.embedding_function,
+            metadata={"hnsw:space": "cosine"}
+        )
+    
+    def get_versions(self) -> Dict[str, Any]:
+        """The live and previous (rollback) collection versions."""
         try:
-            # Validate inputs
-            if not message or not response:
-                logger.warning(f"Empty message or response for user_id={user_id}, session_id={session_id}")
+            with open(self.versions_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {"live": 0, "previous": None, "swapped_at": None}
+    
+    def _save_versions(self, versions: Dict[str, Any]):
+        tmp_path = f"{self.versions_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(versions, f)
+        os.replace(tmp_path, self.versions_path)
+    
+    def collection_version(self) -> Dict[str, Any]:
+        """Describe the live knowledge collection, the rollback target and any build in progress."""
+        versions = self.get_versions()
+        router = self._knowledge_router()
+        return {
+            "live_version": versions["live"],
+            "live_collection": collection_name(versions["live"]),
+            "live_count": self.knowledge_collection.count(),
+            "chat_shards": self.chat_shards,
+            "previous_version": versions.get("previous"),
+            "swapped_at": versions.get("swapped_at"),
+            "building_version": self._staging_version,
+            "knowledge_backend": self.knowledge_backend,
+            "categories": router.sizes() if router is not None else {},
+        }
+    
+    def begin_build(self, resume_version: Optional[int] = None):
+        """
+        Create an empty knowledge collection for the next version and return it, or
+        reopen resume_version if it is a build that was suspended or interrupted.
+        Until commit_build(), suspend_build() or abort_build(), knowledge entries are
+        written to both the live and the new collection so nothing is lost meanwhile.
+        """
+        with self._build_lock:
+            if self._staging is not None:
+                raise RuntimeError(f"Collection version {self._staging_version} is already being built")
+            version = self.next_version()
+            if resume_version != version:
+                try:
+                    self.client.delete_collection(collection_name(version))  # Left over from an aborted build
+                except Exception:
+                    pass
+            self._staging = self._get_collection(version)
+            self._staging_version = version
+            logger.info(f"Building collection version {version}")
+            return self._staging
+    
+    def commit_build(self):
+        """Make the built collection live, keep the old one for rollback and drop anything older."""
+        with self._build_lock:
+            if self._staging is None:
+                raise RuntimeError("No collection build in progress")
+            versions = self.get_versions()
+            old_previous = versions.get("previous")
+            new_versions = {"live": self._staging_version, "previous": versions["live"], "swapped_at": time.time()}
+            # Remember which model embedded each version, so a version from another model is not queried
+            kept = {key: value for key, value in versions.get("vector_ids", {}).items() if key == str(versions["live"])}
+            new_versions["vector_ids"] = {**kept, str(self._staging_version): self.embedder.vector_id}
+            self._save_versions(new_versions)
+            # A single attribute assignment, so queries see either the old or the new collection
+            self.knowledge_collection = self._staging
+            self._staging = None
+            self._staging_version = None
+        
+        if old_previous is not None and old_previous not in (new_versions["live"], new_versions["previous"]):
+            try:
+                self.client.delete_collection(collection_name(old_previous))
+                self._delete_collection_files(collection_name(old_previous))
+            except Exception as e:
+                logger.warning(f"Could not delete old collection version {old_previous}: {str(e)}")
+        logger.info(f"Collection version {new_versions['live']} is live (previous {new_versions['previous']})")
+    
+    def next_version(self) -> int:
+        """Version number the next build will get."""
+        versions = self.get_versions()
+        return max(versions["live"], versions.get("previous") or 0) + 1
+    
+    @property
+    def building_version(self) -> Optional[int]:
+        return self._staging_version
+    
+    def suspend_build(self):
+        """Stop writing to a build in progress but keep its collection so it can be resumed."""
+        with self._build_lock:
+            version = self._staging_version
+            self._staging = None
+            self._staging_version = None
+        if version is not None:
+            logger.info(f"Suspended build of collection version {version}")
+    
+    def abort_build(self):
+        """Discard a build in progress."""
+        with self._build_lock:
+            if self._staging is None:
                 return
-                
-            # Create a unique ID for this chat entry
-            document_id = f"chat_{user_id}_{session_id}_{uuid.uuid4()}"
-            
-            # Store both the message and response as a document
-            full_document = f"User: {message}\nAI: {response}"
-            
-            # Add to collection
-            self.chat_collection.add(
-                documents=[full_document],
-                metadatas=[{
-                    "user_id": str(user_id),
-                    "session_id": str(session_id),
-                    "type": "chat"
-                }],
-                ids=[document_id]
-            )
-            logger.debug(f"Successfully added chat entry to ChromaDB for user_id={user_id}, session_id={session_id}")
+            version = self._staging_version
+            self._staging = None
+            self._staging_version = None
+        try:
+            self.client.delete_collection(collection_name(version))
+            self._delete_collection_files(collection_name(version))
         except Exception as e:
-            logger.error(f"Failed to add chat entry to ChromaDB: {str(e)}")
-            # Don't raise to prevent breaking the application flow
-            # The SQL database still has the chat history
+            logger.warning(f"Could not delete aborted collection version {version}: {str(e)}")
+        logger.info(f"Aborted build of collection version {version}")
+    
+    def _delete_collection_files(self, name: str):
+        """Remove the indexes kept next to a collection version ("{name}.*")."""
+        for path in glob.glob(os.path.join(self.persist_directory, f"{name}.*")):
+            os.remove(path)
+    
+    def export_vectors(self, collection=None, page_size: int = 1000) -> Tuple[List[str], List[str], List[Any], List[str]]:
+        """The ids, documents, stored embeddings and categories of a knowledge collection (the live one by default)."""
+        collection = collection if collection is not None else self.knowledge_collection
+        ids, documents, embeddings, categories = [], [], [], []
+        offset = 0
+        while True:
+            page = collection.get(limit=page_size, offset=offset, include=["documents", "embeddings", "metadatas"])
+            if not len(page["ids"]):
+                break
+            ids.extend(page["ids"])
+            documents.extend(page["documents"])
+            embeddings.extend(page["embeddings"])
+            categories.extend((metadata or {}).get("category", "") for metadata in page["metadatas"])
+            offset += page_size
+        return ids, documents, embeddings, categories
+    
+    def build_knowledge_indexes(self, collection=None):
+        """
+        Build the category router and, with the numpy backend, the vector index of
+        a knowledge collection (the live one by default) from one read of its embeddings.
+        """
+        collection = collection if collection is not None else self.knowledge_collection
+        exported = self.export_vectors(collection)
+        self.build_category_router(collection, exported)
+        if self.knowledge_backend == "numpy":
+            self.build_vector_index(collection, exported)
+    
+    def build_vector_index(self, collection=None, exported=None) -> NumpyVectorIndex:
+        """Write the numpy index of a knowledge collection, partitioned by category, from its stored embeddings."""
+        collection = collection if collection is not None else self.knowledge_collection
+        ids, documents, embeddings, categories = exported or self.export_vectors(collection)
+        prefix = os.path.join(self.persist_directory, f"{collection.name}.vectors")
+        index = NumpyVectorIndex.build(prefix, ids, documents, embeddings, dtype=NUMPY_INDEX_DTYPE, categories=categories)
+        logger.info(f"Built numpy vector index for '{collection.name}': {len(index)} documents, "
+                    f"{len(index.partitions)} partitions ({NUMPY_INDEX_DTYPE})")
+        return index
+    
+    def build_category_router(self, collection=None, exported=None) -> Optional[CategoryRouter]:
+        """Write the category centroids of a knowledge collection; None if it has no documents."""
+        collection = collection if collection is not None else self.knowledge_collection
+        _, _, embeddings, categories = exported or self.export_vectors(collection)
+        if not categories:
+            return None
+        router = CategoryRouter.build(categories, embeddings)
+        router.save(os.path.join(self.persist_directory, f"{collection.name}.partitions.json"))
+        logger.info(f"Built category router for '{collection.name}': {router.sizes()}")
+        return router
+    
+    def _knowledge_vectors(self) -> Optional[NumpyVectorIndex]:
+        """The numpy index of the live knowledge collection, or None when Chroma serves the queries."""
+        if self.knowledge_backend != "numpy":
+            return None
+        collection = self.knowledge_collection
+        if collection.name == self._vector_index_name:
+            return self._vector_index
+        with self._knowledge_index_lock:
+            if collection.name != self._vector_index_name:
+                prefix = os.path.join(self.persist_directory, f"{collection.name}.vectors")
+                try:
+                    self._vector_index = NumpyVectorIndex.load(prefix)
+                except (OSError, ValueError, KeyError):
+                    try:
+                        self._vector_index = self.build_vector_index(collection)
+                    except Exception as e:
+                        # Leave the name unset so the next query retries; Chroma answers meanwhile
+                        logger.error(f"Could not build numpy vector index, using Chroma: {str(e)}")
+                        return None
+                self._vector_index_name = collection.name
+            return self._vector_index
+    
+    def _knowledge_router(self) -> Optional[CategoryRouter]:
+        """The category router of the live knowledge collection, or None if it has no documents."""
+        collection = self.knowledge_collection
+        if collection.name == self._category_router_name:
+            return self._category_router
+        with self._knowledge_index_lock:
+            if collection.name != self._category_router_name:
+                try:
+                    self._category_router = CategoryRouter.load(
+                        os.path.join(self.persist_directory, f"{collection.name}.partitions.json")
+                    )
+                except (OSError, ValueError, KeyError):
+                    try:
+                        self._category_router = self.build_category_router(collection)
+                    except Exception as e:
+                        logger.error(f"Could not build category router, searching all categories: {str(e)}")
+                        return None
+                self._category_router_name = collection.name
+            return self._category_router
+    
+    def _route_knowledge(self, embedding: List[float]) -> Optional[List[str]]:
+        """
+        The categories a knowledge query is restricted to, or None to search them all.
+        Small knowledge bases are always searched in full.
+        """
+        if not KNOWLEDGE_ROUTING_ENABLED:
+            return None
+        router = self._knowledge_router()
+        if router is None or len(router) <= KNOWLEDGE_ROUTE_CATEGORIES or sum(router.counts) < KNOWLEDGE_ROUTING_MIN_DOCUMENTS:
+            return None
+        return router.route(embedding, KNOWLEDGE_ROUTE_CATEGORIES)
+    
+    def _knowledge_changed(self):
+        """Drop the knowledge indexes after a write to the live knowledge collection; they are rebuilt on the next query."""
+        with self._knowledge_index_lock:
+            name = self.knowledge_collection.name
+            for pattern in (f"{name}.vectors.*", f"{name}.partitions.json"):
+                for path in glob.glob(os.path.join(self.persist_directory, pattern)):
+                    os.remove(path)
+            self._vector_index = None
+            self._vector_index_name = None
+            self._category_router = None
+            self._category_router_name = None
     
-    def get_relevant_context(self, user_id: int, session_id: int, query: str, limit: int = 5):
-        """Retrieve the most relevant context based on the user's query."""
+    def rollback(self) -> Dict[str, Any]:
+        """Swap the live and previous knowledge collection versions."""
+        with self._build_lock:
+            versions = self.get_versions()
+            if versions.get("previous") is None:
+                raise RuntimeError("No previous collection version to roll back to")
+            collection = self._get_collection(versions["previous"])
+            self._save_versions({
+                "live": versions["previous"],
+                "previous": versions["live"],
+                "swapped_at": time.time(),
+                "vector_ids": versions.get("vector_ids", {}),
+            })
+            self.knowledge_collection = collection
+        logger.info(f"Rolled back to collection version {versions['previous']}")
+        # Cached answers were generated from the knowledge base that was just replaced
+        self.clear_answer_cache()
+        return self.collection_version()
+    
+    def _init_answer_cache_collection(self):
+        """Create the collection that stores question/answer pairs for the semantic cache."""
+        self.answer_cache_collection = self.client.get_or_create_collection(
+            name="answer_cache",
+            embedding_function=self.embedding_function,
+            metadata={"hnsw:space": "cosine"}
+        )
+    
+    def embed_query(self, query: str) -> List[float]:
+        """Embed a query, reusing the embedding if the same text was embedded recently."""
+        key = hashlib.sha256(query.encode("utf-8")).hexdigest()
+        with self._query_embeddings_lock:
+            embedding = self._query_embeddings.get(key)
+            if embedding is not None:
+                self._query_embeddings.move_to_end(key)
+                metrics.increment("query_embedding_cache_hits")
+                return embedding
+        
+        metrics.increment("query_embedding_cache_misses")
+        embedding = [float(x) for x in self.embedder([query])[0]]
+        with self._query_embeddings_lock:
+            self._query_embeddings[key] = embedding
+            self._query_embeddings.move_to_end(key)
+            while len(self._query_embeddings) > QUERY_EMBEDDING_CACHE_SIZE:
+                self._query_embeddings.popitem(last=False)
+        return embedding
+    
+    def query_contexts(self, query: str, targets: List[Tuple[Any, Any]], limit: int = 5) -> List[List[Dict[str, Any]]]:
+        """
+        Retrieve the closest chat entries for several (user_id, session_id) filters at once.
+        The query is embedded a single time and the embedding is reused for every
+        filter; results are returned in the same order as targets.
+        """
+        if not query or not query.strip():
+            logger.warning(f"Empty query received for targets={targets}")
+            return [[] for _ in targets]
+        
         try:
-            if not query or not query.strip():
-                logger.warning(f"Empty query received for user_id={user_id}, session_id={session_id}")
+            embedding = self.embed_query(query)
+        except Exception as e:
+            logger.error(f"Query embedding error: {str(e)}")
+            return [[] for _ in targets]
+        return [self._query_with_embedding(embedding, user_id, session_id, limit) for user_id, session_id in targets]
+    
+    def _search_knowledge(self, embeddings: List[List[float]], limit: int) -> List[List[Dict[str, Any]]]:
+        """
+        Search the knowledge base for a batch of query embeddings, each restricted to
+        the categories it is routed to. A routed query that finds fewer than limit
+        documents is repeated over all categories.
+        """
+        if not self._knowledge_vectors_match():
+            return [[] for _ in embeddings]
+        index = self._knowledge_vectors()
+        routes = [self._route_knowledge(embedding) for embedding in embeddings]
+        if all(categories is None for categories in routes):
+            return self._knowledge_batch(index, embeddings, limit, None)
+        
+        results = []
+        for embedding, categories in zip(embeddings, routes):
+            found = self._knowledge_batch(index, [embedding], limit, categories)[0]
+            if categories is not None:
+                metrics.increment("knowledge_routed_queries_total")
+                if len(found) < limit:
+                    metrics.increment("knowledge_route_fallbacks_total")
+                    found = self._knowledge_batch(index, [embedding], limit, None)[0]
+            results.append(found)
+        return results
+    
+    def _knowledge_vectors_match(self) -> bool:
+        """Whether the live knowledge version was embedded by the model loaded now (versions from before this was recorded are assumed to)."""
+        name = self.knowledge_collection.name
+        checked, matches = self._knowledge_vectors_ok
+        if checked != name:
+            versions = self.get_versions()
+            recorded = versions.get("vector_ids", {}).get(str(versions["live"]))
+            current = self.embedder.vector_id
+            matches = recorded is None or recorded == current
+            if not matches:
+                logger.error(
+                    f"Knowledge collection {name} was embedded with {recorded} but the embedding model is {current}; "
+                    f"it is not searched until the dataset is ingested again"
+                )
+            self._knowledge_vectors_ok = (name, matches)
+        return matches
+    
+    def _knowledge_batch(self, index: Optional[NumpyVectorIndex], embeddings: List[List[float]], limit: int,
+                         categories: Optional[List[str]]) -> List[List[Dict[str, Any]]]:
+        if index is not None:
+            return index.query(embeddings, limit, partitions=categories)
+        # The knowledge base has its own collection, so only the category needs filtering
+        results = self.knowledge_collection.query(
+            query_embeddings=embeddings,
+            where={"category": {"$in": categories}} if categories else None,
+            n_results=limit,
+            include=["documents", "distances", "embeddings"]
+        )
+        vectors = results.get("embeddings")
+        if vectors is None or not len(vectors):
+            vectors = [[None] * len(ids) for ids in results["ids"]]
+        return [
+            [
+                {"id": doc_id, "document": document, "distance": distance, "embedding": embedding}
+                for doc_id, document, distance, embedding in zip(ids, documents, distances, row_vectors)
+            ]
+            for ids, documents, distances, row_vectors in zip(
+                results["ids"], results["documents"], results["distances"], vectors
+            )
+        ]
+    
+    def query_context(self, user_id: int, session_id: int, query: str, limit: int = 5) -> List[Dict[str, Any]]:
+        """
+        Retrieve the closest chat entries for the query, nearest first.
+        Each result has the document id, text, cosine distance and embedding.
+        """
+        return self.query_contexts(query, [(user_id, session_id)], limit)[0]
+    
+    def _query_with_embedding(self, embedding: List[float], user_id: Any, session_id: Any, limit: int) -> List[Dict[str, Any]]:
+        try:
+            if str(user_id) == RAG_USER_ID:
+                return self._search_knowledge([embedding], limit)[0]
+            
+            if not self._chat_vectors_match():
                 return []
-                
-            # Use $and operator to combine conditions according to ChromaDB's query format
-            results = self.chat_collection.query(
-                query_texts=[query],
-                where={"$and": [
-                    {"user_id": str(user_id)},
-                    {"session_id": str(session_id)}
-                ]},
-                n_results=limit
+            
+            # Only the user's shard is searched; use $and to combine conditions as ChromaDB expects
+            collection = self._chat_collection(user_id)
+            where = {"$and": [
+                {"user_id": str(user_id)},
+                {"session_id": str(session_id)}
+            ]}
+            results = collection.query(
+                query_embeddings=[embedding],
+                where=where,
+                n_results=limit,
+                include=["documents", "distances", "embeddings"]
             )
             
-            if not results or not results.get("documents"):
+            if not results or not results.get("ids") or not results["ids"][0]:
                 logger.info(f"No matching documents found for query from user_id={user_id}, session_id={session_id}")
                 return []
-                
-            return results["documents"][0] if results["documents"] else []
+            
+            embeddings = results.get("embeddings")
+            embeddings = embeddings[0] if embeddings is not None and len(embeddings) else [None] * len(results["ids"][0])
+            return [
+                {"id": doc_id, "document": document, "distance": distance, "embedding": embedding}
+                for doc_id, document, distance, embedding in zip(
+                    results["ids"][0], results["documents"][0], results["distances"][0], embeddings
+                )
+            ]
         except Exception as e:
             logger.error(f"ChromaDB query error: {str(e)}")
             # Return empty list on error to allow fallback mechanism
             return []
     
-    def batch_add_chats(self, chats: List[Dict[str, Any]]):
-        """Add multiple chat entries in a batch for initial loading."""
+    def get_knowledge(self, ids: List[str], query: str) -> List[Dict[str, Any]]:
+        """
+        Fetch knowledge documents by id in the query_context() result format,
+        with their cosine distance to the query, for matches found outside the vector search.
+        """
+        if not ids or not self._knowledge_vectors_match():
+            return []
+        try:
+            index = self._knowledge_vectors()
+            if index is not None:
+                return index.get(ids, self.embed_query(query))
+            results = self.knowledge_collection.get(ids=ids, include=["documents", "embeddings"])
+            if not results["ids"]:
+                return []
+            vectors = np.asarray(results["embeddings"], dtype=np.float32)
+            query_vector = np.asarray(self.embed_query(query), dtype=np.float32)
+            similarity = vectors @ query_vector / np.maximum(
+                np.linalg.norm(vectors, axis=1) * np.linalg.norm(query_vector), 1e-12
+            )
+            return [
+                {"id": doc_id, "document": document, "distance": float(1.0 - sim), "embedding": embedding}
+                for doc_id, document, sim, embedding in zip(results["ids"], results["documents"], similarity, results["embeddings"])
+            ]
+        except Exception as e:
+            logger.error(f"ChromaDB knowledge lookup error: {str(e)}")
+            return []
+    
+    def iter_knowledge(self, page_size: int = 1000):
+        """Yield (ids, documents) pages of the live knowledge collection."""
+        collection = self.knowledge_collection
+        offset = 0
+        while True:
+            page = collection.get(limit=page_size, offset=offset, include=["documents"])
+            if not page["ids"]:
+                return
+            yield page["ids"], page["documents"]
+            offset += page_size
+    
+    def batch_add_chats(self, chats: List[Dict[str, Any]], collection=None):
+        """
+        Add multiple chat entries in a batch for initial loading.
+        Each entry goes to its user's chat memory shard (RAG entries to the knowledge
+        base and any build of it in progress), or to the given collection.
+        """
         if not chats:
             logger.info("No chats provided for batch adding, skipping")
             return
@@ -155,46 +765,218 @@ class ChromaDBUtil:
                     logger.warning(f"Skipping invalid chat entry: {chat}")
                     continue
                     
-                document_id = f"chat_{chat['user_id']}_{chat['session_id']}_{uuid.uuid4()}"
-                full_document = f"User: {chat['message']}\nAI: {chat['response']}"
+                # Rows from the chats table get a stable id; other entries (e.g. RAG chunks) a random one
+                if chat.get("chat_id") is not None:
+                    document_id = chat_document_id(chat["chat_id"])
+                else:
+                    document_id = f"chat_{chat['user_id']}_{chat['session_id']}_{uuid.uuid4()}"
                 
-                documents.append(full_document)
-                metadatas.append({
+                metadata = {
                     "user_id": str(chat["user_id"]),
                     "session_id": str(chat["session_id"]),
                     "type": "chat"
-                })
+                }
+                if chat.get("chat_id") is not None:
+                    metadata["chat_id"] = int(chat["chat_id"])
+                
+                documents.append(chat_document(chat["message"], chat["response"]))
+                metadatas.append(metadata)
                 ids.append(document_id)
             
             if documents:  # Only add if we have valid documents
-                self.chat_collection.add(
-                    documents=documents,
-                    metadatas=metadatas,
-                    ids=ids
-                )
+                # Reuse vectors from the on-disk cache; only new texts go through the model
+                embeddings = embedding_cache.embed(documents, self.embedder)
+                
+                # Group the entries by the collections they are written to
+                targets: Dict[str, Tuple[Any, List[int]]] = {}
+                for i, metadata in enumerate(metadatas):
+                    if collection is not None:
+                        destinations = [collection]
+                    elif metadata["user_id"] == RAG_USER_ID:
+                        destinations = [self.knowledge_collection, self._staging]
+                    else:
+                        destinations = [self._chat_collection(metadata["user_id"])]
+                    for destination in destinations:
+                        if destination is not None:
+                            targets.setdefault(destination.name, (destination, []))[1].append(i)
+                
+                for target, rows in targets.values():
+                    # Upsert so indexing the same chat row twice replaces it
+                    target.upsert(
+                        documents=[documents[i] for i in rows],
+                        embeddings=embeddings[rows],
+                        metadatas=[metadatas[i] for i in rows],
+                        ids=[ids[i] for i in rows]
+                    )
+                    if target is self.knowledge_collection:
+                        self._knowledge_changed()
                 logger.debug(f"Added {len(documents)} documents to ChromaDB in batch")
             else:
                 logger.warning("No valid documents found in batch to add to ChromaDB")
                 
         except Exception as e:
             logger.error(f"Error in batch_add_chats: {str(e)}")
-            # Continue execution, don't raise to avoid breaking the application
+            # Callers decide whether to retry; a sync must not move past entries that were not written
+            raise
+    
+    def upsert_documents(self, ids: List[str], documents: List[str], metadatas: List[Dict[str, Any]],
+                         embeddings, collection=None, batch_size: int = 5000):
+        """Upsert documents whose embeddings were computed by the caller, in slices Chroma accepts."""
+        collection = collection if collection is not None else self.knowledge_collection
+        for start in range(0, len(ids), batch_size):
+            end = start + batch_size
+            collection.upsert(
+                ids=ids[start:end],
+                documents=documents[start:end],
+                metadatas=metadatas[start:end],
+                embeddings=embeddings[start:end]
+            )
+        if collection is self.knowledge_collection:
+            self._knowledge_changed()
     
-    def reset_collection(self):
-        """Reset the collection by deleting and recreating it."""
+    def get_cached_answer(self, query: str, max_distance: float, user_id: Any, session_id: Any) -> Optional[str]:
+        """
+        Return a cached answer whose question is within max_distance of the query, if any.
+        Only answers cached for this session, or shared answers, that have not expired are considered.
+        """
         try:
-            self.client.delete_collection("chat_history")
-            logger.info("Successfully deleted existing 'chat_history' collection")
+            if not query or not query.strip():
+                return None
+            
+            results = self.answer_cache_collection.query(
+                query_embeddings=[self.embed_query(query)],
+                where={"$and": [
+                    {"created_at": {"$gte": time.time() - SEMANTIC_CACHE_TTL}},
+                    # Questions embedded by another model are not comparable with this query
+                    {"vector_id": self.embedder.vector_id},
+                    {"$or": [
+                        {"shared": True},
+                        {"session_key": f"{user_id}:{session_id}"}
+                    ]}
+                ]},
+                n_results=1,
+                include=["metadatas", "distances"]
+            )
+            
+            if not results.get("ids") or not results["ids"][0]:
+                return None
+            
+            distance = results["distances"][0][0]
+            if distance > max_distance:
+                return None
+            
+            logger.debug(f"Semantic cache hit at distance {distance:.4f}")
+            return results["metadatas"][0][0].get("answer")
         except Exception as e:
-            logger.warning(f"Error deleting collection (may not exist yet): {str(e)}")
-        
-        # Create a fresh collection
-        self.chat_collection = self.client.get_or_create_collection(
-            name="chat_history",
-            embedding_function=self.embedding_function,
-            metadata={"hnsw:space": "cosine"}
-        )
-        logger.info("Successfully created new 'chat_history' collection")
+            logger.error(f"Semantic cache lookup error: {str(e)}")
+            return None
+    
+    def cache_answer(self, query: str, answer: str, user_id: Any, session_id: Any, shared: bool = False):
+        """
+        Store a question and its generated answer in the semantic cache for the session.
+        shared answers (generated without the user's chat history) are reused for everyone.
+        """
+        try:
+            if not query or not query.strip() or not answer:
+                return
+            
+            self.answer_cache_collection.add(
+                documents=[query],
+                embeddings=[self.embed_query(query)],
+                metadatas=[{
+                    "user_id": str(user_id),
+                    "session_key": f"{user_id}:{session_id}",
+                    "shared": shared,
+                    "vector_id": self.embedder.vector_id,
+                    "answer": answer,
+                    "created_at": time.time()
+                }],
+                ids=[f"answer_{uuid.uuid4()}"]
+            )
+            self._prune_answer_cache()
+        except Exception as e:
+            logger.error(f"Failed to add answer to semantic cache: {str(e)}")
+    
+    def _prune_answer_cache(self):
+        """
+        Keep the semantic cache below SEMANTIC_CACHE_MAX_ENTRIES: once it is over,
+        expired answers are deleted, then the oldest down to 90% of the limit.
+        """
+        collection = self.answer_cache_collection
+        if collection.count() <= SEMANTIC_CACHE_MAX_ENTRIES:
+            return
+        collection.delete(where={"created_at": {"$lt": time.time() - SEMANTIC_CACHE_TTL}})
+        overflow = collection.count() - int(SEMANTIC_CACHE_MAX_ENTRIES * 0.9)
+        if overflow > 0:
+            entries = collection.get(include=["metadatas"])
+            oldest = sorted(zip(entries["ids"], entries["metadatas"]), key=lambda e: (e[1] or {}).get("created_at", 0))
+            collection.delete(ids=[doc_id for doc_id, _ in oldest[:overflow]])
+        metrics.increment("semantic_cache_prunes_total")
+        logger.info(f"Pruned semantic answer cache to {collection.count()} entries")
+    
+    def clear_answer_cache(self):
+        """Drop every cached answer, e.g. after the RAG dataset changes."""
+        try:
+            self.client.delete_collection("answer_cache")
+            logger.info("Cleared semantic answer cache")
+        except Exception as e:
+            logger.warning(f"Error deleting answer cache (may not exist yet): {str(e)}")
+        self._init_answer_cache_collection()
+    
+    def existing_ids(self, ids: List[str], user_ids: List[Any]) -> set:
+        """Return which of the given chat document ids (owned by user_ids) are already indexed."""
+        by_shard: Dict[str, Tuple[Any, List[str]]] = {}
+        for doc_id, user_id in zip(ids, user_ids):
+            collection = self._chat_collection(user_id)
+            by_shard.setdefault(collection.name, (collection, []))[1].append(doc_id)
+        existing = set()
+        for collection, shard_ids in by_shard.values():
+            existing.update(collection.get(ids=shard_ids, include=[])["ids"])
+        return existing
+    
+    def get_sync_mark(self) -> int:
+        """Highest chats.id below which every row has been indexed (0 if never synced)."""
+        try:
+            with open(self.sync_state_path) as f:
+                return int(json.load(f).get("chat_high_water_mark", 0))
+        except (OSError, ValueError):
+            return 0
+    
+    def set_sync_mark(self, chat_id: int):
+        tmp_path = f"{self.sync_state_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"chat_high_water_mark": chat_id, "updated_at": time.time()}, f)
+        os.replace(tmp_path, self.sync_state_path)
+    
+    def remove_chats_except(self, chat_ids: Set[int], max_chat_id: int, page_size: int = 1000) -> int:
+        """
+        Delete chat memory entries whose chats row no longer exists (deleted chats
+        and sessions), and entries without a chats row id. Called after a full rebuild
+        with the ids it scanned; entries above max_chat_id were indexed while it ran
+        and are left alone.
+        """
+        removed = 0
+        for name in self._collection_names():
+            if not name.startswith(f"{CHAT_SHARD_PREFIX}_"):
+                continue
+            collection = self.client.get_collection(name, embedding_function=self.embedding_function)
+            stale = []
+            offset = 0
+            while True:
+                page = collection.get(limit=page_size, offset=offset, include=["metadatas"])
+                if not page["ids"]:
+                    break
+                stale.extend(
+                    doc_id for doc_id, metadata in zip(page["ids"], page["metadatas"])
+                    if _is_stale_chat((metadata or {}).get("chat_id"), chat_ids, max_chat_id)
+                )
+                offset += page_size
+            for start in range(0, len(stale), page_size):
+                collection.delete(ids=stale[start:start + page_size])
+            removed += len(stale)
+        if removed:
+            logger.info(f"Removed {removed} chat memory entries without a chats row")
+        return removed
 
 # Create a singleton instance
 chroma_db = ChromaDBUtil()
@@ -0,0 +1,65 @@
+"""Select retrieved context for a prompt: distance cut-off, recent-turn dedup and MMR diversity."""
+import logging
+from typing import Any, Dict, Iterable, List, Tuple
+import numpy as np
+from app.config.retrieval_config import HISTORY_MAX_DISTANCE, RETRIEVAL_MMR_LAMBDA
+from app.utils.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+def _normalize(text: str) -> str:
+    return " ".join(text.split()).lower()
+
+
+def _overlaps_recent(document: str, recent_turns: List[Tuple[str, str]]) -> bool:
+    """True if the document is one of the exchanges already in the recent-turn window."""
+    normalized = _normalize(document)
+    for message, response in recent_turns:
+        if _normalize(f"User: {message}") in normalized and _normalize(response or "") in normalized:
+            return True
+    return False
+
+
+def _mmr(candidates: List[Dict[str, Any]], limit: int, mmr_lambda: float) -> List[Dict[str, Any]]:
+    """Pick up to limit candidates that are relevant to the query but not redundant with each other."""
+    if len(candidates) <= 1 or any(c.get("embedding") is None for c in candidates):
+        return candidates[:limit]
+
+    vectors = np.asarray([c["embedding"] for c in candidates], dtype=np.float32)
+    vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+    pairwise = vectors @ vectors.T
+    relevance = np.asarray([1.0 - c["distance"] for c in candidates], dtype=np.float32)
+
+    selected = [0]  # The nearest candidate always goes first
+    remaining = list(range(1, len(candidates)))
+    while remaining and len(selected) < limit:
+        redundancy = pairwise[np.ix_(remaining, selected)].max(axis=1)
+        scores = mmr_lambda * relevance[remaining] - (1 - mmr_lambda) * redundancy
+        best = remaining[int(np.argmax(scores))]
+        selected.append(best)
+        remaining.remove(best)
+    return [candidates[i] for i in selected]
+
+
+def select_context(candidates: List[Dict[str, Any]], limit: int,
+                   recent_turns: Iterable[Tuple[str, str]] = (),
+                   max_distance: float = HISTORY_MAX_DISTANCE,
+                   mmr_lambda: float = RETRIEVAL_MMR_LAMBDA) -> List[str]:
+    """
+    Turn query_context() results into the documents to put in the prompt.
+    Drops results beyond max_distance (except exact code matches from hybrid
+    retrieval) and exchanges already present in the recent-turn window, then
+    applies MMR so near-duplicates are not repeated.
+    """
+    recent_turns = list(recent_turns)
+    kept = [
+        c for c in candidates
+        if (c.get("exact") or c["distance"] <= max_distance) and not _overlaps_recent(c["document"], recent_turns)
+    ]
+    selected = _mmr(kept, limit, mmr_lambda)
+
+    metrics.increment("retrieval_candidates_total", len(candidates))
+    metrics.increment("retrieval_selected_total", len(selected))
+    logger.debug(f"Selected {len(selected)} of {len(candidates)} retrieved documents")
+    return [c["document"] for c in selected]
@@ -0,0 +1,143 @@
+"""Persistent, content-addressed cache of document embeddings (float32 memmap plus key index)."""
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import unicodedata
+from typing import Callable, Dict, List, Optional, Sequence
+import numpy as np
+from app.config.embedding_config import EMBEDDING_CACHE_DIR
+from app.utils.embedding_engine import embedding_engine
+from app.utils.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+_WHITESPACE_RE = re.compile(r"\s+")
+
+
+def normalize_text(text: str) -> str:
+    """Canonical form used for cache keys: NFC unicode with collapsed whitespace."""
+    return _WHITESPACE_RE.sub(" ", unicodedata.normalize("NFC", text)).strip()
+
+
+class EmbeddingCache:
+    def __init__(self, directory: str = EMBEDDING_CACHE_DIR, model_id: Optional[str] = None):
+        """
+        Store embeddings on disk keyed by SHA-256 of the model id and normalized text.
+        Vectors are appended to vectors.f32 and read back through a memory map;
+        keys.txt holds one hex key per row in the same order. Each model gets its
+        own subdirectory, so switching models never returns stale vectors.
+        Without a model_id, the vector id of the model the embedding engine actually
+        loaded is used, resolved on first use.
+        """
+        self.model_id = model_id
+        self.enabled = bool(directory)
+        self.base_directory = directory
+        self.directory = ""
+        self.dim: Optional[int] = None
+        self._rows: Dict[str, int] = {}
+        self._mapped: Optional[np.memmap] = None
+        self._lock = threading.Lock()
+        self._loaded = False
+
+    def _ensure_loaded(self):
+        """Resolve the model id and open its subdirectory (called with the lock held)."""
+        if self._loaded:
+            return
+        if self.model_id is None:
+            self.model_id = embedding_engine.vector_id
+        self.directory = os.path.join(self.base_directory, re.sub(r"[^\w.-]", "_", self.model_id))
+        self.vectors_path = os.path.join(self.directory, "vectors.f32")
+        self.keys_path = os.path.join(self.directory, "keys.txt")
+        self.meta_path = os.path.join(self.directory, "meta.json")
+        self._load()
+        self._loaded = True
+
+    def _load(self):
+        os.makedirs(self.directory, exist_ok=True)
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path) as f:
+                self.dim = int(json.load(f)["dim"])
+        if self.dim is None or not os.path.exists(self.keys_path):
+            return
+
+        with open(self.keys_path) as f:
+            keys = [line.strip() for line in f if line.strip()]
+        vector_rows = os.path.getsize(self.vectors_path) // (4 * self.dim) if os.path.exists(self.vectors_path) else 0
+        # A crash between the two appends can leave one file longer; only trust complete rows
+        usable = min(len(keys), vector_rows)
+        self._rows = {key: row for row, key in enumerate(keys[:usable])}
+        if usable < len(keys) or usable < vector_rows:
+            logger.warning(f"Embedding cache {self.directory} had {max(len(keys), vector_rows) - usable} incomplete rows, truncating")
+            self._truncate(usable, keys[:usable])
+        logger.info(f"Loaded {len(self._rows)} cached embeddings for {self.model_id}")
+
+    def _truncate(self, rows: int, keys: List[str]):
+        with open(self.vectors_path, "ab") as f:
+            f.truncate(rows * 4 * self.dim)
+        with open(self.keys_path, "w") as f:
+            f.writelines(f"{key}\n" for key in keys)
+
+    def make_key(self, text: str) -> str:
+        return hashlib.sha256(f"{self.model_id}\0{normalize_text(text)}".encode("utf-8")).hexdigest()
+
+    def _vectors(self) -> np.ndarray:
+        """Memory map of all stored rows, re-mapped after appends."""
+        if self._mapped is None or len(self._mapped) != len(self._rows):
+            self._mapped = np.memmap(self.vectors_path, dtype=np.float32, mode="r", shape=(len(self._rows), self.dim))
+        return self._mapped
+
+    def _append(self, keys: List[str], vectors: np.ndarray):
+        if self.dim is None:
+            self.dim = int(vectors.shape[1])
+            with open(self.meta_path, "w") as f:
+                json.dump({"model_id": self.model_id, "dim": self.dim}, f)
+        # Vectors first, then keys, so a key never points at a missing vector
+        with open(self.vectors_path, "ab") as f:
+            f.write(np.ascontiguousarray(vectors, dtype=np.float32).tobytes())
+        with open(self.keys_path, "a") as f:
+            f.writelines(f"{key}\n" for key in keys)
+        start = len(self._rows)
+        for offset, key in enumerate(keys):
+            self._rows[key] = start + offset
+
+    def embed(self, texts: Sequence[str], embed_fn: Callable[[List[str]], Sequence]) -> np.ndarray:
+        """
+        Return a (len(texts), dim) float32 array of embeddings. Cached vectors are
+        read from disk; the rest are computed with one embed_fn call and stored.
+        """
+        if not texts:
+            return np.zeros((0, self.dim or 0), dtype=np.float32)
+        if not self.enabled:
+            return np.asarray(embed_fn(list(texts)), dtype=np.float32)
+
+        with self._lock:
+            self._ensure_loaded()
+        keys = [self.make_key(text) for text in texts]
+        with self._lock:
+            missing: Dict[str, str] = {}
+            for key, text in zip(keys, texts):
+                if key not in self._rows and key not in missing:
+                    missing[key] = text
+
+        if missing:
+            computed = np.asarray(embed_fn(list(missing.values())), dtype=np.float32)
+            with self._lock:
+                new = [(key, vector) for key, vector in zip(missing, computed) if key not in self._rows]
+                if new:
+                    self._append([key for key, _ in new], np.stack([vector for _, vector in new]))
+
+        metrics.increment("embedding_cache_hits", len(texts) - len(missing))
+        metrics.increment("embedding_cache_misses", len(missing))
+        with self._lock:
+            vectors = self._vectors()
+            return np.asarray(vectors[[self._rows[key] for key in keys]])
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+
+# Create a singleton instance
+embedding_cache = EmbeddingCache()
@@ -0,0 +1,251 @@
+"""
+Text embedding engine used for queries and indexing.
+Runs ChromaDB's default MiniLM model, or the same model through ONNX Runtime
+(optionally int8-quantized) with explicit thread control, and coalesces small
+concurrent calls into shared batches.
+"""
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+from typing import List, Optional, Sequence
+import numpy as np
+from app.config.embedding_config import (
+    EMBEDDING_MODEL_ID,
+    EMBEDDING_ENGINE,
+    EMBEDDING_PRECISION,
+    EMBEDDING_ONNX_MODEL,
+    EMBEDDING_THREADS,
+    EMBEDDING_MAX_BATCH,
+    EMBEDDING_BATCH_WINDOW_MS,
+)
+from app.utils.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# MiniLM was trained on sequences of up to 256 word pieces
+_MAX_TOKENS = 256
+
+
+def _default_model_dir() -> str:
+    """Directory where ChromaDB keeps its downloaded all-MiniLM-L6-v2 ONNX model."""
+    try:
+        from chromadb.utils.embedding_functions.onnx_mini_lm_l6_v2 import ONNXMiniLM_L6_V2
+        return os.path.join(str(ONNXMiniLM_L6_V2.DOWNLOAD_PATH), ONNXMiniLM_L6_V2.EXTRACTED_FOLDER_NAME)
+    except (ImportError, AttributeError):
+        return str(Path.home() / ".cache" / "chroma" / "onnx_models" / "all-MiniLM-L6-v2" / "onnx")
+
+
+def _quantized_model(source: str) -> str:
+    """Return an int8 copy of the model next to it, creating it on first use."""
+    target = os.path.join(os.path.dirname(source), "model_int8.onnx")
+    if not os.path.exists(target):
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        logger.info(f"Quantizing {source} to int8...")
+        quantize_dynamic(source, f"{target}.tmp", weight_type=QuantType.QInt8)
+        os.replace(f"{target}.tmp", target)
+    return target
+
+
+class _DefaultModel:
+    """ChromaDB's built-in embedding function."""
+    name = "default"
+    vector_id = EMBEDDING_MODEL_ID
+
+    def __init__(self):
+        from chromadb.utils import embedding_functions
+        self._function = embedding_functions.DefaultEmbeddingFunction()
+
+    def __call__(self, texts: List[str]) -> np.ndarray:
+        return np.asarray(self._function(texts), dtype=np.float32)
+
+
+class _OnnxMiniLM:
+    """all-MiniLM-L6-v2 on ONNX Runtime, pooled and normalized the way ChromaDB's default function does it."""
+
+    def __init__(self, model_path: str, precision: str, threads: int):
+        import onnxruntime
+        from tokenizers import Tokenizer
+
+        model_dir = _default_model_dir()
+        if not model_path:
+            model_path = os.path.join(model_dir, "model.onnx")
+            if not os.path.exists(model_path):
+                # Let ChromaDB download the model files
+                _DefaultModel()(["download"])
+            if precision == "int8":
+                try:
+                    model_path = _quantized_model(model_path)
+                except ImportError:
+                    precision = "fp32"
+                    logger.warning("The onnx package is needed to quantize the embedding model; using fp32")
+        self.name = f"onnx-{precision}"
+        # int8 vectors differ slightly from fp32 ones; the fp32 model computes the default function's vectors
+        self.vector_id = f"{EMBEDDING_MODEL_ID}-int8" if precision == "int8" else EMBEDDING_MODEL_ID
+
+        self.tokenizer = Tokenizer.from_file(os.path.join(model_dir, "tokenizer.json"))
+        self.tokenizer.enable_truncation(max_length=_MAX_TOKENS)
+        # Pad to the longest text of the batch instead of always to 256 tokens
+        self.tokenizer.enable_padding(pad_id=0, pad_token="[PAD]")
+
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = threads
+        options.inter_op_num_threads = 1
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.log_severity_level = 3
+        self.session = onnxruntime.InferenceSession(model_path, sess_options=options, providers=["CPUExecutionProvider"])
+        self.input_names = {i.name for i in self.session.get_inputs()}
+
+    def __call__(self, texts: List[str]) -> np.ndarray:
+        encoded = self.tokenizer.encode_batch(texts)
+        input_ids = np.asarray([e.ids for e in encoded], dtype=np.int64)
+        attention_mask = np.asarray([e.attention_mask for e in encoded], dtype=np.int64)
+        inputs = {"input_ids": input_ids, "attention_mask": attention_mask}
+        if "token_type_ids" in self.input_names:
+            inputs["token_type_ids"] = np.zeros_like(input_ids)
+        hidden = self.session.run(None, inputs)[0]
+
+        # Mean over the real (unpadded) tokens, then L2 normalization
+        mask = attention_mask[:, :, None].astype(np.float32)
+        pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        return (pooled / np.maximum(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12)).astype(np.float32)
+
+
+class _Request:
+    __slots__ = ("texts", "done", "result", "error")
+
+    def __init__(self, texts: List[str]):
+        self.texts = texts
+        self.done = threading.Event()
+        self.result: Optional[np.ndarray] = None
+        self.error: Optional[BaseException] = None
+
+
+class EmbeddingEngine:
+    def __init__(self, engine: str = EMBEDDING_ENGINE, precision: str = EMBEDDING_PRECISION,
+                 model_path: str = EMBEDDING_ONNX_MODEL, threads: int = EMBEDDING_THREADS,
+                 max_batch: int = EMBEDDING_MAX_BATCH, batch_window_ms: float = EMBEDDING_BATCH_WINDOW_MS):
+        """Configure the engine; the model is loaded on first use (or by warm_up())."""
+        self.engine = engine
+        self.precision = precision
+        self.model_path = model_path
+        self.threads = max(threads, 1)
+        self.max_batch = max(max_batch, 1)
+        self.batch_window = max(batch_window_ms, 0.0) / 1000
+        self._model = None
+        self._model_lock = threading.Lock()
+
+        # Small calls waiting to be embedded together by the batching thread
+        self._pending: List[_Request] = []
+        self._pending_cond = threading.Condition()
+        self._batcher: Optional[threading.Thread] = None
+
+    def _get_model(self):
+        if self._model is None:
+            with self._model_lock:
+                if self._model is None:
+                    started = time.perf_counter()
+                    if self.engine == "onnx":
+                        try:
+                            self._model = _OnnxMiniLM(self.model_path, self.precision, self.threads)
+                        except ImportError as e:
+                            logger.warning(f"ONNX Runtime is not available ({str(e)}); using the default embedding function")
+                    if self._model is None:
+                        self._model = _DefaultModel()
+                    logger.info(f"Loaded {self._model.name} embedding model in {time.perf_counter() - started:.2f}s")
+        return self._model
+
+    @property
+    def name(self) -> str:
+        return self._get_model().name
+
+    @property
+    def vector_id(self) -> str:
+        """
+        Identifies the vector space of the model that actually loaded (which may be a
+        fallback from the configured one); vectors with different ids must not be mixed.
+        """
+        return self._get_model().vector_id
+
+    def __call__(self, input: Sequence[str]) -> np.ndarray:
+        """Embed texts (ChromaDB embedding function signature); returns one normalized float32 row per text."""
+        texts = list(input)
+        if not texts:
+            return np.zeros((0, 0), dtype=np.float32)
+        if self.batch_window <= 0 or len(texts) >= self.max_batch:
+            return self._embed(texts)
+        return self._submit(texts)
+
+    def _embed(self, texts: List[str]) -> np.ndarray:
+        """Run the model over texts in batches of max_batch, grouping texts of similar length."""
+        model = self._get_model()
+        started = time.perf_counter()
+        order = np.argsort([len(t) for t in texts], kind="stable")
+        vectors = None
+        for start in range(0, len(texts), self.max_batch):
+            rows = order[start:start + self.max_batch]
+            batch = model([texts[i] for i in rows])
+            if vectors is None:
+                vectors = np.empty((len(texts), batch.shape[1]), dtype=np.float32)
+            vectors[rows] = batch
+            metrics.observe("embedding_batch_size", len(rows))
+        metrics.increment("embedding_texts_total", len(texts))
+        metrics.observe("embedding_seconds", time.perf_counter() - started)
+        return vectors
+
+    def _submit(self, texts: List[str]) -> np.ndarray:
+        """Hand a small call to the batching thread and wait for its rows."""
+        request = _Request(texts)
+        with self._pending_cond:
+            if self._batcher is None:
+                self._batcher = threading.Thread(target=self._run_batcher, name="embedding-batcher", daemon=True)
+                self._batcher.start()
+            self._pending.append(request)
+            self._pending_cond.notify()
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def _run_batcher(self):
+        while True:
+            with self._pending_cond:
+                while not self._pending:
+                    self._pending_cond.wait()
+                # Give concurrent callers the batch window to join, unless the batch is already full
+                deadline = time.monotonic() + self.batch_window
+                while sum(len(r.texts) for r in self._pending) < self.max_batch:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._pending_cond.wait(remaining)
+                batch: List[_Request] = []
+                size = 0
+                while self._pending and (not batch or size + len(self._pending[0].texts) <= self.max_batch):
+                    request = self._pending.pop(0)
+                    batch.append(request)
+                    size += len(request.texts)
+
+            metrics.observe("embedding_coalesced_calls", len(batch))
+            try:
+                vectors = self._embed([text for request in batch for text in request.texts])
+                offset = 0
+                for request in batch:
+                    request.result = vectors[offset:offset + len(request.texts)]
+                    offset += len(request.texts)
+            except Exception as e:
+                for request in batch:
+                    request.error = e
+            for request in batch:
+                request.done.set()
+
+    def warm_up(self):
+        """Load the model and run one inference, so the first request does not pay for either."""
+        started = time.perf_counter()
+        self._embed(["warm up"])
+        logger.info(f"Embedding engine ({self.name}, {self.threads} threads) warmed up in {time.perf_counter() - started:.2f}s")
+
+
+# Create a singleton instance
+embedding_engine = EmbeddingEngine()
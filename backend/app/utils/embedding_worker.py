@@ -0,0 +1,77 @@
+"""
+Embedding functions for worker processes.
+Only imports the embedding engine, so spawned processes do not open ChromaDB or the database.
+"""
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional, Sequence
+import numpy as np
+
+_embedding_function = None
+
+
+def _init_worker(threads: Optional[int] = None):
+    global _embedding_function
+    from app.utils.embedding_engine import EmbeddingEngine
+    # Worker calls are already large batches, so the dynamic batching window is not needed
+    options = {"threads": threads} if threads else {}
+    _embedding_function = EmbeddingEngine(batch_window_ms=0, **options)
+
+
+def _embed_batch(texts: List[str]) -> np.ndarray:
+    return np.asarray(_embedding_function(texts), dtype=np.float32)
+
+
+class EmbeddingPool:
+    def __init__(self, workers: int, batch_size: int, fallback: Optional[callable] = None):
+        """
+        Worker processes that embed texts in batches of batch_size, kept for the
+        whole job. Use as a context manager: the processes are spawned on the first
+        call that needs them (so a fully cached run starts none) and reused by
+        every later call, instead of loading the model again for each call.
+        With one worker (or a single batch) the fallback embedding function is
+        used in-process.
+        """
+        self.workers = workers
+        self.batch_size = batch_size
+        self.fallback = fallback
+        self._executor: Optional[ProcessPoolExecutor] = None
+
+    def embed(self, texts: Sequence[str]) -> np.ndarray:
+        texts = list(texts)
+        batches = [texts[i:i + self.batch_size] for i in range(0, len(texts), self.batch_size)]
+        if not batches:
+            return np.zeros((0, 0), dtype=np.float32)
+        if self.workers <= 1 or len(batches) <= 1:
+            fallback = self.fallback
+            if fallback is None:
+                if _embedding_function is None:
+                    _init_worker()
+                fallback = _embedding_function
+            return np.concatenate([np.asarray(fallback(batch), dtype=np.float32) for batch in batches])
+        return np.concatenate(list(self._get_executor().map(_embed_batch, batches)))
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            # Split the cores between the workers instead of every worker using all of them
+            threads = max((os.cpu_count() or 1) // self.workers, 1)
+            # Spawn rather than fork: forking the threaded server process can deadlock the children
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+                initargs=(threads,)
+            )
+        return self._executor
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def __enter__(self) -> "EmbeddingPool":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
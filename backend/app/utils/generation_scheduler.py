@@ -0,0 +1,123 @@
+"""Admission control for LLM generations: a concurrency cap with a bounded, per-user fair queue."""
+import asyncio
+import math
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import Any, Deque, Optional
+from app.config.llm_config import (
+    GENERATION_MAX_CONCURRENT,
+    GENERATION_MAX_QUEUE,
+    GENERATION_QUEUE_TIMEOUT,
+)
+from app.utils.metrics import metrics
+
+
+class SchedulerBusyError(Exception):
+    """Raised when a generation cannot be admitted; retry_after is a hint in seconds."""
+
+    def __init__(self, detail: str, retry_after: int):
+        super().__init__(detail)
+        self.retry_after = retry_after
+
+
+class GenerationScheduler:
+    def __init__(self, max_concurrent: int = GENERATION_MAX_CONCURRENT,
+                 max_queue: int = GENERATION_MAX_QUEUE,
+                 queue_timeout: float = GENERATION_QUEUE_TIMEOUT):
+        """
+        At most max_concurrent generations run at once. Up to max_queue more wait,
+        and waiting requests are admitted round-robin across users so one user
+        with many requests cannot starve the others.
+        """
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self._active = 0
+        self._queued = 0
+        # user key -> FIFO of waiting futures; dict order is the round-robin order
+        self._waiting: "OrderedDict[Any, Deque[asyncio.Future]]" = OrderedDict()
+
+    def _update_gauges(self):
+        metrics.set_gauge("generation_active", self._active)
+        metrics.set_gauge("generation_queue_depth", self._queued)
+
+    def retry_after(self) -> int:
+        """Rough number of seconds until a slot frees up for a new request."""
+        hold = metrics.average("generation_slot_seconds", default=5.0)
+        return max(1, math.ceil(hold * (self._queued + 1) / max(self.max_concurrent, 1)))
+
+    async def acquire(self, user_id: Any):
+        """Wait for a generation slot, or raise SchedulerBusyError if the queue is full or the wait times out."""
+        started = time.monotonic()
+        if self._active < self.max_concurrent and not self._queued:
+            self._active += 1
+            self._update_gauges()
+            metrics.observe("generation_queue_wait_seconds", 0.0)
+            return
+
+        if self._queued >= self.max_queue:
+            metrics.increment("generation_rejected_total")
+            raise SchedulerBusyError("Too many requests are waiting for the AI service. Please try again shortly.", self.retry_after())
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiting.setdefault(user_id, deque()).append(waiter)
+        self._queued += 1
+        self._update_gauges()
+
+        try:
+            await asyncio.wait_for(waiter, self.queue_timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if waiter.done() and not waiter.cancelled():
+                # A slot was handed over at the same moment we gave up; pass it on
+                self.release()
+            else:
+                self._remove(user_id, waiter)
+            if isinstance(e, asyncio.TimeoutError):
+                metrics.increment("generation_timed_out_total")
+                raise SchedulerBusyError("Timed out waiting for the AI service. Please try again shortly.", self.retry_after())
+            raise
+        metrics.observe("generation_queue_wait_seconds", time.monotonic() - started)
+
+    def _remove(self, user_id: Any, waiter: asyncio.Future):
+        queue = self._waiting.get(user_id)
+        if queue and waiter in queue:
+            queue.remove(waiter)
+            self._queued -= 1
+            if not queue:
+                del self._waiting[user_id]
+            self._update_gauges()
+
+    def release(self, held_since: Optional[float] = None):
+        """Free a slot and hand it to the next user in round-robin order."""
+        if held_since is not None:
+            metrics.observe("generation_slot_seconds", time.monotonic() - held_since)
+        self._active -= 1
+        while self._waiting:
+            user_id, queue = next(iter(self._waiting.items()))
+            waiter = queue.popleft()
+            self._queued -= 1
+            # Move this user to the back of the rotation
+            del self._waiting[user_id]
+            if queue:
+                self._waiting[user_id] = queue
+            if waiter.done():
+                continue
+            self._active += 1
+            waiter.set_result(None)
+            break
+        self._update_gauges()
+
+    @asynccontextmanager
+    async def slot(self, user_id: Any):
+        """Hold a generation slot for the duration of the block."""
+        await self.acquire(user_id)
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.release(held_since=started)
+
+
+# Create a singleton instance
+generation_scheduler = GenerationScheduler()
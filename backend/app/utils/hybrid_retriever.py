@@ -0,0 +1,128 @@
+"""Hybrid knowledge retrieval: BM25 and exact code matches fused with vector results by reciprocal rank fusion."""
+import glob
+import logging
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional, Sequence
+from app.config.retrieval_config import RRF_K
+from app.utils.chroma_db import chroma_db, split_chat_document
+from app.utils.lexical_index import LexicalIndex
+from app.utils.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+_INDEX_SUFFIX = ".lexical.json"
+
+
+class HybridRetriever:
+    def __init__(self, db=chroma_db):
+        """The lexical index follows the live knowledge collection version and is loaded on first use."""
+        self.db = db
+        self._index: Optional[LexicalIndex] = None
+        self._index_name: Optional[str] = None
+        self._lock = threading.Lock()
+
+    def index_path(self, collection_name: str) -> str:
+        return os.path.join(self.db.persist_directory, f"{collection_name}{_INDEX_SUFFIX}")
+
+    def build_index(self, collection_name: str, ids: Sequence[str], texts: Sequence[str],
+                    documents: Sequence[str]) -> LexicalIndex:
+        """Build and save the lexical index of a knowledge collection version (called during ingestion)."""
+        index = LexicalIndex(ids, texts, documents)
+        index.save(self.index_path(collection_name))
+        logger.info(f"Built lexical index for '{collection_name}': {len(index)} documents, {len(index.codes)} codes")
+
+        # Indexes of collection versions that no longer exist are not needed
+        live = set(self.db._collection_names())
+        for path in glob.glob(os.path.join(self.db.persist_directory, f"*{_INDEX_SUFFIX}")):
+            if os.path.basename(path)[:-len(_INDEX_SUFFIX)] not in live:
+                os.remove(path)
+        return index
+
+    def _current_index(self) -> Optional[LexicalIndex]:
+        """The index of the live knowledge collection, reloaded after a version swap or rollback."""
+        name = self.db.knowledge_collection.name
+        if name == self._index_name:
+            return self._index
+        with self._lock:
+            if name != self._index_name:
+                self._index = self._load_index(name)
+                self._index_name = name
+            return self._index
+
+    def _load_index(self, name: str) -> Optional[LexicalIndex]:
+        path = self.index_path(name)
+        try:
+            return LexicalIndex.load(path)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError) as e:
+            logger.error(f"Could not load lexical index {path}: {str(e)}")
+
+        # Knowledge ingested before lexical indexing existed: index the stored documents once
+        try:
+            ids, documents = [], []
+            for page_ids, page_documents in self.db.iter_knowledge():
+                ids.extend(page_ids)
+                documents.extend(page_documents)
+        except Exception as e:
+            logger.error(f"Could not read the knowledge collection for lexical indexing: {str(e)}")
+            return None
+        if not ids:
+            return None
+        return self.build_index(name, ids, [split_chat_document(d)[0] for d in documents], documents)
+
+    def exact_matches(self, query: str) -> List[str]:
+        """Ids of knowledge documents containing a transaction or message code from the query."""
+        index = self._current_index()
+        if index is None:
+            return []
+        return [index.ids[i] for i in index.match_codes(query)]
+
+    def fuse(self, query: str, vector_candidates: List[Dict[str, Any]], limit: int) -> List[Dict[str, Any]]:
+        """
+        Merge exact code matches, BM25 results and vector results with reciprocal
+        rank fusion. Returns up to limit candidates in the query_context() format,
+        best first; exact code matches are flagged so the distance cut-off keeps them.
+        """
+        index = self._current_index()
+        if index is None or not len(index):
+            return vector_candidates
+
+        started = time.perf_counter()
+        exact = index.match_codes(query)
+        lexical = [i for i, _ in index.search(query, limit)]
+        metrics.observe("lexical_search_seconds", time.perf_counter() - started)
+        if exact:
+            metrics.increment("knowledge_exact_match_queries_total")
+
+        rankings = [
+            [index.ids[i] for i in exact],
+            [index.ids[i] for i in lexical],
+            [c["id"] for c in vector_candidates],
+        ]
+        scores: Dict[str, float] = {}
+        for ranking in rankings:
+            for rank, doc_id in enumerate(ranking):
+                scores[doc_id] = scores.get(doc_id, 0.0) + 1.0 / (RRF_K + rank + 1)
+        fused = sorted(scores, key=scores.get, reverse=True)[:limit]
+
+        # Lexical-only matches still need a distance and embedding for the context selector
+        by_id = {c["id"]: c for c in vector_candidates}
+        missing = [doc_id for doc_id in fused if doc_id not in by_id]
+        by_id.update({c["id"]: c for c in self.db.get_knowledge(missing, query)})
+        lexical_documents = {index.ids[i]: index.documents[i] for i in exact + lexical}
+        exact_ids = set(rankings[0])
+
+        results = []
+        for doc_id in fused:
+            candidate = by_id.get(doc_id) or {
+                "id": doc_id, "document": lexical_documents[doc_id], "distance": 1.0, "embedding": None
+            }
+            results.append({**candidate, "exact": doc_id in exact_ids, "rrf_score": scores[doc_id]})
+        return results
+
+
+# Create a singleton instance
+hybrid_retriever = HybridRetriever()
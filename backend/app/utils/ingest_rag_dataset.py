@@ -2,24 +2,72 @@
 RAG dataset ingestion utility for ChromaDB.
 Allows ingestion of any CSV dataset for domain-specific Q&A.
 """
+import hashlib
+import numpy as np
 import pandas as pd
-from app.utils.chroma_db import chroma_db
-from app.config.dataset_config import DATASET_PATH
+from app.utils.chroma_db import chroma_db, chat_document, collection_name
+from app.utils.embedding_cache import embedding_cache
+from app.utils.embedding_worker import EmbeddingPool
+from app.utils.hybrid_retriever import hybrid_retriever
+from app.config.dataset_config import DATASET_PATH, RAG_CHUNK_SIZE, RAG_EMBED_BATCH_SIZE, RAG_EMBED_WORKERS
 import logging
 import os
+import time
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-def chunk_text(text, chunk_size=300):
+def chunk_text(text, chunk_size=RAG_CHUNK_SIZE):
     """Split text into chunks of approximately chunk_size characters."""
     return [text[i:i+chunk_size] for i in range(0, len(text), chunk_size)]
 
-def ingest_dataset_to_chromadb(dataset_path=None):
+def prepare_chunks(df: pd.DataFrame, chunk_size: int = RAG_CHUNK_SIZE) -> pd.DataFrame:
+    """
+    Chunk every issue and collapse identical (chunk, response) pairs.
+    Returns one row per unique document with the CSV rows it came from.
+    """
+    rows = pd.DataFrame({
+        "row": df.index,
+        "issue": df["issue/query"].astype(str),
+        "response": df["response"].astype(str),
+        "category": df["category"].astype(str) if "category" in df.columns else "",
+    })
+    # Same slicing as chunk_text(), done by the regex engine for the whole column
+    rows["chunk"] = rows["issue"].str.findall(f"(?s).{{1,{chunk_size}}}")
+    chunks = rows.explode("chunk").dropna(subset=["chunk"])
+
+    unique = chunks.groupby(["chunk", "response"], sort=False).agg(
+        rows=("row", lambda r: ",".join(map(str, pd.unique(r)))),
+        row_count=("row", "nunique"),
+        category=("category", lambda c: c.mode().iat[0]),
+    ).reset_index()
+    unique["document"] = [chat_document(c, r) for c, r in zip(unique["chunk"], unique["response"])]
+    unique["id"] = ["rag_" + hashlib.sha256(d.encode("utf-8")).hexdigest()[:32] for d in unique["document"]]
+    unique.attrs["total_chunks"] = len(chunks)
+    return unique
+
+def dataset_fingerprint(path: str, chunk_size: int = RAG_CHUNK_SIZE) -> str:
+    """Identify a dataset file's contents (and chunking), so a checkpoint is only reused for the same input."""
+    digest = hashlib.sha256(f"{chunk_size}\0".encode("utf-8"))
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def ingest_dataset_to_chromadb(dataset_path=None, job=None):
     """
     Ingests a CSV dataset into ChromaDB for RAG.
-    Each row is chunked and embedded for retrieval.
+    Each row is chunked, identical chunks are embedded once, and the embeddings
+    are computed in large batches across worker processes. The result is built
+    into a new collection version that replaces the live one only when complete,
+    together with the BM25 and transaction-code index of its issue texts.
+
+    When run as a background job, progress is reported after every committed
+    batch, cancellation is checked between batches and a checkpoint is saved, so
+    an interrupted job continues from the last committed batch.
+    Returns a throughput report on success and False on failure or cancellation.
     """
+    started = time.perf_counter()
     path = dataset_path or DATASET_PATH
     if not os.path.exists(path):
         logger.error(f"Dataset file not found: {path}")
@@ -29,25 +77,105 @@ def ingest_dataset_to_chromadb(dataset_path=None):
     if not required_cols.issubset(df.columns):
         logger.error(f"Dataset must contain columns: {required_cols}")
         return False
-    chroma_db.reset_collection()
-    batch = []
-    for idx, row in df.iterrows():
-        issue = str(row['issue/query'])
-        response = str(row['response'])
-        for chunk in chunk_text(issue):
-            batch.append({
-                'user_id': 'rag',
-                'session_id': 'rag',
-                'message': chunk,
-                'response': response
-            })
-        if len(batch) >= 100:
-            chroma_db.batch_add_chats(batch)
-            batch = []
-    if batch:
-        chroma_db.batch_add_chats(batch)
-    logger.info(f"Ingested dataset from {path} into ChromaDB.")
-    return True
+
+    unique = prepare_chunks(df)
+    total_chunks = unique.attrs["total_chunks"]
+    documents = unique["document"].tolist()
+    ids = unique["id"].tolist()
+    metadatas = [
+        {"user_id": "rag", "session_id": "rag", "type": "rag", "category": category, "rows": rows, "row_count": int(count)}
+        for category, rows, count in zip(unique["category"], unique["rows"], unique["row_count"])
+    ]
+    prepared = time.perf_counter()
+
+    # Resume the collection build of an interrupted run of the same dataset
+    checkpoint = job.checkpoint if job is not None else None
+    resume_version = checkpoint["version"] if checkpoint and checkpoint["version"] == chroma_db.next_version() else None
+    committed = checkpoint["committed"] if resume_version is not None else 0
+    if committed:
+        logger.info(f"Resuming ingestion of {path} at document {committed} of {len(documents)}")
+
+    # CSV rows count as processed once every unique chunk they map to is committed
+    remaining = np.zeros(len(df), dtype=np.int32)
+    doc_rows = [np.fromiter(map(int, rows.split(",")), dtype=np.int64) for rows in unique["rows"]]
+    for rows in doc_rows:
+        np.add.at(remaining, rows, 1)
+    for rows in doc_rows[:committed]:
+        np.subtract.at(remaining, rows, 1)
+
+    # Build the new knowledge base next to the live one and swap it in when complete
+    staging = chroma_db.begin_build(resume_version)
+    embed_seconds = 0.0
+    batch_size = RAG_EMBED_BATCH_SIZE * max(RAG_EMBED_WORKERS, 1)
+    # One set of worker processes for the whole job, so the model is loaded once per worker
+    pool = EmbeddingPool(RAG_EMBED_WORKERS, RAG_EMBED_BATCH_SIZE, fallback=chroma_db.embedder)
+    try:
+        if job is not None:
+            job.update_progress(len(df), int((remaining == 0).sum()), len(documents), committed)
+
+        while committed < len(documents):
+            if job is not None and job.cancelled:
+                chroma_db.abort_build()
+                logger.info(f"Ingestion of {path} cancelled at document {committed} of {len(documents)}")
+                return False
+
+            end = min(committed + batch_size, len(documents))
+            # Only texts missing from the persistent cache reach the worker processes
+            batch_started = time.perf_counter()
+            embeddings = embedding_cache.embed(documents[committed:end], pool.embed)
+            embed_seconds += time.perf_counter() - batch_started
+            chroma_db.upsert_documents(
+                ids=ids[committed:end],
+                documents=documents[committed:end],
+                metadatas=metadatas[committed:end],
+                embeddings=embeddings,
+                collection=staging
+            )
+            for rows in doc_rows[committed:end]:
+                np.subtract.at(remaining, rows, 1)
+            committed = end
+            if job is not None:
+                job.save_checkpoint({"version": chroma_db.building_version, "committed": committed})
+                job.update_progress(len(df), int((remaining == 0).sum()), len(documents), committed)
+
+        # Lexical index for exact tokens (T-codes, error codes) that embeddings match poorly
+        hybrid_retriever.build_index(collection_name(chroma_db.building_version), ids, unique["chunk"].tolist(), documents)
+        # Category centroids for query routing (and the numpy index, with that backend)
+        chroma_db.build_knowledge_indexes(staging)
+        chroma_db.commit_build()
+    except Exception as e:
+        logger.error(f"Failed to build the new collection version: {str(e)}")
+        if job is not None:
+            # Keep the partial collection so the job can resume from its checkpoint
+            chroma_db.suspend_build()
+        else:
+            chroma_db.abort_build()
+        return False
+    finally:
+        pool.close()
+    # Cached answers were generated from the previous knowledge base
+    chroma_db.clear_answer_cache()
+    finished = time.perf_counter()
+
+    elapsed = max(finished - started, 1e-9)
+    report = {
+        "collection_version": chroma_db.collection_version()["live_version"],
+        "rows": len(df),
+        "chunks": total_chunks,
+        "unique_chunks": len(unique),
+        "seconds": round(elapsed, 3),
+        "prepare_seconds": round(prepared - started, 3),
+        "embed_seconds": round(embed_seconds, 3),
+        "insert_seconds": round(finished - prepared - embed_seconds, 3),
+        "rows_per_second": round(len(df) / elapsed, 1),
+        "chunks_per_second": round(total_chunks / elapsed, 1),
+    }
+    logger.info(
+        f"Ingested dataset from {path} into ChromaDB: {report['rows']} rows, {report['chunks']} chunks "
+        f"({report['unique_chunks']} unique) in {report['seconds']}s - "
+        f"{report['rows_per_second']} rows/s, {report['chunks_per_second']} chunks/s"
+    )
+    return report
 
 if __name__ == "__main__":
     ingest_dataset_to_chromadb()
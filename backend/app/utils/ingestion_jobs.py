@@ -0,0 +1,223 @@
+"""Background RAG ingestion jobs with progress, cancellation and checkpoint/resume."""
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from typing import Any, Dict, List, Optional
+from app.config.dataset_config import INGEST_JOBS_DIR
+from app.utils.ingest_rag_dataset import ingest_dataset_to_chromadb, dataset_fingerprint
+
+logger = logging.getLogger(__name__)
+
+FINISHED_STATUSES = ("completed", "cancelled")
+
+
+class IngestionJob:
+    def __init__(self, job_id: str, dataset_path: str, fingerprint: str, manager: "IngestionJobManager"):
+        self.id = job_id
+        self.dataset_path = dataset_path
+        self.fingerprint = fingerprint
+        self.status = "queued"
+        self.error: Optional[str] = None
+        self.report: Optional[Dict[str, Any]] = None
+        self.checkpoint: Optional[Dict[str, Any]] = None
+        self.rows_total = 0
+        self.rows_processed = 0
+        self.chunks_total = 0
+        self.chunks_processed = 0
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self._resumed_from: Optional[int] = None
+        self._cancel = threading.Event()
+        self._manager = manager
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancel.is_set()
+
+    def cancel(self):
+        self._cancel.set()
+
+    def update_progress(self, rows_total: int, rows_processed: int, chunks_total: int, chunks_processed: int):
+        """Called by the ingestion pipeline after every committed batch."""
+        if self._resumed_from is None:
+            # The first report of a run says where it started
+            self._resumed_from = chunks_processed
+        self.rows_total = rows_total
+        self.rows_processed = rows_processed
+        self.chunks_total = chunks_total
+        self.chunks_processed = chunks_processed
+        self._manager.save(self)
+
+    def save_checkpoint(self, checkpoint: Dict[str, Any]):
+        """Record the last committed batch; written before the progress update."""
+        self.checkpoint = checkpoint
+        self._manager.save(self)
+
+    def status_dict(self) -> Dict[str, Any]:
+        elapsed = ((self.finished_at or time.time()) - self.started_at) if self.started_at else 0.0
+        # Throughput and ETA only count the work done by this run, not before a resume
+        done_this_run = self.chunks_processed - (self._resumed_from or 0)
+        chunks_per_second = done_this_run / elapsed if elapsed > 0 else 0.0
+        remaining = self.chunks_total - self.chunks_processed
+        eta = remaining / chunks_per_second if self.status == "running" and chunks_per_second > 0 else None
+        return {
+            "job_id": self.id,
+            "dataset_path": self.dataset_path,
+            "status": self.status,
+            "rows_total": self.rows_total,
+            "rows_processed": self.rows_processed,
+            "chunks_total": self.chunks_total,
+            "chunks_processed": self.chunks_processed,
+            "progress": round(self.chunks_processed / self.chunks_total, 4) if self.chunks_total else 0.0,
+            "chunks_per_second": round(chunks_per_second, 1),
+            "rows_per_second": round(self.rows_processed / elapsed, 1) if elapsed > 0 else 0.0,
+            "eta_seconds": round(eta, 1) if eta is not None else None,
+            "resumable": self.status in ("failed", "interrupted") and self.checkpoint is not None,
+            "error": self.error,
+            "report": self.report,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+    def to_state(self) -> Dict[str, Any]:
+        state = self.status_dict()
+        state["fingerprint"] = self.fingerprint
+        state["checkpoint"] = self.checkpoint
+        return state
+
+
+class IngestionJobManager:
+    def __init__(self, jobs_dir: str = INGEST_JOBS_DIR):
+        """
+        Run one ingestion at a time in a background thread.
+        Job state is written to jobs_dir after every batch; jobs that were running
+        when the process stopped are loaded as "interrupted" and can be resumed.
+        """
+        self.jobs_dir = jobs_dir
+        self._jobs: Dict[str, IngestionJob] = {}
+        self._lock = threading.Lock()
+        self._running: Optional[IngestionJob] = None
+        os.makedirs(jobs_dir, exist_ok=True)
+        self._load()
+
+    def _path(self, job_id: str) -> str:
+        return os.path.join(self.jobs_dir, f"{job_id}.json")
+
+    def _load(self):
+        for name in os.listdir(self.jobs_dir):
+            if not name.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(self.jobs_dir, name)) as f:
+                    state = json.load(f)
+            except (OSError, ValueError) as e:
+                logger.warning(f"Skipping unreadable ingestion job file {name}: {str(e)}")
+                continue
+            job = IngestionJob(state["job_id"], state["dataset_path"], state["fingerprint"], self)
+            job.status = "interrupted" if state["status"] in ("queued", "running") else state["status"]
+            for field in ("error", "report", "checkpoint", "rows_total", "rows_processed", "chunks_total",
+                          "chunks_processed", "created_at", "started_at", "finished_at"):
+                setattr(job, field, state.get(field))
+            self._jobs[job.id] = job
+
+    def save(self, job: IngestionJob):
+        tmp_path = f"{self._path(job.id)}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(job.to_state(), f)
+        os.replace(tmp_path, self._path(job.id))
+
+    def get(self, job_id: str) -> Optional[IngestionJob]:
+        return self._jobs.get(job_id)
+
+    def list(self) -> List[Dict[str, Any]]:
+        return [job.status_dict() for job in sorted(self._jobs.values(), key=lambda j: j.created_at, reverse=True)]
+
+    def start(self, dataset_path: str) -> IngestionJob:
+        """
+        Start ingesting dataset_path. If an interrupted or failed job for the same
+        file contents has a checkpoint, that job is resumed instead of starting over.
+        Raises RuntimeError if another job is running.
+        """
+        fingerprint = dataset_fingerprint(dataset_path)
+        with self._lock:
+            if self._running is not None:
+                raise RuntimeError(f"Ingestion job {self._running.id} is already running")
+            job = next((j for j in self._jobs.values()
+                        if j.fingerprint == fingerprint and j.status in ("failed", "interrupted") and j.checkpoint), None)
+            if job is None:
+                job = IngestionJob(uuid.uuid4().hex, dataset_path, fingerprint, self)
+                self._jobs[job.id] = job
+            self._launch(job)
+        return job
+
+    def resume(self, job_id: str) -> IngestionJob:
+        """Resume a failed or interrupted job from its last checkpoint."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                raise KeyError(job_id)
+            if job.status not in ("failed", "interrupted"):
+                raise RuntimeError(f"Ingestion job {job_id} is {job.status} and cannot be resumed")
+            if self._running is not None:
+                raise RuntimeError(f"Ingestion job {self._running.id} is already running")
+            if dataset_fingerprint(job.dataset_path) != job.fingerprint:
+                # The file changed; its checkpoint no longer matches the documents
+                job.checkpoint = None
+            self._launch(job)
+        return job
+
+    def cancel(self, job_id: str) -> IngestionJob:
+        job = self._jobs.get(job_id)
+        if job is None:
+            raise KeyError(job_id)
+        if job.status in ("queued", "running"):
+            job.cancel()
+        elif job.status in ("failed", "interrupted"):
+            # Nothing is running; just discard the checkpoint
+            job.status = "cancelled"
+            job.checkpoint = None
+            self.save(job)
+        return job
+
+    def _launch(self, job: IngestionJob):
+        job.status = "running"
+        job.error = None
+        job.started_at = time.time()
+        job.finished_at = None
+        job._resumed_from = None
+        job._cancel.clear()
+        self._running = job
+        self.save(job)
+        threading.Thread(target=self._run, args=(job,), name=f"ingest-{job.id}", daemon=True).start()
+
+    def _run(self, job: IngestionJob):
+        try:
+            report = ingest_dataset_to_chromadb(job.dataset_path, job=job)
+            if report:
+                job.status = "completed"
+                job.report = report
+                job.checkpoint = None
+            elif job.cancelled:
+                job.status = "cancelled"
+                job.checkpoint = None
+            else:
+                job.status = "failed"
+                job.error = "Ingestion failed; see the server log"
+        except Exception as e:
+            logger.error(f"Ingestion job {job.id} failed: {str(e)}")
+            job.status = "failed"
+            job.error = str(e)
+        finally:
+            job.finished_at = time.time()
+            with self._lock:
+                self._running = None
+            self.save(job)
+
+
+# Create a singleton instance
+ingestion_jobs = IngestionJobManager()
@@ -0,0 +1,110 @@
+"""In-memory BM25 and exact transaction-code indexes over the RAG knowledge base."""
+import json
+import logging
+import math
+import os
+import re
+from collections import Counter
+from typing import Dict, List, Sequence, Tuple
+import numpy as np
+from app.config.retrieval_config import BM25_K1, BM25_B, TRANSACTION_CODE_ALLOWLIST
+
+logger = logging.getLogger(__name__)
+
+_TOKEN_RE = re.compile(r"[a-z0-9]+(?:_[a-z0-9]+)*")
+_WORD_RE = re.compile(r"[A-Z0-9]+")
+# SAP transaction codes with digits: 1-4 letters, 1-3 digits and an optional letter, at least
+# four characters (VA01, F110, SE16N, FBL1N), which leaves out MP3, S4 or ISO9001
+_CODE_RE = re.compile(r"(?=\w{4})[A-Z]{1,4}\d{1,3}[A-Z]?")
+_STOPWORDS = frozenset(
+    "a an and are as at be by can for from how i in is it my not of on or the this to was what when why with".split()
+)
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercase word tokens for BM25; codes such as se16n stay one token."""
+    return [t for t in _TOKEN_RE.findall(text.lower()) if t not in _STOPWORDS]
+
+
+def extract_codes(text: str) -> List[str]:
+    """
+    Transaction codes in the text, matched case-insensitively: words with the
+    shape of a code and the letter-only codes of TRANSACTION_CODE_ALLOWLIST.
+    """
+    words = _WORD_RE.findall(text.upper())
+    return list(dict.fromkeys(w for w in words if w in TRANSACTION_CODE_ALLOWLIST or _CODE_RE.fullmatch(w)))
+
+
+class LexicalIndex:
+    def __init__(self, ids: Sequence[str], texts: Sequence[str], documents: Sequence[str]):
+        """
+        Index texts (the issue text of each knowledge document) for BM25 scoring
+        and exact code lookup. ids and documents are returned with the matches.
+        """
+        self.ids = list(ids)
+        self.texts = list(texts)
+        self.documents = list(documents)
+
+        tokens = [tokenize(text) for text in self.texts]
+        self.doc_lengths = np.asarray([len(t) for t in tokens], dtype=np.float32)
+        self.avg_length = float(self.doc_lengths.mean()) if len(tokens) else 0.0
+
+        # token -> (document indexes, term frequencies)
+        postings: Dict[str, List[Tuple[int, int]]] = {}
+        for i, doc_tokens in enumerate(tokens):
+            for token, tf in Counter(doc_tokens).items():
+                postings.setdefault(token, []).append((i, tf))
+        n = len(tokens)
+        self.postings = {
+            token: (np.asarray([i for i, _ in rows], dtype=np.int32), np.asarray([tf for _, tf in rows], dtype=np.float32))
+            for token, rows in postings.items()
+        }
+        self.idf = {token: math.log(1 + (n - len(rows) + 0.5) / (len(rows) + 0.5)) for token, rows in postings.items()}
+
+        # code -> document indexes containing it; only codes seen in the dataset can match a query
+        self.codes: Dict[str, List[int]] = {}
+        for i, text in enumerate(self.texts):
+            for code in extract_codes(text):
+                self.codes.setdefault(code, []).append(i)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def search(self, query: str, limit: int) -> List[Tuple[int, float]]:
+        """Return up to limit (document index, BM25 score) pairs, best first."""
+        if not self.ids:
+            return []
+        scores = np.zeros(len(self.ids), dtype=np.float32)
+        norm = BM25_K1 * (1 - BM25_B + BM25_B * self.doc_lengths / max(self.avg_length, 1e-9))
+        for token in set(tokenize(query)):
+            posting = self.postings.get(token)
+            if posting is None:
+                continue
+            docs, tf = posting
+            scores[docs] += self.idf[token] * tf * (BM25_K1 + 1) / (tf + norm[docs])
+
+        matched = np.flatnonzero(scores)
+        if not len(matched):
+            return []
+        top = matched[np.argsort(-scores[matched], kind="stable")[:limit]]
+        return [(int(i), float(scores[i])) for i in top]
+
+    def match_codes(self, query: str) -> List[int]:
+        """Indexes of documents containing a code from the query, those matching the most codes first."""
+        hits = Counter()
+        for code in extract_codes(query):
+            hits.update(self.codes.get(code, ()))
+        return [i for i, _ in sorted(hits.items(), key=lambda item: (-item[1], item[0]))]
+
+    def save(self, path: str):
+        """Write the indexed texts; the postings are rebuilt on load, which takes milliseconds."""
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"ids": self.ids, "texts": self.texts, "documents": self.documents}, f)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> "LexicalIndex":
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        return cls(data["ids"], data["texts"], data["documents"])
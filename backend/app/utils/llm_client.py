@@ -0,0 +1,283 @@
+"""Shared async Ollama client used by the chat and streaming routes."""
+import asyncio
+import httpx
+import json
+import logging
+from typing import AsyncContextManager, AsyncIterator, Callable, List, Optional, Tuple
+from app.config.llm_config import (
+    OLLAMA_BASE_URLS,
+    OLLAMA_MODEL,
+    OLLAMA_CONNECT_TIMEOUT,
+    OLLAMA_READ_TIMEOUT,
+    OLLAMA_MAX_CONNECTIONS,
+    OLLAMA_MAX_KEEPALIVE_CONNECTIONS,
+    OLLAMA_KEEPALIVE_EXPIRY,
+    OLLAMA_HEDGE_AFTER,
+    OLLAMA_API_MODE,
+)
+from app.utils.metrics import metrics
+from app.utils.ollama_pool import OllamaBackend, OllamaPool
+from app.utils.response_cache import response_cache, split_into_chunks
+from app.utils.single_flight import single_flight
+
+logger = logging.getLogger(__name__)
+
+
+class LLMUnavailableError(Exception):
+    """Raised when no Ollama server can be reached."""
+
+
+def _reply_text(data: dict) -> str:
+    """Extract the generated text from an /api/generate or /api/chat response object."""
+    if "message" in data:
+        return (data.get("message") or {}).get("content", "")
+    return data.get("response", "")
+
+
+async def _first_chunk(source: AsyncIterator[str]) -> str:
+    try:
+        return await source.__anext__()
+    except StopAsyncIteration:
+        return ""
+
+
+class LLMClient:
+    def __init__(self, base_urls: Optional[List[str]] = None, model: str = OLLAMA_MODEL,
+                 hedge_after: float = OLLAMA_HEDGE_AFTER, api_mode: str = OLLAMA_API_MODE,
+                 transport: Optional[httpx.AsyncBaseTransport] = None):
+        """
+        Configure the client; the underlying connection pool is created lazily.
+        transport replaces the network (e.g. httpx.MockTransport for fake Ollama servers in tests).
+        """
+        self.pool = OllamaPool(base_urls or OLLAMA_BASE_URLS)
+        self.model = model
+        self.api_mode = api_mode
+        self.hedge_after = hedge_after
+        self.transport = transport
+        self._client: Optional[httpx.AsyncClient] = None
+
+    def _get_client(self) -> httpx.AsyncClient:
+        """Return the pooled httpx client, creating it on first use."""
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                timeout=httpx.Timeout(OLLAMA_READ_TIMEOUT, connect=OLLAMA_CONNECT_TIMEOUT),
+                limits=httpx.Limits(
+                    max_connections=OLLAMA_MAX_CONNECTIONS,
+                    max_keepalive_connections=OLLAMA_MAX_KEEPALIVE_CONNECTIONS,
+                    keepalive_expiry=OLLAMA_KEEPALIVE_EXPIRY,
+                ),
+                transport=self.transport,
+            )
+        return self._client
+
+    def start_health_checks(self):
+        """Start probing the Ollama backends in the background (called on application startup)."""
+        self.pool.start_health_checks(self._get_client())
+
+    def _request(self, prompt: str, messages: Optional[List[dict]], model: str, stream: bool) -> Tuple[str, dict, str]:
+        """
+        Return the Ollama path, JSON body and cache text for a generation.
+        In chat mode, structured messages go to /api/chat so Ollama can reuse the
+        KV cache of the stable conversation prefix; otherwise /api/generate is used.
+        """
+        if messages and self.api_mode == "chat":
+            body = {"model": model, "messages": messages, "stream": stream}
+            return "/api/chat", body, json.dumps(messages, sort_keys=True)
+        return "/api/generate", {"model": model, "prompt": prompt, "stream": stream}, prompt
+
+    def needs_generation(self, prompt: str, model: Optional[str] = None, messages: Optional[List[dict]] = None) -> bool:
+        """
+        False if the reply is cached or an identical generation is already in flight,
+        i.e. the request would not cause any upstream work of its own.
+        """
+        model = model or self.model
+        _, _, cache_text = self._request(prompt, messages, model, True)
+        if response_cache.contains(cache_text, model):
+            return False
+        return not single_flight.in_flight(response_cache.make_key(cache_text, model))
+
+    async def generate(self, prompt: str, model: Optional[str] = None, messages: Optional[List[dict]] = None,
+                       slot: Optional[Callable[[], AsyncContextManager]] = None) -> str:
+        """
+        Run a non-streaming generation and return the full reply text.
+        slot is entered around the upstream request only, so cached replies and
+        callers joining an identical in-flight generation are not admission-controlled.
+        """
+        model = model or self.model
+        path, payload, cache_text = self._request(prompt, messages, model, False)
+        cached = response_cache.get(cache_text, model)
+        if cached is not None:
+            return cached
+
+        async def upstream() -> str:
+            if slot is None:
+                return await self._generate_upstream(path, payload, cache_text, model)
+            async with slot():
+                return await self._generate_upstream(path, payload, cache_text, model)
+
+        # Concurrent identical requests share one upstream generation
+        key = response_cache.make_key(cache_text, model)
+        return await single_flight.do(key, upstream)
+
+    async def _generate_upstream(self, path: str, payload: dict, cache_text: str, model: str) -> str:
+        tried = []
+        while True:
+            backend = self.pool.pick(exclude=tried)
+            if backend is None:
+                raise LLMUnavailableError("No Ollama backend could be reached")
+            tried.append(backend)
+
+            self.pool.acquire(backend)
+            try:
+                response = await self._get_client().post(f"{backend.url}{path}", json=payload)
+                response.raise_for_status()
+                self.pool.record_success(backend)
+                break
+            except (httpx.ConnectError, httpx.ConnectTimeout) as e:
+                # Fail over to the next backend
+                logger.warning(f"Ollama backend {backend.url} unreachable: {str(e)}")
+                self.pool.record_failure(backend)
+            finally:
+                self.pool.release(backend)
+
+        reply = _reply_text(response.json())
+        if not reply:
+            return "No response from model."
+        response_cache.set(cache_text, model, reply)
+        return reply
+
+    async def stream(self, prompt: str, model: Optional[str] = None, messages: Optional[List[dict]] = None) -> AsyncIterator[str]:
+        """Yield reply chunks as Ollama produces them.
+
+        Closing the generator early closes the upstream HTTP response (once no
+        other caller shares it), which tells Ollama to stop generating. Cached
+        replies are replayed in word-sized chunks so callers see the same protocol.
+        """
+        model = model or self.model
+        path, payload, cache_text = self._request(prompt, messages, model, True)
+        cached = response_cache.get(cache_text, model)
+        if cached is not None:
+            for chunk in split_into_chunks(cached):
+                yield chunk
+            return
+
+        # Concurrent identical requests are fanned out from one upstream stream
+        key = response_cache.make_key(cache_text, model)
+        shared = single_flight.stream(key, lambda: self._stream_upstream(path, payload, cache_text, model))
+        try:
+            async for chunk in shared:
+                yield chunk
+        finally:
+            await shared.aclose()
+
+    async def _stream_upstream(self, path: str, payload: dict, cache_text: str, model: str) -> AsyncIterator[str]:
+        source, first = await self._open_stream(path, payload)
+        reply = first
+        try:
+            if first:
+                yield first
+            async for chunk in source:
+                reply += chunk
+                yield chunk
+            # Only complete replies are cached
+            response_cache.set(cache_text, model, reply)
+        finally:
+            await source.aclose()
+
+    async def _open_stream(self, path: str, payload: dict) -> Tuple[AsyncIterator[str], str]:
+        """
+        Start a streaming generation and wait for its first chunk.
+        Unreachable backends are skipped, and when hedging is enabled a second
+        backend is raced against the first if the first token is slow.
+        """
+        tried = []
+        while True:
+            backend = self.pool.pick(exclude=tried)
+            if backend is None:
+                raise LLMUnavailableError("No Ollama backend could be reached")
+            tried.append(backend)
+
+            source = self._stream_from(backend, path, payload)
+            first = asyncio.ensure_future(_first_chunk(source))
+            try:
+                if self.hedge_after > 0:
+                    done, _ = await asyncio.wait({first}, timeout=self.hedge_after)
+                    hedge_backend = self.pool.pick(exclude=tried) if not done else None
+                    if hedge_backend is not None:
+                        tried.append(hedge_backend)
+                        metrics.increment("ollama_hedged_requests_total")
+                        hedge = self._stream_from(hedge_backend, path, payload)
+                        return await self._race({first: source, asyncio.ensure_future(_first_chunk(hedge)): hedge})
+                return source, await first
+            except LLMUnavailableError:
+                await source.aclose()
+                continue
+            except BaseException:
+                first.cancel()
+                await asyncio.gather(first, return_exceptions=True)
+                await source.aclose()
+                raise
+
+    async def _race(self, attempts: dict) -> Tuple[AsyncIterator[str], str]:
+        """Return the stream whose first chunk arrives first and close the others."""
+        error: Optional[BaseException] = None
+        try:
+            while attempts:
+                done, _ = await asyncio.wait(attempts, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    source = attempts.pop(task)
+                    if task.exception() is None:
+                        return source, task.result()
+                    error = task.exception()
+                    await source.aclose()
+        finally:
+            # Cancel the losing attempts; closing their sources closes the upstream requests
+            for task, source in attempts.items():
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+                await source.aclose()
+        raise error
+
+    async def _stream_from(self, backend: OllamaBackend, path: str, payload: dict) -> AsyncIterator[str]:
+        self.pool.acquire(backend)
+        try:
+            async with self._get_client().stream("POST", f"{backend.url}{path}", json=payload) as response:
+                response.raise_for_status()
+                self.pool.record_success(backend)
+                async for line in response.aiter_lines():
+                    if not line:
+                        continue
+                    try:
+                        data = json.loads(line)
+                    except json.JSONDecodeError:
+                        logger.warning(f"Error decoding JSON: {line}")
+                        continue
+                    chunk = _reply_text(data)
+                    if chunk:
+                        yield chunk
+                    if data.get("done"):
+                        break
+        except (httpx.ConnectError, httpx.ConnectTimeout) as e:
+            logger.warning(f"Ollama backend {backend.url} unreachable: {str(e)}")
+            self.pool.record_failure(backend)
+            raise LLMUnavailableError(str(e)) from e
+        finally:
+            self.pool.release(backend)
+
+    async def aclose(self):
+        """Stop health checks and close the pooled connections (called on application shutdown)."""
+        await self.pool.stop_health_checks()
+        if self._client is not None and not self._client.is_closed:
+            await self._client.aclose()
+        self._client = None
+
+
+def clean_reply(reply: str) -> str:
+    """Remove the "AI:" artifact the model sometimes echoes from the prompt."""
+    if reply.startswith("AI:"):
+        return reply[3:].strip()
+    return reply
+
+
+# Create a singleton instance
+llm_client = LLMClient()
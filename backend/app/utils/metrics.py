@@ -0,0 +1,59 @@
+"""In-process counters and timings for the chat pipeline, exposed through GET /metrics."""
+import threading
+from typing import Dict, Any
+
+
+class Metrics:
+    def __init__(self):
+        """Create an empty registry. All methods are safe to call from any thread."""
+        self._lock = threading.Lock()
+        self._counters: Dict[str, float] = {}
+        self._gauges: Dict[str, float] = {}
+        self._timings: Dict[str, Dict[str, float]] = {}
+
+    def increment(self, name: str, value: float = 1):
+        """Add value to a monotonically increasing counter."""
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def set_gauge(self, name: str, value: float):
+        """Record the current value of something that goes up and down (queue depth, ...)."""
+        with self._lock:
+            self._gauges[name] = value
+
+    def observe(self, name: str, value: float):
+        """Record one sample of a duration or size; keeps count, sum, max and last."""
+        with self._lock:
+            timing = self._timings.setdefault(name, {"count": 0, "sum": 0.0, "max": 0.0, "last": 0.0})
+            timing["count"] += 1
+            timing["sum"] += value
+            timing["max"] = max(timing["max"], value)
+            timing["last"] = value
+
+    def average(self, name: str, default: float = 0.0) -> float:
+        """Return the mean of the samples observed for name."""
+        with self._lock:
+            timing = self._timings.get(name)
+            if not timing or not timing["count"]:
+                return default
+            return timing["sum"] / timing["count"]
+
+    def get_counter(self, name: str) -> float:
+        with self._lock:
+            return self._counters.get(name, 0)
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Return a copy of every metric, with averages filled in for timings."""
+        with self._lock:
+            timings = {}
+            for name, timing in self._timings.items():
+                timings[name] = dict(timing, avg=timing["sum"] / timing["count"] if timing["count"] else 0.0)
+            return {
+                "counters": dict(self._counters),
+                "gauges": dict(self._gauges),
+                "timings": timings
+            }
+
+
+# Create a singleton instance
+metrics = Metrics()
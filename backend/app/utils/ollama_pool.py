@@ -0,0 +1,110 @@
+"""Pool of Ollama servers with least-outstanding-requests routing and health checks."""
+import asyncio
+import logging
+import time
+from typing import Dict, Iterable, List, Optional, Any
+import httpx
+from app.config.llm_config import (
+    OLLAMA_HEALTH_CHECK_INTERVAL,
+    OLLAMA_HEALTH_CHECK_TIMEOUT,
+    OLLAMA_EJECT_AFTER_FAILURES,
+)
+from app.utils.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class OllamaBackend:
+    def __init__(self, url: str):
+        self.url = url.rstrip("/")
+        self.outstanding = 0
+        self.healthy = True
+        self.consecutive_failures = 0
+        self.last_checked: Optional[float] = None
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "url": self.url,
+            "healthy": self.healthy,
+            "outstanding": self.outstanding,
+            "consecutive_failures": self.consecutive_failures,
+            "last_checked": self.last_checked
+        }
+
+
+class OllamaPool:
+    def __init__(self, urls: Iterable[str], eject_after: int = OLLAMA_EJECT_AFTER_FAILURES):
+        """Create the pool. A backend is ejected after eject_after consecutive failures."""
+        self.backends: List[OllamaBackend] = [OllamaBackend(url) for url in urls]
+        if not self.backends:
+            raise ValueError("At least one Ollama backend URL is required")
+        self.eject_after = eject_after
+        self._health_task: Optional[asyncio.Task] = None
+
+    def pick(self, exclude: Iterable[OllamaBackend] = ()) -> Optional[OllamaBackend]:
+        """Return the healthy backend with the fewest requests in flight.
+
+        If every remaining backend is ejected, the least loaded one is still
+        returned so requests are attempted rather than refused outright.
+        """
+        candidates = [b for b in self.backends if b not in exclude]
+        if not candidates:
+            return None
+        healthy = [b for b in candidates if b.healthy]
+        return min(healthy or candidates, key=lambda b: b.outstanding)
+
+    def acquire(self, backend: OllamaBackend):
+        backend.outstanding += 1
+        metrics.set_gauge(f"ollama_outstanding[{backend.url}]", backend.outstanding)
+
+    def release(self, backend: OllamaBackend):
+        backend.outstanding = max(backend.outstanding - 1, 0)
+        metrics.set_gauge(f"ollama_outstanding[{backend.url}]", backend.outstanding)
+
+    def record_success(self, backend: OllamaBackend):
+        backend.consecutive_failures = 0
+        if not backend.healthy:
+            backend.healthy = True
+            metrics.increment("ollama_backend_reinstated_total")
+            logger.info(f"Ollama backend {backend.url} reinstated")
+
+    def record_failure(self, backend: OllamaBackend):
+        backend.consecutive_failures += 1
+        if backend.healthy and backend.consecutive_failures >= self.eject_after:
+            backend.healthy = False
+            metrics.increment("ollama_backend_ejected_total")
+            logger.warning(f"Ollama backend {backend.url} ejected after {backend.consecutive_failures} failures")
+
+    async def probe(self, client: httpx.AsyncClient):
+        """Check every backend once with a cheap request to /api/tags."""
+        async def check(backend: OllamaBackend):
+            try:
+                response = await client.get(f"{backend.url}/api/tags", timeout=OLLAMA_HEALTH_CHECK_TIMEOUT)
+                response.raise_for_status()
+                self.record_success(backend)
+            except Exception as e:
+                logger.debug(f"Health check failed for {backend.url}: {str(e)}")
+                self.record_failure(backend)
+            backend.last_checked = time.time()
+
+        await asyncio.gather(*(check(backend) for backend in self.backends))
+
+    async def _run_health_checks(self, client: httpx.AsyncClient, interval: float):
+        while True:
+            await self.probe(client)
+            await asyncio.sleep(interval)
+
+    def start_health_checks(self, client: httpx.AsyncClient, interval: float = OLLAMA_HEALTH_CHECK_INTERVAL):
+        """Probe backends periodically in the background (interval <= 0 disables probing)."""
+        if interval <= 0 or (self._health_task is not None and not self._health_task.done()):
+            return
+        self._health_task = asyncio.create_task(self._run_health_checks(client, interval))
+
+    async def stop_health_checks(self):
+        if self._health_task is not None:
+            self._health_task.cancel()
+            await asyncio.gather(self._health_task, return_exceptions=True)
+            self._health_task = None
+
+    def status(self) -> List[Dict[str, Any]]:
+        return [backend.status() for backend in self.backends]
@@ -1,51 +1,115 @@
 """Script to initialize and populate ChromaDB with existing chat data."""
-from app.utils.chroma_db import chroma_db
+from app.utils.chroma_db import chroma_db, chat_document_id
 from app.database.db import SessionLocal
 from app.models.user import Chat
 from sqlalchemy.orm import Session
+import argparse
 import logging
+from typing import Any, Dict, List
 from app.config.dataset_config import DATASET_PATH  # Import dataset config
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-def populate_chroma_db():
-    """Populate ChromaDB with existing chat data from the SQL database."""
+def _index_batch(batch: List[Dict[str, Any]], skip_existing: bool) -> int:
+    """Upsert a batch of chat rows, leaving out rows that are already indexed when skip_existing is set."""
+    if skip_existing:
+        existing = chroma_db.existing_ids(
+            [chat_document_id(chat["chat_id"]) for chat in batch],
+            [chat["user_id"] for chat in batch]
+        )
+        batch = [chat for chat in batch if chat_document_id(chat["chat_id"]) not in existing]
+    chroma_db.batch_add_chats(batch)
+    return len(batch)
+
+def _save_progress(committed_mark: int, incremental: bool):
+    """Store the mark reached before a failed batch, without moving an incremental sync backwards."""
+    if incremental and committed_mark <= chroma_db.get_sync_mark():
+        return
+    chroma_db.set_sync_mark(committed_mark)
+    logger.info(f"Stopped at high-water mark {committed_mark}; the next incremental sync resumes from there.")
+
+def populate_chroma_db(incremental: bool = False, batch_size: int = 100):
+    """
+    Populate ChromaDB with chat data from the SQL database.
+    A full rebuild re-upserts every row into the chat memory shards, which keeps
+    chat memory available meanwhile, and then removes the entries of chats and
+    sessions that were deleted from the table. An incremental sync only reads rows
+    after the stored high-water mark and skips rows that are already indexed.
+    Rows are streamed in batches; only their ids are kept for the whole run.
+    If a batch fails, the high-water mark is only advanced past the batches
+    that were written, so the next incremental sync retries the rest.
+    """
     db = SessionLocal()
+    # The mark up to which every row has been written to ChromaDB
+    committed_mark = None
     try:
-        logger.info("Starting to populate ChromaDB with existing chat data...")
-        
-        # Reset the collection to start fresh
-        chroma_db.reset_collection()
-        
-        # Get all chats from the database
-        chats = db.query(Chat).all()
-        
-        # Convert to list of dictionaries for batch processing
-        chat_dicts = []
+        if incremental:
+            mark = chroma_db.get_sync_mark()
+            logger.info(f"Syncing chats after id {mark} into ChromaDB...")
+        else:
+            logger.info("Starting to populate ChromaDB with existing chat data...")
+            mark = 0
+
+        # Stream the rows in id order instead of loading the whole table
+        chats = db.query(Chat).filter(Chat.id > mark).order_by(Chat.id).yield_per(batch_size)
+
+        new_mark = mark
+        committed_mark = mark
+        waiting_for_reply = False
+        scanned = 0
+        indexed = 0
+        # Every chats row id, so a full rebuild can remove entries of deleted rows
+        chat_ids = set()
+        batch = []
         for chat in chats:
-            chat_dicts.append({
+            scanned += 1
+            chat_ids.add(chat.id)
+            if not chat.response:
+                # The reply is still being streamed; keep the mark below it so the next sync picks it up
+                waiting_for_reply = True
+                continue
+            if not waiting_for_reply:
+                new_mark = chat.id
+            if not chat.message:
+                continue
+
+            batch.append({
+                "chat_id": chat.id,
                 "user_id": chat.user_id,
                 "session_id": chat.session_id,
                 "message": chat.message,
                 "response": chat.response
             })
-        
-        # Process in batches of 100
-        batch_size = 100
-        for i in range(0, len(chat_dicts), batch_size):
-            batch = chat_dicts[i:i + batch_size]
-            chroma_db.batch_add_chats(batch)
-            logger.info(f"Processed {i + len(batch)} of {len(chat_dicts)} chats...")
-        
-        logger.info(f"Successfully populated ChromaDB with {len(chat_dicts)} chat entries.")
+            if len(batch) >= batch_size:
+                indexed += _index_batch(batch, skip_existing=incremental)
+                committed_mark = new_mark
+                batch = []
+                logger.info(f"Processed {scanned} chats ({indexed} indexed)...")
+
+        if batch:
+            indexed += _index_batch(batch, skip_existing=incremental)
+
+        if not incremental:
+            # Chats created during the scan are above the highest id it saw and are kept
+            chroma_db.remove_chats_except(chat_ids, max(chat_ids, default=0))
+            # Every row was embedded again, with the model that is loaded now
+            chroma_db.record_chat_vectors()
+
+        chroma_db.set_sync_mark(new_mark)
+        logger.info(f"Successfully populated ChromaDB: scanned {scanned} chats, indexed {indexed}, high-water mark {new_mark}.")
         return True
     except Exception as e:
         logger.error(f"Error populating ChromaDB: {str(e)}")
+        if committed_mark is not None:
+            _save_progress(committed_mark, incremental)
         return False
     finally:
         db.close()
 
 if __name__ == "__main__":
-    populate_chroma_db()
+    parser = argparse.ArgumentParser(description="Index the chats table into ChromaDB")
+    parser.add_argument("--incremental", action="store_true", help="Only index chats added since the last sync")
+    args = parser.parse_args()
+    populate_chroma_db(incremental=args.incremental)
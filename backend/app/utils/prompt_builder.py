@@ -0,0 +1,218 @@
+"""Token-budgeted prompt assembly for the chat and streaming endpoints."""
+import logging
+import re
+from typing import Dict, List, Optional, Tuple
+from app.config.llm_config import PROMPT_MAX_TOKENS, PROMPT_SECTION_BUDGETS, OLLAMA_API_MODE, OLLAMA_CHAT_MAX_TURNS
+from app.utils.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Words, numbers and single punctuation marks; long words count as several tokens
+_TOKEN_RE = re.compile(r"\w+|[^\w\s]")
+TRUNCATION_MARKER = " ...[truncated]"
+
+DEFAULT_SYSTEM_MESSAGE = "You are Nexora AI, a helpful and knowledgeable assistant. Maintain context of the conversation and provide accurate, concise responses. Remember previous information shared by the user.\n\n"
+FILES_SYSTEM_MESSAGE = "You are Nexora AI, a helpful and knowledgeable assistant. The user is sending you messages with attached files which have been converted to text. Please analyze both the message and the extracted text to provide an appropriate response. Be concise and helpful, focusing on what the files actually contain.\n\n"
+KNOWLEDGE_POLISH_SYSTEM_MESSAGE = "You are Nexora AI, a helpful and knowledgeable assistant. The knowledge base below contains the approved answer to the user's question. Rewrite that answer so it addresses the question directly. Keep every fact and instruction from it and do not add new ones.\n\n"
+
+# Sections are shrunk in this order when the whole prompt is over budget
+TRUNCATION_ORDER = ["history", "knowledge", "recent", "attachments", "user", "system"]
+
+# Recent turns dropped at a time when they are over budget. In chat API mode this is the
+# step the get_recent_turns() window moves in, so the turns that stay are the same for
+# several requests and the message prefix (and Ollama's KV cache) is reused.
+TURN_DROP_STEP = max(OLLAMA_CHAT_MAX_TURNS // 2, 1) if OLLAMA_API_MODE == "chat" else 1
+
+
+def count_tokens(text: str) -> int:
+    """Approximate the llama tokenizer: one token per word or symbol, plus one per 6 characters of long words."""
+    return sum(1 + len(piece) // 6 for piece in _TOKEN_RE.findall(text))
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """Cut text after the last piece that fits in max_tokens."""
+    if max_tokens <= 0:
+        return ""
+    used = 0
+    for match in _TOKEN_RE.finditer(text):
+        used += 1 + len(match.group()) // 6
+        if used > max_tokens:
+            return text[:match.start()].rstrip() + TRUNCATION_MARKER
+    return text
+
+
+class PromptResult:
+    def __init__(self, prompt: str, section_tokens: Dict[str, int], truncated: List[str],
+                 messages: Optional[List[Dict[str, str]]] = None):
+        self.prompt = prompt
+        # The same sections as /api/chat messages: a stable system + turns prefix, then the new request
+        self.messages = messages or []
+        self.section_tokens = section_tokens
+        self.total_tokens = sum(section_tokens.values())
+        self.truncated = truncated
+
+
+class PromptBuilder:
+    def __init__(self, system_message: str, max_tokens: int = PROMPT_MAX_TOKENS,
+                 budgets: Optional[Dict[str, int]] = None, turn_drop_step: int = TURN_DROP_STEP):
+        """
+        Collect prompt sections and render them within max_tokens.
+        Each section is first capped at its own budget; if the total is still too
+        large, sections are shrunk in TRUNCATION_ORDER.
+        """
+        self.max_tokens = max_tokens
+        self.turn_drop_step = max(turn_drop_step, 1)
+        self.budgets = dict(PROMPT_SECTION_BUDGETS, **(budgets or {}))
+        self.system = system_message
+        self.history: List[str] = []
+        self.knowledge: List[str] = []
+        self.recent: List[Tuple[str, str]] = []
+        self.recent_header = "Recent conversation:"
+        self.attachments: List[Tuple[str, str]] = []
+
+    def add_history(self, exchanges: List[str]):
+        """Semantically retrieved exchanges, most relevant first."""
+        self.history.extend(e for e in exchanges if e)
+
+    def add_knowledge(self, chunks: List[str]):
+        """RAG knowledge chunks, most relevant first."""
+        self.knowledge.extend(c for c in chunks if c)
+
+    def add_recent_turns(self, turns: List[Tuple[str, str]], header: str = "Recent conversation:"):
+        """(message, response) pairs in chronological order."""
+        self.recent.extend(turns)
+        self.recent_header = header
+
+    def add_attachment(self, name: str, text: str):
+        if text:
+            self.attachments.append((name, text))
+
+    def _render_list(self, header: str, items: List[str]) -> str:
+        if not items:
+            return ""
+        heading = f"{header}\n" if header else ""
+        return heading + "".join(f"{item}\n\n" for item in items)
+
+    def _render_attachments(self, files: List[Tuple[str, str]]) -> str:
+        if not files:
+            return ""
+        return "\n\nAttached files:" + "".join(f"\n\nText from {name}:\n{text}" for name, text in files)
+
+    def _render_sections(self, sections: Dict[str, object]) -> Dict[str, str]:
+        return {
+            "system": sections["system"],
+            "history": self._render_list("Relevant conversation history:", sections["history"]),
+            "knowledge": self._render_list("Relevant domain knowledge:", sections["knowledge"]),
+            "recent": self._render_list(self.recent_header, [f"User: {m}\nAI: {r}" for m, r in sections["recent"]]),
+            "attachments": self._render_attachments(sections["attachments"]),
+            "user": sections["user"],
+        }
+
+    def _shrink(self, sections: Dict[str, object], name: str, max_tokens: int):
+        """Shrink one section until its rendered size fits max_tokens."""
+        def size():
+            return count_tokens(self._render_sections(sections)[name])
+
+        if size() <= max_tokens:
+            return False
+        if name in ("system", "user"):
+            sections[name] = truncate_to_tokens(sections[name], max_tokens)
+        elif name == "attachments":
+            sections[name] = self._fit_attachments(sections[name], max_tokens)
+        elif name == "recent":
+            # Drop the oldest turns, turn_drop_step at a time so the remaining prefix stays stable
+            while sections[name] and size() > max_tokens:
+                sections[name] = sections[name][self.turn_drop_step:]
+        else:
+            # Drop the lowest-ranked retrieved items
+            while sections[name] and size() > max_tokens:
+                sections[name] = sections[name][:-1]
+        return True
+
+    def _fit_attachments(self, files: List[Tuple[str, str]], max_tokens: int) -> List[Tuple[str, str]]:
+        """
+        Truncate the attached files so their rendered section fits max_tokens.
+        What is left after the headers and truncation markers is shared equally,
+        and files shorter than their share pass the rest on to the longer ones.
+        Files are only dropped, last first, when there is no room left for their text.
+        """
+        marker = count_tokens(TRUNCATION_MARKER)
+        while files:
+            sizes = [count_tokens(text) for _, text in files]
+            available = max_tokens - count_tokens(self._render_attachments([(name, "") for name, _ in files]))
+            while available > 0:
+                shares = [0] * len(files)
+                remaining = available
+                by_size = sorted(range(len(files)), key=lambda i: sizes[i])
+                for done, i in enumerate(by_size):
+                    fair = remaining // (len(files) - done)
+                    # A truncated file also needs room for the truncation marker
+                    shares[i] = sizes[i] if sizes[i] <= fair else fair - marker
+                    remaining -= sizes[i] if sizes[i] <= fair else fair
+                if min(shares) <= 0:
+                    break
+                fitted = [
+                    (name, text if sizes[i] <= shares[i] else truncate_to_tokens(text, shares[i]))
+                    for i, (name, text) in enumerate(files)
+                ]
+                overflow = count_tokens(self._render_attachments(fitted)) - max_tokens
+                if overflow <= 0:
+                    return fitted
+                available -= overflow
+            files = files[:-1]
+        return []
+
+    def _build_messages(self, sections: Dict[str, object], rendered: Dict[str, str]) -> List[Dict[str, str]]:
+        """
+        Lay out the sections as chat messages. The system message and the earlier
+        turns come first and only ever grow between requests, while everything
+        retrieved for this request goes into the final user message, so the
+        prefix stays identical and the server can reuse its KV cache.
+        """
+        messages = [{"role": "system", "content": rendered["system"].strip()}]
+        for message, response in sections["recent"]:
+            messages.append({"role": "user", "content": message})
+            messages.append({"role": "assistant", "content": response or ""})
+        context = f"{rendered['history']}{rendered['knowledge']}"
+        messages.append({"role": "user", "content": f"{context}{rendered['user']}{rendered['attachments']}"})
+        return messages
+
+    def build(self, message: str) -> PromptResult:
+        """Render the final prompt for the user's message."""
+        sections = {
+            "system": self.system,
+            "history": list(self.history),
+            "knowledge": list(self.knowledge),
+            "recent": list(self.recent),
+            "attachments": list(self.attachments),
+            "user": message,
+        }
+        truncated = []
+        for name in TRUNCATION_ORDER:
+            if self._shrink(sections, name, self.budgets.get(name, self.max_tokens)):
+                truncated.append(name)
+
+        # Then shrink by priority until the whole prompt fits
+        for name in TRUNCATION_ORDER:
+            rendered = self._render_sections(sections)
+            total = sum(count_tokens(text) for text in rendered.values())
+            if total <= self.max_tokens:
+                break
+            allowed = max(count_tokens(rendered[name]) - (total - self.max_tokens), 0)
+            if self._shrink(sections, name, allowed) and name not in truncated:
+                truncated.append(name)
+
+        rendered = self._render_sections(sections)
+        prompt = (
+            f"{rendered['system']}{rendered['history']}{rendered['knowledge']}{rendered['recent']}"
+            f"User: {rendered['user']}{rendered['attachments']}\nAI:"
+        )
+        section_tokens = {name: count_tokens(text) for name, text in rendered.items()}
+        result = PromptResult(prompt, section_tokens, truncated, self._build_messages(sections, rendered))
+
+        metrics.observe("prompt_tokens", result.total_tokens)
+        if truncated:
+            metrics.increment("prompt_truncated_total")
+            logger.info(f"Prompt truncated to fit {self.max_tokens} tokens (sections: {', '.join(truncated)})")
+        logger.debug(f"Prompt token counts: {section_tokens}")
+        return result
@@ -0,0 +1,76 @@
+"""Exact-match cache of LLM replies keyed by the final prompt and model."""
+import hashlib
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Optional
+from app.config.llm_config import RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_TTL
+from app.utils.metrics import metrics
+
+
+class ResponseCache:
+    def __init__(self, max_entries: int = RESPONSE_CACHE_MAX_ENTRIES, ttl: float = RESPONSE_CACHE_TTL):
+        """LRU cache with a time-to-live; max_entries <= 0 disables caching."""
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (stored_at, reply)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(prompt: str, model: str) -> str:
+        return hashlib.sha256(f"{model}\0{prompt}".encode("utf-8")).hexdigest()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    def get(self, prompt: str, model: str) -> Optional[str]:
+        """Return the cached reply, counting a hit or a miss."""
+        if not self.enabled:
+            return None
+        key = self.make_key(prompt, model)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() - entry[0] > self.ttl:
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                metrics.increment("response_cache_misses")
+                return None
+            self._entries.move_to_end(key)
+        metrics.increment("response_cache_hits")
+        return entry[1]
+
+    def contains(self, prompt: str, model: str) -> bool:
+        """Whether an unexpired reply is cached, without counting a hit or a miss."""
+        if not self.enabled:
+            return False
+        with self._lock:
+            entry = self._entries.get(self.make_key(prompt, model))
+            return entry is not None and time.monotonic() - entry[0] <= self.ttl
+
+    def set(self, prompt: str, model: str, reply: str):
+        if not self.enabled or not reply:
+            return
+        key = self.make_key(prompt, model)
+        with self._lock:
+            self._entries[key] = (time.monotonic(), reply)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            metrics.set_gauge("response_cache_entries", len(self._entries))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            metrics.set_gauge("response_cache_entries", 0)
+
+
+def split_into_chunks(text: str) -> List[str]:
+    """Split a cached reply into word-sized chunks so it streams like a live reply."""
+    return re.findall(r"\s*\S+\s*", text) or [text]
+
+
+# Create a singleton instance
+response_cache = ResponseCache()
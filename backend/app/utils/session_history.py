@@ -0,0 +1,93 @@
+"""Session lookups and prompt context shared by the chat and streaming routes."""
+from datetime import datetime
+from typing import List
+from sqlalchemy.orm import Session
+from app.config.llm_config import OLLAMA_API_MODE, OLLAMA_CHAT_MAX_TURNS
+from app.config.retrieval_config import RETRIEVAL_CANDIDATES
+from app.database.db import SessionLocal
+from app.models.user import Chat, ChatSession
+from app.utils.chroma_db import chroma_db
+from app.utils.context_selector import select_context
+from app.utils.prompt_builder import PromptBuilder
+
+
+def get_recent_turns(db: Session, session_id: int, limit: int) -> List[Chat]:
+    """
+    Return the session's most recent chats in chronological order.
+    In chat API mode the window is OLLAMA_CHAT_MAX_TURNS long and its start only
+    moves in steps of half that, so consecutive requests send the same leading
+    turns and Ollama can reuse the KV cache it built for them.
+    """
+    query = db.query(Chat).filter(Chat.session_id == session_id)
+    if OLLAMA_API_MODE != "chat":
+        return list(reversed(query.order_by(Chat.timestamp.desc(), Chat.id.desc()).limit(limit).all()))
+
+    total = query.count()
+    step = max(OLLAMA_CHAT_MAX_TURNS // 2, 1)
+    start = max(total - OLLAMA_CHAT_MAX_TURNS, 0)
+    # Round up to the next step so the window start stays put for several turns
+    start = -(-start // step) * step
+    return query.order_by(Chat.timestamp.asc(), Chat.id.asc()).offset(start).all()
+
+
+def touch_session(user_id: int, session_id: int) -> bool:
+    """Verify the session belongs to the user and mark it as recently used (runs in a worker thread)."""
+    db = SessionLocal()
+    try:
+        session = db.query(ChatSession).filter(
+            ChatSession.id == session_id,
+            ChatSession.user_id == user_id
+        ).first()
+        if not session:
+            return False
+        session.updated_at = datetime.utcnow()
+        db.commit()
+        return True
+    finally:
+        db.close()
+
+
+def build_session_prompt(db: Session, user_id: int, session_id: int, query: str, system_message: str) -> PromptBuilder:
+    """
+    Collect the semantically relevant and the most recent exchanges of a session
+    into a PromptBuilder (runs in a worker thread, since embedding and the
+    database queries block).
+    """
+    try:
+        # Use ChromaDB to find relevant previous context based on semantic similarity
+        candidates = chroma_db.query_context(
+            user_id=user_id,
+            session_id=session_id,
+            query=query,
+            limit=RETRIEVAL_CANDIDATES
+        )
+
+        # Also get the most recent messages to maintain conversation flow
+        recent_messages = get_recent_turns(db, session_id, limit=3)  # Get last 3 messages for recency bias
+
+        # Keep the 5 closest, non-redundant exchanges that are not already among the recent messages
+        relevant_context = select_context(
+            candidates,
+            limit=5,
+            recent_turns=[(msg.message, msg.response) for msg in recent_messages]
+        )
+
+        # Build context combining semantic relevance with recency
+        prompt_builder = PromptBuilder(system_message)
+
+        # Add semantically relevant context first
+        prompt_builder.add_history(relevant_context)
+
+        # Add recent messages for conversational flow (already in chronological order)
+        prompt_builder.add_recent_turns([(msg.message, msg.response) for msg in recent_messages])
+    except Exception as e:
+        # If there's an issue with ChromaDB, fall back to the traditional method
+        print(f"ChromaDB error, falling back to traditional context retrieval: {str(e)}")
+
+        # Traditional method - get previous messages from this session
+        previous_messages = get_recent_turns(db, session_id, limit=10)
+
+        prompt_builder = PromptBuilder(system_message)
+
+        prompt_builder.add_recent_turns([(msg.message, msg.response) for msg in previous_messages], header="")
+    return prompt_builder
@@ -0,0 +1,106 @@
+"""Coalesce concurrent identical LLM generations into a single upstream request."""
+import asyncio
+import logging
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional
+from app.utils.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class _SharedStream:
+    def __init__(self, source: AsyncIterator[str], on_finished: Callable[[], None]):
+        """Pump one upstream token stream and let any number of subscribers read it from the start."""
+        self.chunks: List[str] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.subscribers = 0
+        self._changed = asyncio.Condition()
+        self._on_finished = on_finished
+        self._task = asyncio.create_task(self._pump(source))
+
+    async def _pump(self, source: AsyncIterator[str]):
+        try:
+            async for chunk in source:
+                async with self._changed:
+                    self.chunks.append(chunk)
+                    self._changed.notify_all()
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            self.error = e
+        finally:
+            # Closing the source closes the upstream HTTP response
+            await source.aclose()
+            self._on_finished()
+            async with self._changed:
+                self.done = True
+                self._changed.notify_all()
+
+    async def subscribe(self) -> AsyncIterator[str]:
+        self.subscribers += 1
+        index = 0
+        try:
+            while True:
+                async with self._changed:
+                    await self._changed.wait_for(lambda: self.done or len(self.chunks) > index)
+                    pieces = self.chunks[index:]
+                    finished = self.done
+                for piece in pieces:
+                    index += 1
+                    yield piece
+                if finished and index >= len(self.chunks):
+                    if self.error is not None:
+                        raise self.error
+                    return
+        finally:
+            self.subscribers -= 1
+            if not self.subscribers and not self.done:
+                # Nobody is listening any more, so stop the shared generation
+                self._on_finished()
+                self._task.cancel()
+
+
+class SingleFlight:
+    def __init__(self):
+        """Tracks in-flight generations by prompt fingerprint."""
+        self._calls: Dict[str, asyncio.Task] = {}
+        self._streams: Dict[str, _SharedStream] = {}
+
+    def in_flight(self, key: str) -> bool:
+        """Whether a generation with this key is running, so a new caller would join it."""
+        return key in self._calls or key in self._streams
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[str]]) -> str:
+        """Run fn once for all concurrent callers with the same key and share its result."""
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fn())
+            self._calls[key] = task
+            task.add_done_callback(lambda _: self._calls.pop(key, None))
+        else:
+            metrics.increment("single_flight_shared_total")
+        # Shield so one caller going away does not cancel the generation for the others
+        return await asyncio.shield(task)
+
+    async def stream(self, key: str, factory: Callable[[], AsyncIterator[str]]) -> AsyncIterator[str]:
+        """Fan one upstream token stream out to every concurrent caller with the same key."""
+        shared = self._streams.get(key)
+        if shared is None:
+            def finished(stream_key=key):
+                if self._streams.get(stream_key) is shared:
+                    del self._streams[stream_key]
+            shared = _SharedStream(factory(), finished)
+            self._streams[key] = shared
+        else:
+            metrics.increment("single_flight_shared_total")
+
+        subscription = shared.subscribe()
+        try:
+            async for chunk in subscription:
+                yield chunk
+        finally:
+            await subscription.aclose()
+
+
+# Create a singleton instance
+single_flight = SingleFlight()
@@ -0,0 +1,133 @@
+"""Bounded in-memory buffers that let clients resume an interrupted streaming reply."""
+import asyncio
+import time
+import logging
+from collections import deque
+from typing import AsyncIterator, Dict, Optional
+from app.config.streaming_config import (
+    STREAM_BUFFER_MAX_CHUNKS,
+    STREAM_BUFFER_TTL,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class OffsetEvictedError(Exception):
+    """Raised when a reader asks for text that has already left the ring buffer."""
+
+
+class StreamBuffer:
+    def __init__(self, stream_id: int, user_id: int, max_chunks: int = STREAM_BUFFER_MAX_CHUNKS):
+        """
+        Ring buffer of reply chunks for one streamed reply.
+        Offsets are character offsets into the reply text, so a client can resume
+        from the number of characters it has already received.
+        """
+        self.stream_id = stream_id
+        self.user_id = user_id
+        # Each entry is (start_offset, chunk)
+        self._chunks = deque(maxlen=max_chunks)
+        self._length = 0
+        self._changed = asyncio.Condition()
+        self.done = False
+        self.completed_at: Optional[float] = None
+        self.subscribers = 0
+        self._abandoned_since: Optional[float] = time.monotonic()
+
+    @property
+    def length(self) -> int:
+        """Number of characters produced so far."""
+        return self._length
+
+    @property
+    def base_offset(self) -> int:
+        """Offset of the oldest character still held in the buffer."""
+        return self._chunks[0][0] if self._chunks else self._length
+
+    async def append(self, chunk: str):
+        async with self._changed:
+            self._chunks.append((self._length, chunk))
+            self._length += len(chunk)
+            self._changed.notify_all()
+
+    async def finish(self):
+        async with self._changed:
+            self.done = True
+            self.completed_at = time.monotonic()
+            self._changed.notify_all()
+
+    def abandoned_for(self) -> float:
+        """Seconds since the last reader went away (0 while someone is reading)."""
+        if self.subscribers or self._abandoned_since is None:
+            return 0.0
+        return time.monotonic() - self._abandoned_since
+
+    def _chunks_from(self, offset: int):
+        if offset < self.base_offset:
+            raise OffsetEvictedError(f"Offset {offset} is no longer buffered (oldest is {self.base_offset})")
+        pieces = []
+        for start, chunk in self._chunks:
+            end = start + len(chunk)
+            if end <= offset:
+                continue
+            pieces.append(chunk[max(offset - start, 0):])
+        return pieces
+
+    async def read(self, offset: int = 0) -> AsyncIterator[str]:
+        """Replay the buffer from offset, then tail live output until the reply is done."""
+        # Fail before registering as a reader so the caller can return a proper error
+        self._chunks_from(offset)
+        self.subscribers += 1
+        self._abandoned_since = None
+        try:
+            while True:
+                async with self._changed:
+                    await self._changed.wait_for(lambda: self.done or self._length > offset)
+                    pieces = self._chunks_from(offset)
+                    finished = self.done
+                for piece in pieces:
+                    offset += len(piece)
+                    yield piece
+                if finished and offset >= self._length:
+                    return
+        finally:
+            self.subscribers -= 1
+            if not self.subscribers:
+                self._abandoned_since = time.monotonic()
+
+
+class StreamRegistry:
+    def __init__(self, ttl: float = STREAM_BUFFER_TTL):
+        """Keeps the buffers of in-flight and recently completed replies, keyed by chat id."""
+        self.ttl = ttl
+        self._buffers: Dict[int, StreamBuffer] = {}
+        # Strong references to producer tasks so they are not garbage collected mid-reply
+        self._tasks: Dict[int, asyncio.Task] = {}
+
+    def _evict_expired(self):
+        now = time.monotonic()
+        for stream_id, buffer in list(self._buffers.items()):
+            if buffer.done and buffer.completed_at is not None and now - buffer.completed_at > self.ttl:
+                del self._buffers[stream_id]
+                logger.debug(f"Evicted stream buffer {stream_id}")
+
+    def create(self, stream_id: int, user_id: int) -> StreamBuffer:
+        self._evict_expired()
+        buffer = StreamBuffer(stream_id, user_id)
+        self._buffers[stream_id] = buffer
+        return buffer
+
+    def get(self, stream_id: int) -> Optional[StreamBuffer]:
+        self._evict_expired()
+        return self._buffers.get(stream_id)
+
+    def start(self, stream_id: int, coro) -> asyncio.Task:
+        """Run the producer for a buffer in the background, independent of any client connection."""
+        task = asyncio.create_task(coro)
+        self._tasks[stream_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(stream_id, None))
+        return task
+
+
+# Create a singleton instance
+stream_registry = StreamRegistry()
@@ -0,0 +1,112 @@
+"""Exact in-memory vector search over a memory-mapped .npy embedding matrix, for small static collections."""
+import json
+import logging
+import os
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class NumpyVectorIndex:
+    def __init__(self, vectors: np.ndarray, ids: Sequence[str], documents: Sequence[str],
+                 partitions: Optional[Dict[str, Tuple[int, int]]] = None):
+        """
+        vectors holds one L2-normalized row per id, in float32 or float16.
+        partitions maps a category to its contiguous [start, end) range of rows.
+        """
+        self.vectors = vectors
+        self.ids = list(ids)
+        self.documents = list(documents)
+        self.partitions = {name: (int(start), int(end)) for name, (start, end) in (partitions or {}).items()}
+        self._positions = {doc_id: i for i, doc_id in enumerate(self.ids)}
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @staticmethod
+    def _normalize(vectors) -> np.ndarray:
+        vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+        return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+    @classmethod
+    def build(cls, prefix: str, ids: Sequence[str], documents: Sequence[str], embeddings,
+              dtype: str = "float32", categories: Optional[Sequence[str]] = None) -> "NumpyVectorIndex":
+        """
+        Write {prefix}.npy (normalized embeddings) and {prefix}.json (ids and documents), then load them.
+        With categories, rows are grouped by category so each partition is one slice of the matrix.
+        """
+        vectors = cls._normalize(embeddings).astype(dtype) if len(ids) else np.zeros((0, 0), dtype=dtype)
+        ids, documents = list(ids), list(documents)
+        partitions = {}
+        if categories is not None and len(ids):
+            labels = np.asarray([c or "" for c in categories])
+            order = np.argsort(labels, kind="stable")
+            vectors = vectors[order]
+            ids = [ids[i] for i in order]
+            documents = [documents[i] for i in order]
+            names, starts, counts = np.unique(labels[order], return_index=True, return_counts=True)
+            partitions = {str(n): [int(s), int(s + c)] for n, s, c in zip(names, starts, counts)}
+        with open(f"{prefix}.npy.tmp", "wb") as f:
+            np.save(f, vectors)
+        with open(f"{prefix}.json.tmp", "w", encoding="utf-8") as f:
+            json.dump({"ids": ids, "documents": documents, "partitions": partitions}, f)
+        # The matrix is replaced last, so a reader never pairs new ids with old vectors
+        os.replace(f"{prefix}.json.tmp", f"{prefix}.json")
+        os.replace(f"{prefix}.npy.tmp", f"{prefix}.npy")
+        return cls.load(prefix)
+
+    @classmethod
+    def load(cls, prefix: str) -> "NumpyVectorIndex":
+        """Memory-map the matrix; pages are read on first use and shared between processes."""
+        vectors = np.load(f"{prefix}.npy", mmap_mode="r")
+        with open(f"{prefix}.json", encoding="utf-8") as f:
+            data = json.load(f)
+        if len(data["ids"]) != len(vectors):
+            raise ValueError(f"{prefix}: {len(data['ids'])} ids for {len(vectors)} vectors")
+        return cls(vectors, data["ids"], data["documents"], data.get("partitions"))
+
+    def _result(self, i: int, distance: float) -> Dict[str, Any]:
+        return {
+            "id": self.ids[i],
+            "document": self.documents[i],
+            "distance": distance,
+            "embedding": np.asarray(self.vectors[i], dtype=np.float32),
+        }
+
+    def query(self, embeddings, limit: int, partitions: Optional[Sequence[str]] = None) -> List[List[Dict[str, Any]]]:
+        """
+        Exact cosine search for a batch of query embeddings: one matrix product and
+        argpartition per batch. When partitions are given, only their rows are
+        scanned. Returns, per query, up to limit results nearest first in the
+        query_context() format.
+        """
+        queries = self._normalize(embeddings)
+        if partitions is None:
+            spans = [(0, len(self.ids))]
+        else:
+            spans = [self.partitions[name] for name in partitions if name in self.partitions]
+        rows = np.concatenate([np.arange(start, end) for start, end in spans]) if spans else np.zeros(0, dtype=np.int64)
+        if not len(rows) or limit <= 0:
+            return [[] for _ in range(len(queries))]
+        k = min(limit, len(rows))
+
+        # Partitions are contiguous slices, so no rows are copied; float16 is promoted to float32 by the product
+        scores = np.concatenate([queries @ self.vectors[start:end].T for start, end in spans], axis=1)
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        top_scores = np.take_along_axis(scores, top, axis=1)
+        order = np.argsort(-top_scores, axis=1, kind="stable")
+        top = rows[np.take_along_axis(top, order, axis=1)]
+        top_scores = np.take_along_axis(top_scores, order, axis=1)
+        return [
+            [self._result(int(i), float(1.0 - s)) for i, s in zip(row, row_scores)]
+            for row, row_scores in zip(top, top_scores)
+        ]
+
+    def get(self, ids: Sequence[str], query_embedding) -> List[Dict[str, Any]]:
+        """The given documents with their cosine distance to the query embedding, skipping unknown ids."""
+        positions = [self._positions[doc_id] for doc_id in ids if doc_id in self._positions]
+        if not positions:
+            return []
+        scores = np.asarray(self.vectors[positions], dtype=np.float32) @ self._normalize(query_embedding)[0]
+        return [self._result(i, float(1.0 - s)) for i, s in zip(positions, scores)]
@@ -0,0 +1,75 @@
+"""Fake Ollama servers for testing the LLM client without a network."""
+import asyncio
+import json
+import os
+import sys
+from typing import Dict, List, Optional
+import httpx
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class FakeOllama:
+    def __init__(self, url: str, reply: str = "Hello from the fake server", first_token_delay: float = 0.0,
+                 down: bool = False):
+        """
+        One fake Ollama server. A server that is down refuses connections, and
+        first_token_delay holds back the first streamed chunk (to trigger hedging).
+        """
+        self.url = url
+        self.reply = reply
+        self.first_token_delay = first_token_delay
+        self.down = down
+        self.requests: List[str] = []
+        self.streams_closed = 0
+
+    async def handle(self, request: httpx.Request) -> httpx.Response:
+        if self.down:
+            raise httpx.ConnectError("Connection refused", request=request)
+        self.requests.append(request.url.path)
+        if request.url.path == "/api/tags":
+            return httpx.Response(200, json={"models": []})
+
+        body = json.loads(request.content)
+        key = "message" if request.url.path == "/api/chat" else "response"
+        if not body.get("stream"):
+            content = {"role": "assistant", "content": self.reply} if key == "message" else self.reply
+            return httpx.Response(200, json={key: content, "done": True})
+        return httpx.Response(200, content=self._stream(key))
+
+    async def _stream(self, key: str):
+        try:
+            await asyncio.sleep(self.first_token_delay)
+            for word in self.reply.split(" "):
+                content = {"role": "assistant", "content": f"{word} "} if key == "message" else f"{word} "
+                yield (json.dumps({key: content, "done": False}) + "\n").encode("utf-8")
+            yield (json.dumps({key: "" if key == "response" else {"content": ""}, "done": True}) + "\n").encode("utf-8")
+        finally:
+            self.streams_closed += 1
+
+
+class FakeOllamaCluster:
+    def __init__(self, servers: List[FakeOllama]):
+        """Route requests to the fake server whose URL matches the request host."""
+        self.servers: Dict[str, FakeOllama] = {server.url: server for server in servers}
+        self.transport = httpx.MockTransport(self.handle)
+
+    async def handle(self, request: httpx.Request) -> httpx.Response:
+        server: Optional[FakeOllama] = self.servers.get(f"{request.url.scheme}://{request.url.netloc.decode()}")
+        if server is None:
+            raise httpx.ConnectError("Unknown host", request=request)
+        return await server.handle(request)
+
+    @property
+    def urls(self) -> List[str]:
+        return list(self.servers)
+
+
+@pytest.fixture(autouse=True)
+def clear_response_cache():
+    """Replies cached by one test must not answer the next one."""
+    from app.utils.response_cache import response_cache
+    response_cache.clear()
+    yield
+    response_cache.clear()
@@ -0,0 +1,44 @@
+"""The ingestion embedding pool keeps its worker processes for the whole job."""
+import numpy as np
+from app.utils import embedding_worker
+from app.utils.embedding_worker import EmbeddingPool
+
+
+class _InlineExecutor:
+    """Stands in for ProcessPoolExecutor and embeds in-process."""
+    created = []
+
+    def __init__(self, max_workers, mp_context, initializer, initargs):
+        self.start_method = mp_context.get_start_method()
+        self.shut_down = False
+        _InlineExecutor.created.append(self)
+
+    def map(self, fn, batches):
+        return [np.full((len(batch), 2), len(batch[0]), dtype=np.float32) for batch in batches]
+
+    def shutdown(self):
+        self.shut_down = True
+
+
+def test_pool_is_created_once_and_reused_across_calls(monkeypatch):
+    monkeypatch.setattr(embedding_worker, "ProcessPoolExecutor", _InlineExecutor)
+    _InlineExecutor.created = []
+
+    with EmbeddingPool(workers=2, batch_size=2) as pool:
+        for _ in range(3):
+            assert pool.embed(["a", "bb", "ccc", "dddd"]).shape == (4, 2)
+
+    assert len(_InlineExecutor.created) == 1
+    executor = _InlineExecutor.created[0]
+    assert executor.start_method == "spawn"
+    assert executor.shut_down
+
+
+def test_single_batch_is_embedded_in_process_without_a_pool(monkeypatch):
+    monkeypatch.setattr(embedding_worker, "ProcessPoolExecutor", _InlineExecutor)
+    _InlineExecutor.created = []
+
+    with EmbeddingPool(workers=4, batch_size=8, fallback=lambda texts: [[1.0, 0.0]] * len(texts)) as pool:
+        assert pool.embed(["a", "b"]).shape == (2, 2)
+
+    assert _InlineExecutor.created == []
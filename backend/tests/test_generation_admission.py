@@ -0,0 +1,47 @@
+"""Admission control only applies to requests that start an upstream generation."""
+import asyncio
+import pytest
+from app.utils.generation_scheduler import GenerationScheduler, SchedulerBusyError
+from app.utils.llm_client import LLMClient
+from conftest import FakeOllama, FakeOllamaCluster
+
+
+def test_identical_requests_share_one_slot():
+    server = FakeOllama("http://a:11434", reply="shared reply", first_token_delay=0.05)
+    client = LLMClient(base_urls=["http://a:11434"], transport=FakeOllamaCluster([server]).transport)
+    # One slot and no queue: a second admitted generation would be rejected
+    scheduler = GenerationScheduler(max_concurrent=1, max_queue=0)
+
+    async def run():
+        try:
+            return await asyncio.gather(*(
+                client.generate("incident question", slot=lambda user_id=user_id: scheduler.slot(user_id))
+                for user_id in range(5)
+            ))
+        finally:
+            await client.aclose()
+
+    assert asyncio.run(run()) == ["shared reply"] * 5
+    assert server.requests == ["/api/generate"]
+
+
+def test_cached_reply_does_not_wait_for_a_slot():
+    server = FakeOllama("http://a:11434", reply="cached reply")
+    client = LLMClient(base_urls=["http://a:11434"], transport=FakeOllamaCluster([server]).transport)
+    scheduler = GenerationScheduler(max_concurrent=1, max_queue=0)
+
+    async def run():
+        try:
+            await client.generate("popular question", slot=lambda: scheduler.slot(1))
+            # Saturate the scheduler; a cached reply is still served
+            await scheduler.acquire(2)
+            assert not client.needs_generation("popular question")
+            cached = await client.generate("popular question", slot=lambda: scheduler.slot(3))
+            with pytest.raises(SchedulerBusyError):
+                await client.generate("new question", slot=lambda: scheduler.slot(3))
+            return cached
+        finally:
+            await client.aclose()
+
+    assert asyncio.run(run()) == "cached reply"
+    assert server.requests == ["/api/generate"]
@@ -0,0 +1,76 @@
+"""Generation slots are handed out round-robin across users, with a bounded queue."""
+import asyncio
+import pytest
+from app.utils.generation_scheduler import GenerationScheduler, SchedulerBusyError
+
+
+def test_waiting_requests_are_admitted_round_robin_across_users():
+    scheduler = GenerationScheduler(max_concurrent=1, max_queue=10, queue_timeout=5)
+    admitted = []
+
+    async def request(user_id, name):
+        await scheduler.acquire(user_id)
+        admitted.append(name)
+
+    async def run():
+        await scheduler.acquire("alice")
+        # Alice queues a burst before Bob asks for anything
+        waiting = [asyncio.create_task(request(user_id, name)) for user_id, name in (
+            ("alice", "alice-2"), ("alice", "alice-3"), ("alice", "alice-4"), ("bob", "bob-1"), ("bob", "bob-2"),
+        )]
+        await asyncio.sleep(0)
+        for _ in waiting:
+            scheduler.release()
+            await asyncio.sleep(0)
+        await asyncio.gather(*waiting)
+
+    asyncio.run(run())
+    assert admitted == ["alice-2", "bob-1", "alice-3", "bob-2", "alice-4"]
+
+
+def test_full_queue_rejects_new_requests():
+    scheduler = GenerationScheduler(max_concurrent=1, max_queue=1, queue_timeout=5)
+
+    async def run():
+        await scheduler.acquire("alice")
+        queued = asyncio.create_task(scheduler.acquire("bob"))
+        await asyncio.sleep(0)
+        with pytest.raises(SchedulerBusyError) as raised:
+            await scheduler.acquire("carol")
+        scheduler.release()
+        await queued
+        return raised.value.retry_after
+
+    assert asyncio.run(run()) >= 1
+
+
+def test_timed_out_waiter_leaves_the_queue():
+    scheduler = GenerationScheduler(max_concurrent=1, max_queue=1, queue_timeout=0.01)
+
+    async def run():
+        await scheduler.acquire("alice")
+        with pytest.raises(SchedulerBusyError):
+            await scheduler.acquire("bob")
+        # The queue place is free again, and releasing does not hand the slot to the gone waiter
+        scheduler.release()
+        await asyncio.wait_for(scheduler.acquire("carol"), 1)
+        return scheduler._active, scheduler._queued
+
+    assert asyncio.run(run()) == (1, 0)
+
+
+def test_cancelled_waiter_does_not_take_the_slot():
+    scheduler = GenerationScheduler(max_concurrent=1, max_queue=2, queue_timeout=5)
+
+    async def run():
+        await scheduler.acquire("alice")
+        gone = asyncio.create_task(scheduler.acquire("bob"))
+        waiting = asyncio.create_task(scheduler.acquire("carol"))
+        await asyncio.sleep(0)
+        gone.cancel()
+        await asyncio.gather(gone, return_exceptions=True)
+        scheduler.release()
+        await asyncio.wait_for(waiting, 1)
+        return scheduler._active, scheduler._queued
+
+    assert asyncio.run(run()) == (1, 0)
@@ -0,0 +1,22 @@
+"""Exact transaction-code matching and tokenization of the lexical index."""
+from app.utils.lexical_index import LexicalIndex, extract_codes, tokenize
+
+
+def test_letter_only_codes_are_extracted_but_acronyms_and_non_codes_are_not():
+    assert extract_codes("Error while posting invoice in MIRO") == ["MIRO"]
+    assert extract_codes("Mismatch between mmbe and MB52") == ["MMBE", "MB52"]
+    assert extract_codes("SAP GUI, BAPI, MP3, S4 and ISO9001") == []
+    assert extract_codes("Run SE16N, FBL1N and F110") == ["SE16N", "FBL1N", "F110"]
+
+
+def test_slash_separated_codes_are_split():
+    assert tokenize("va01/va02") == ["va01", "va02"]
+    assert extract_codes("va01/va02") == ["VA01", "VA02"]
+
+
+def test_only_codes_seen_in_the_dataset_match():
+    texts = ["System dump during VA01", "Error while posting invoice in MIRO", "Customer data missing in XD03"]
+    index = LexicalIndex(["a", "b", "c"], texts, texts)
+    assert sorted(index.codes) == ["MIRO", "VA01", "XD03"]
+    assert index.match_codes("what changed between va01/va02 and miro?") == [0, 1]
+    assert index.match_codes("MIGO is slow") == []
@@ -0,0 +1,146 @@
+"""Routing, failover, ejection and hedging of the Ollama backend pool against fake servers."""
+import asyncio
+import pytest
+from app.utils.llm_client import LLMClient, LLMUnavailableError
+from app.utils.ollama_pool import OllamaPool
+from conftest import FakeOllama, FakeOllamaCluster
+
+
+def _client(cluster: FakeOllamaCluster, **options) -> LLMClient:
+    return LLMClient(base_urls=cluster.urls, model="test-model", transport=cluster.transport, **options)
+
+
+async def _collect(client: LLMClient, prompt: str) -> str:
+    reply = ""
+    async for chunk in client.stream(prompt):
+        reply += chunk
+    return reply
+
+
+def test_pick_prefers_the_least_loaded_healthy_backend():
+    pool = OllamaPool(["http://a:11434", "http://b:11434", "http://c:11434"])
+    a, b, c = pool.backends
+    pool.acquire(a)
+    pool.acquire(b)
+    assert pool.pick() is c
+
+    c.healthy = False
+    pool.acquire(a)
+    assert pool.pick() is b
+    assert pool.pick(exclude=[a, b]) is c  # Ejected backends are still tried as a last resort
+    assert pool.pick(exclude=[a, b, c]) is None
+
+
+def test_generate_fails_over_to_a_reachable_backend():
+    down = FakeOllama("http://down:11434", down=True)
+    up = FakeOllama("http://up:11434", reply="from up")
+    client = _client(FakeOllamaCluster([down, up]))
+
+    async def run():
+        try:
+            return await client.generate("failover prompt")
+        finally:
+            await client.aclose()
+
+    assert asyncio.run(run()) == "from up"
+    assert up.requests == ["/api/generate"]
+    assert client.pool.backends[0].consecutive_failures == 1
+
+
+def test_backend_is_ejected_after_repeated_failures():
+    down = FakeOllama("http://down:11434", down=True)
+    up = FakeOllama("http://up:11434")
+    client = _client(FakeOllamaCluster([down, up]))
+    client.pool.eject_after = 2
+    # Keep the healthy server busy so the failing one is picked first
+    client.pool.acquire(client.pool.backends[1])
+
+    async def run():
+        try:
+            for i in range(2):
+                await client.generate(f"ejection prompt {i}")
+        finally:
+            await client.aclose()
+
+    asyncio.run(run())
+    assert client.pool.backends[0].healthy is False
+
+
+def test_all_backends_down_raises_unavailable():
+    cluster = FakeOllamaCluster([FakeOllama("http://a:11434", down=True), FakeOllama("http://b:11434", down=True)])
+    client = _client(cluster)
+
+    async def run():
+        try:
+            await client.generate("nobody home")
+        finally:
+            await client.aclose()
+
+    with pytest.raises(LLMUnavailableError):
+        asyncio.run(run())
+
+
+def test_stream_fails_over_to_a_reachable_backend():
+    down = FakeOllama("http://down:11434", down=True)
+    up = FakeOllama("http://up:11434", reply="streamed from up")
+    client = _client(FakeOllamaCluster([down, up]))
+
+    async def run():
+        try:
+            return await _collect(client, "stream failover prompt")
+        finally:
+            await client.aclose()
+
+    assert asyncio.run(run()).strip() == "streamed from up"
+
+
+def test_slow_first_token_is_hedged_to_another_backend():
+    slow = FakeOllama("http://slow:11434", reply="slow reply", first_token_delay=2.0)
+    fast = FakeOllama("http://fast:11434", reply="fast reply")
+    client = _client(FakeOllamaCluster([slow, fast]), hedge_after=0.05)
+
+    async def run():
+        try:
+            return await asyncio.wait_for(_collect(client, "hedged prompt"), 1.0)
+        finally:
+            await client.aclose()
+
+    assert asyncio.run(run()).strip() == "fast reply"
+    assert slow.requests == ["/api/generate"] and fast.requests == ["/api/generate"]
+    # The losing request was closed instead of being left to generate
+    assert slow.streams_closed == 1
+    assert all(backend.outstanding == 0 for backend in client.pool.backends)
+
+
+def test_chat_mode_posts_messages_to_the_chat_api():
+    server = FakeOllama("http://a:11434", reply="chat reply")
+    client = _client(FakeOllamaCluster([server]), api_mode="chat")
+    messages = [{"role": "system", "content": "Be brief."}, {"role": "user", "content": "Hi"}]
+
+    async def run():
+        try:
+            return await client.generate("ignored in chat mode", messages=messages)
+        finally:
+            await client.aclose()
+
+    assert asyncio.run(run()) == "chat reply"
+    assert server.requests == ["/api/chat"]
+
+
+def test_health_checks_eject_and_reinstate_backends():
+    flaky = FakeOllama("http://flaky:11434", down=True)
+    cluster = FakeOllamaCluster([flaky, FakeOllama("http://steady:11434")])
+    client = _client(cluster)
+    client.pool.eject_after = 1
+
+    async def run():
+        try:
+            await client.pool.probe(client._get_client())
+            ejected = not client.pool.backends[0].healthy
+            flaky.down = False
+            await client.pool.probe(client._get_client())
+            return ejected, client.pool.backends[0].healthy
+        finally:
+            await client.aclose()
+
+    assert asyncio.run(run()) == (True, True)
@@ -0,0 +1,62 @@
+"""Token budgets of the prompt builder."""
+from app.utils.prompt_builder import PromptBuilder, TRUNCATION_MARKER, count_tokens
+
+
+def _text(words: int, word: str = "invoice") -> str:
+    return " ".join(f"{word}{i}" for i in range(words))
+
+
+def test_oversized_attachment_is_truncated_not_dropped():
+    builder = PromptBuilder("System.\n\n")
+    builder.add_attachment("report.pdf", _text(1600))
+    result = builder.build("Summarize the attached file")
+
+    budget = builder.budgets["attachments"]
+    assert budget - 20 <= result.section_tokens["attachments"] <= budget
+    assert "Text from report.pdf:\ninvoice0 invoice1" in result.prompt
+    assert TRUNCATION_MARKER in result.prompt
+    assert "attachments" in result.truncated
+
+
+def test_attachments_share_the_budget_equally():
+    builder = PromptBuilder("System.\n\n")
+    builder.add_attachment("a.pdf", _text(1600, "alpha"))
+    builder.add_attachment("b.pdf", _text(1600, "beta"))
+    builder.add_attachment("note.txt", "short note")
+    result = builder.build("Compare the files")
+
+    assert result.section_tokens["attachments"] <= builder.budgets["attachments"]
+    sections = result.prompt.split("\n\nText from ")[1:]
+    assert [s.split(":", 1)[0] for s in sections] == ["a.pdf", "b.pdf", "note.txt"]
+    # The short file is kept whole and the two long ones get the same share of the rest
+    assert sections[2].startswith("note.txt:\nshort note")
+    sizes = [count_tokens(s) for s in sections[:2]]
+    assert abs(sizes[0] - sizes[1]) <= 2 and min(sizes) > 600
+
+
+def test_attachments_within_budget_are_unchanged():
+    builder = PromptBuilder("System.\n\n")
+    builder.add_attachment("small.txt", "just a few words")
+    result = builder.build("Read it")
+    assert result.prompt.endswith("Text from small.txt:\njust a few words\nAI:")
+    assert not result.truncated
+
+
+def _window(turns, max_turns=8):
+    """The chat-mode window of get_recent_turns(): its start moves in steps of max_turns // 2."""
+    step = max_turns // 2
+    start = -(-max(len(turns) - max_turns, 0) // step) * step
+    return turns[start:]
+
+
+def test_over_budget_turns_are_trimmed_at_window_steps():
+    turns = [(f"question {i}", _text(80, f"answer{i}w")) for i in range(20)]
+    for asked in range(1, len(turns) + 1):
+        builder = PromptBuilder("System.\n\n", turn_drop_step=4)
+        builder.add_recent_turns(_window(turns[:asked]))
+        result = builder.build("next question")
+        assert result.section_tokens["recent"] <= builder.budgets["recent"]
+        if len(result.messages) > 2:
+            # Dropping one turn at a time would move the first sent turn on every request
+            first = int(result.messages[1]["content"].split()[-1])
+            assert first % 4 == 0
@@ -0,0 +1,66 @@
+"""Exact-match reply cache: expiry, LRU eviction and hit accounting."""
+from app.utils import response_cache as response_cache_module
+from app.utils.metrics import metrics
+from app.utils.response_cache import ResponseCache, split_into_chunks
+
+
+class _Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_entries_expire_after_the_ttl(monkeypatch):
+    clock = _Clock()
+    monkeypatch.setattr(response_cache_module.time, "monotonic", clock)
+    cache = ResponseCache(max_entries=10, ttl=60)
+    cache.set("prompt", "model", "reply")
+
+    clock.now += 60
+    assert cache.get("prompt", "model") == "reply"
+    clock.now += 1
+    assert not cache.contains("prompt", "model")
+    assert cache.get("prompt", "model") is None
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = ResponseCache(max_entries=2, ttl=60)
+    cache.set("first", "model", "1")
+    cache.set("second", "model", "2")
+    # Reading "first" makes "second" the least recently used entry
+    assert cache.get("first", "model") == "1"
+    cache.set("third", "model", "3")
+
+    assert cache.get("second", "model") is None
+    assert cache.get("first", "model") == "1"
+    assert cache.get("third", "model") == "3"
+
+
+def test_keys_include_the_model():
+    cache = ResponseCache(max_entries=10, ttl=60)
+    cache.set("prompt", "model-a", "reply")
+    assert cache.get("prompt", "model-b") is None
+
+
+def test_contains_does_not_count_hits_or_misses():
+    cache = ResponseCache(max_entries=10, ttl=60)
+    cache.set("prompt", "model", "reply")
+    hits, misses = metrics.get_counter("response_cache_hits"), metrics.get_counter("response_cache_misses")
+
+    assert cache.contains("prompt", "model")
+    assert not cache.contains("other", "model")
+    assert metrics.get_counter("response_cache_hits") == hits
+    assert metrics.get_counter("response_cache_misses") == misses
+
+
+def test_zero_entries_disables_the_cache():
+    cache = ResponseCache(max_entries=0, ttl=60)
+    cache.set("prompt", "model", "reply")
+    assert cache.get("prompt", "model") is None
+
+
+def test_chunks_rebuild_the_reply():
+    reply = "  Restart the  service,\nthen check the logs. "
+    assert "".join(split_into_chunks(reply)) == reply
@@ -0,0 +1,107 @@
+"""Identical concurrent streams share one upstream generation."""
+import asyncio
+from app.utils.llm_client import LLMClient
+from app.utils.single_flight import SingleFlight
+from conftest import FakeOllama, FakeOllamaCluster
+
+
+class _Source:
+    def __init__(self, chunks):
+        """Upstream stream that yields one chunk each time release() is called."""
+        self.chunks = chunks
+        self.opened = 0
+        self.closed = False
+        self._ready = asyncio.Semaphore(0)
+
+    def release(self, count: int = 1):
+        for _ in range(count):
+            self._ready.release()
+
+    async def stream(self):
+        self.opened += 1
+        try:
+            for chunk in self.chunks:
+                await self._ready.acquire()
+                yield chunk
+        finally:
+            self.closed = True
+
+
+async def _collect(stream) -> str:
+    return "".join([chunk async for chunk in stream])
+
+
+def test_concurrent_identical_streams_make_one_request():
+    server = FakeOllama("http://a:11434", reply="shared streamed reply", first_token_delay=0.05)
+    client = LLMClient(base_urls=["http://a:11434"], transport=FakeOllamaCluster([server]).transport)
+
+    async def read():
+        return "".join([chunk async for chunk in client.stream("incident question")])
+
+    async def run():
+        try:
+            return await asyncio.gather(*(read() for _ in range(3)))
+        finally:
+            await client.aclose()
+
+    assert asyncio.run(run()) == ["shared streamed reply "] * 3
+    assert server.requests == ["/api/generate"]
+    assert server.streams_closed == 1
+
+
+def test_late_joiner_receives_the_reply_from_the_start():
+    async def run():
+        flights = SingleFlight()
+        source = _Source(["one ", "two ", "three"])
+        first = flights.stream("key", source.stream)
+        source.release()
+        assert await first.__anext__() == "one "
+
+        # Joins after "one " was already delivered to the first reader
+        late = asyncio.create_task(_collect(flights.stream("key", source.stream)))
+        await asyncio.sleep(0)
+        source.release(2)
+        rest = "".join([chunk async for chunk in first])
+        return rest, await asyncio.wait_for(late, 1), source.opened, flights.in_flight("key")
+
+    assert asyncio.run(run()) == ("two three", "one two three", 1, False)
+
+
+def test_last_subscriber_leaving_closes_the_upstream_stream():
+    async def run():
+        flights = SingleFlight()
+        source = _Source(["one ", "two ", "three"])
+        readers = [flights.stream("key", source.stream) for _ in range(2)]
+        source.release()
+        for reader in readers:
+            assert await reader.__anext__() == "one "
+
+        await readers[0].aclose()
+        # Another subscriber is still reading, so the generation continues
+        assert flights.in_flight("key") and not source.closed
+        await readers[1].aclose()
+        await asyncio.sleep(0)
+        return source.closed, flights.in_flight("key")
+
+    assert asyncio.run(run()) == (True, False)
+
+
+def test_upstream_errors_reach_every_subscriber():
+    async def failing():
+        yield "partial "
+        raise RuntimeError("backend went away")
+
+    async def read(flights):
+        chunks = []
+        try:
+            async for chunk in flights.stream("key", failing):
+                chunks.append(chunk)
+        except RuntimeError as e:
+            chunks.append(str(e))
+        return chunks
+
+    async def run():
+        flights = SingleFlight()
+        return await asyncio.gather(read(flights), read(flights))
+
+    assert asyncio.run(run()) == [["partial ", "backend went away"]] * 2
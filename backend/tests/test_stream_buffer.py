@@ -0,0 +1,74 @@
+"""Resumable stream buffers: offsets, eviction and abandonment."""
+import asyncio
+import time
+import pytest
+from app.utils.stream_buffer import OffsetEvictedError, StreamBuffer, StreamRegistry
+
+
+async def _read(buffer: StreamBuffer, offset: int = 0) -> str:
+    return "".join([chunk async for chunk in buffer.read(offset)])
+
+
+def test_resume_from_an_offset_inside_a_chunk():
+    async def run():
+        buffer = StreamBuffer(1, user_id=7)
+        for chunk in ("Hello ", "wide ", "world"):
+            await buffer.append(chunk)
+        await buffer.finish()
+        return await _read(buffer), await _read(buffer, 8), await _read(buffer, buffer.length)
+
+    assert asyncio.run(run()) == ("Hello wide world", "de world", "")
+
+
+def test_reader_tails_live_output_until_finished():
+    async def run():
+        buffer = StreamBuffer(1, user_id=7)
+        reader = asyncio.create_task(_read(buffer))
+        for chunk in ("one ", "two ", "three"):
+            await asyncio.sleep(0.01)
+            await buffer.append(chunk)
+        await buffer.finish()
+        return await asyncio.wait_for(reader, 1)
+
+    assert asyncio.run(run()) == "one two three"
+
+
+def test_offsets_that_left_the_ring_buffer_are_rejected():
+    async def run():
+        buffer = StreamBuffer(1, user_id=7, max_chunks=2)
+        for chunk in ("aa", "bb", "cc"):
+            await buffer.append(chunk)
+        await buffer.finish()
+        assert buffer.base_offset == 2
+        assert await _read(buffer, 3) == "bcc"
+        with pytest.raises(OffsetEvictedError):
+            await _read(buffer, 1)
+
+    asyncio.run(run())
+
+
+def test_abandoned_time_counts_only_while_nobody_reads():
+    async def run():
+        buffer = StreamBuffer(1, user_id=7)
+        await buffer.append("partial")
+        reader = buffer.read(0)
+        assert await reader.__anext__() == "partial"
+        # A connected reader keeps the generation alive past the resume grace period
+        assert buffer.abandoned_for() == 0.0
+        await reader.aclose()
+        await asyncio.sleep(0.02)
+        return buffer.abandoned_for()
+
+    assert asyncio.run(run()) >= 0.02
+
+
+def test_registry_evicts_finished_buffers_after_the_ttl():
+    async def run():
+        registry = StreamRegistry(ttl=60)
+        running = registry.create(1, user_id=7)
+        finished = registry.create(2, user_id=7)
+        await finished.finish()
+        finished.completed_at = time.monotonic() - 61
+        return registry.get(1) is running, registry.get(2)
+
+    assert asyncio.run(run()) == (True, None)